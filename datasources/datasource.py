@@ -2,13 +2,14 @@ import os
 import sys
 import shutil
 import logging
-import zipfile
 import arcpy
-import requests
 import validators
 
+from utilities import archive
 from utilities import settings
 from utilities import util
+from utilities import dataset_cache
+from utilities import downloader
 
 
 class DataSource(object):
@@ -90,36 +91,23 @@ class DataSource(object):
 
         self._data_source = d
 
-    @staticmethod
-    def download_file(url, output_dir):
-        fname = os.path.split(url)[1]
-        path = os.path.join(output_dir, fname)
-
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        r = requests.get(url, stream=True)
-
-        logging.info("Downloading {0!s} to {1}".format(url, path))
-        with open(path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                f.write(chunk)
-                # f.flush # apparently has no effect
-                # http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-        logging.debug("Download complete.")
-
-        return path
-
-    @staticmethod
-    def unzip(filename, folder):
+    def download_file(self, url, output_dir):
+        """
+        Download a URL through the download cache; see utilities/downloader.py
+        :param url: the URL
+        :param output_dir: dir to download to
+        :return: path to the downloaded file
+        """
+        return downloader.download(url, output_dir, self.gfw_env)
 
-        if zipfile.is_zipfile(filename):
-            logging.debug('Unzipping {0} to directory {1}'.format(filename, folder))
-            zf = zipfile.ZipFile(filename, 'r')
-            zf.extractall(folder)
-            return zf.namelist()
-        else:
-            return []
+    def download_files(self, url_list, output_dir):
+        """
+        Download several URLs at once
+        :param url_list: list of URLs
+        :param output_dir: dir to download to
+        :return: list of paths to the downloaded files, in the same order as url_list
+        """
+        return downloader.download_all(url_list, output_dir, self.gfw_env)
 
     @staticmethod
     def remove_all_fields_except(fc, keep_field_list):
@@ -131,24 +119,26 @@ class DataSource(object):
             else:
                 arcpy.DeleteField_management(fc, field)
 
+        dataset_cache.invalidate(fc)
+
         return
 
     def unzip_and_find_data(self, in_zipfile):
         """
-        Unzip a zipfile and find a .shp or .tif file in the output
+        Extract the .shp and .tif files (and the files that go with them) from a zipfile, and find the one to use
         :param in_zipfile:
         :return:
         """
-        self.unzip(in_zipfile, self.download_workspace)
+        dataset_list = archive.extract_datasets(in_zipfile, self.download_workspace)
 
-        shp_list = [x for x in os.listdir(self.download_workspace) if os.path.splitext(x)[1] == '.shp']
-        tif_list = [x for x in os.listdir(self.download_workspace) if os.path.splitext(x)[1] == '.tif']
+        shp_list = [x for x in dataset_list if os.path.splitext(x)[1].lower() == '.shp']
+        tif_list = [x for x in dataset_list if os.path.splitext(x)[1].lower() == '.tif']
 
         if len(shp_list) == 1:
-            source_file = os.path.join(self.download_workspace, shp_list[0])
+            source_file = shp_list[0]
 
         elif len(tif_list) == 1:
-            source_file = os.path.join(self.download_workspace, tif_list[0])
+            source_file = tif_list[0]
 
         else:
             logging.error('Unknown output from zip file, {0} shps, {1} tifs.\nMay need to define a custom function to '
@@ -41,13 +41,7 @@ class GlobalForestChange(DataSource):
             updated_raster_url_list = self.find_updated_data(raster_url_list)
 
             if updated_raster_url_list:
-                output_list = []
-
-                for ras in updated_raster_url_list:
-                    out_file = self.download_file(ras, self.download_workspace)
-                    output_list.append(out_file)
-
-                self.layerdef['source'] = output_list
+                self.layerdef['source'] = self.download_files(updated_raster_url_list, self.download_workspace)
 
             else:
                 # Important for the script that reads the log file and sends an email
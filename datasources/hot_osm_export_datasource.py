@@ -6,6 +6,7 @@ import logging
 import arcpy
 
 import utilities.token_util
+from utilities import archive
 from utilities import field_map
 from datasource import DataSource
 
@@ -114,7 +115,7 @@ class HotOsmExportDataSource(DataSource):
 
     def download_results(self):
         """
-        Download the zip files for all complete jobs and unzip
+        Download the zip files for all complete jobs and extract their shapefiles
         :return: a list of shapefiles
         """
         shp_list = []
@@ -126,12 +127,7 @@ class HotOsmExportDataSource(DataSource):
 
                 out_job_dir = os.path.join(self.download_workspace, job_uid)
 
-                self.unzip(zip_file, out_job_dir)
-
-                arcpy.env.workspace = out_job_dir
-                shp_name = arcpy.ListFeatureClasses()[0]
-
-                shp_list.append(os.path.join(out_job_dir, shp_name))
+                shp_list.append(archive.extract_datasets(zip_file, out_job_dir, ['.shp'])[0])
 
         return shp_list
 
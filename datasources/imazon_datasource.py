@@ -6,12 +6,23 @@ import arcpy
 import datetime
 import shutil
 import calendar
+import itertools
 import logging
 
 import requests
 
 from datasource import DataSource
-from utilities import util
+from utilities import archive
+from utilities import dataset_cache
+from utilities import downloader
+from utilities import feature_sink
+from utilities import geometry_repair
+from utilities import parallel
+from utilities import settings
+
+# Fields of the imazon_sad output, as (name, type, length)
+SAD_FIELDS = [('orig_oid', 'TEXT', 255), ('Date', 'DATE', None), ('date_alias', 'DATE', None),
+              ('data_type', 'TEXT', 255), ('orig_fname', 'TEXT', 255), ('ha_eck_iv', 'DOUBLE', None)]
 
 
 class ImazonDataSource(DataSource):
@@ -93,32 +104,10 @@ class ImazonDataSource(DataSource):
 
         return to_download_list
 
-    def download_sad_zipfiles(self, to_download_list):
-        """
-        Download zip file and copy to the archive directory
-        :param to_download_list:
-        :return:
-        """
-        unzip_list = []
-        
-        for url in to_download_list:
-
-            z = self.download_file(url, self.download_workspace)
-            
-            output_zip_name = os.path.basename(z)
-            imazon_source_path = os.path.join(self.imazon_archive_folder, output_zip_name)
-
-            logging.debug('Copying archive to ' + self.imazon_archive_folder)
-            shutil.copy2(z, imazon_source_path)
-
-            unzip_list.append(z)
-
-        return unzip_list
-
-    def download_new_source_data(self):
+    def find_new_sad_urls(self):
         """
-        Find new data on SAD website, download and unzip
-        :return:
+        Find new data on SAD website
+        :return: a list of URLs to download
         """
         sad_urls = self.list_sad_urls()
 
@@ -131,24 +120,21 @@ class ImazonDataSource(DataSource):
             # Including this 'Checked' message will show that we checked the layer but it didn't need updating
             logging.critical('Checked | {0}'.format(self.name))
             sys.exit(0)
-            
-        else:
-            source_list = []
 
-            for download_file in self.download_sad_zipfiles(to_download):
-                outdir = os.path.dirname(download_file)
-                
-                self.unzip(download_file, outdir)
+        return to_download
 
-                # grab the basename, then strip everything before imazon_ (sometimes junk in front)
-                # also replace _ with -
-                base_name = os.path.splitext(os.path.basename(download_file))[0].replace('-', '_')
-                outfilename = base_name[base_name.index('imazon_'):] + '.shp'
-                outfilepath = os.path.join(outdir, outfilename)
-                
-                source_list.append(outfilepath)
+    @staticmethod
+    def find_source_shp(zip_path):
+        """
+        :param zip_path: a downloaded SAD zip file, already extracted
+        :return: the path of the shapefile it should contain, named after the zip file
+        """
+        # grab the basename, then strip everything before imazon_ (sometimes junk in front)
+        # also replace _ with -
+        base_name = os.path.splitext(os.path.basename(zip_path))[0].replace('-', '_')
+        outfilename = base_name[base_name.index('imazon_'):] + '.shp'
 
-        return source_list
+        return os.path.join(os.path.dirname(zip_path), outfilename)
 
     @staticmethod
     def data_type(shp_name):
@@ -180,70 +166,89 @@ class ImazonDataSource(DataSource):
         
         return imazon_date_text
 
-    def clean_source_shps(self, shp_list):
+    @staticmethod
+    def clean_source_shp(shp, data_type):
         """
-        After the data has been unzipped, repair geometry, remove fields, and add date and orig_fname
-        :param shp_list: list of cleaned shapefiles ready to be appended to final output
-        :return:
+        After the data has been unzipped, repair geometry, then copy it to a new shapefile with only the SAD_FIELDS:
+        the date, data_type, orig_fname, orig_oid and area, all calculated in the same cursor pass
+        :param shp: shapefile from a SAD zip file
+        :param data_type: degrad or defor
+        :return: the cleaned shapefile, ready to be merged into the final output
         """
-        cleaned_shp_list = []
+        shp_name = os.path.basename(shp).replace('-', '_')
 
-        for shp in shp_list:
-            
-            shp_name = os.path.basename(shp).replace('-', '_')
-            
-            single_part_path = os.path.join(os.path.dirname(shp), shp_name.replace('.shp', '') + '_singlepart.shp')
+        single_part_path = os.path.join(os.path.dirname(shp), shp_name.replace('.shp', '') + '_singlepart.shp')
+        clean_path = os.path.join(os.path.dirname(shp), shp_name.replace('.shp', '') + '_clean.shp')
 
-            # unclear why this extra garbage is added to the filename, but it is
-            if 'desmatamento' in shp and int(shp[shp.index('2018')+5:shp.index('2018')+7]) <= 7:
-                shp = os.path.splitext(shp)[0] + '_01102018.shp'
+        # unclear why this extra garbage is added to the filename, but it is
+        if 'desmatamento' in shp and int(shp[shp.index('2018')+5:shp.index('2018')+7]) <= 7:
+            shp = os.path.splitext(shp)[0] + '_01102018.shp'
 
-            # sometimes the zip files have dashes after the month, sometimes underscores
-            # who can ever know why
-            if not os.path.exists(shp):
-                idx_2018 = shp.index('2018') + 4
-                shp = shp[:idx_2018] + '-' + shp[idx_2018 + 1:]
+        # sometimes the zip files have dashes after the month, sometimes underscores
+        # who can ever know why
+        if not os.path.exists(shp):
+            idx_2018 = shp.index('2018') + 4
+            shp = shp[:idx_2018] + '-' + shp[idx_2018 + 1:]
 
-            logging.info('Starting multipart to singlepart for ' + shp_name)
-            arcpy.MultipartToSinglepart_management(shp, single_part_path)
+        logging.info('Starting multipart to singlepart for ' + shp_name)
+        arcpy.MultipartToSinglepart_management(shp, single_part_path)
 
-            arcpy.RepairGeometry_management(single_part_path, "DELETE_NULL")
+        # Already running in a worker process for this file; don't start more for the repair
+        geometry_repair.repair_esri(single_part_path, 1)
 
-            # Must have one field before we delete all the other ones. So says arcgis anyway
-            orig_oid_field = 'orig_oid'
-            util.add_field_and_calculate(single_part_path, orig_oid_field, 'Text', '255', '!FID!', self.gfw_env)
-            self.remove_all_fields_except(single_part_path, keep_field_list=[orig_oid_field])
+        imazon_date_str = ImazonDataSource.get_date_from_filename(os.path.basename(shp))
+        imazon_date = datetime.datetime.strptime(imazon_date_str, '%m/%d/%Y')
 
-            imazon_date_str = self.get_date_from_filename(os.path.basename(shp))
+        spatial_reference = arcpy.Describe(single_part_path).spatialReference
+        create_sad_fc(clean_path, spatial_reference)
 
-            util.add_field_and_calculate(single_part_path, 'Date', 'DATE', "", imazon_date_str, self.gfw_env)
-            util.add_field_and_calculate(single_part_path, 'date_alias', 'DATE', "", imazon_date_str,
-                                         self.gfw_env)
-            util.add_field_and_calculate(single_part_path, 'data_type', 'TEXT', "255", self.data_type(shp),
-                                         self.gfw_env)
-            util.add_field_and_calculate(single_part_path, 'orig_fname', 'TEXT', "255", shp_name, self.gfw_env)
+        # Source: http://gis.stackexchange.com/a/43514/30899
+        eckert_iv_sr = arcpy.SpatialReference(54012)
 
-            self.calculate_area_ha_eckert_iv(single_part_path)
+        field_names = [x[0] for x in SAD_FIELDS]
 
-            cleaned_shp_list.append(single_part_path)
+        with arcpy.da.SearchCursor(single_part_path, ['OID@', 'SHAPE@']) as search_cursor:
+            with arcpy.da.InsertCursor(clean_path, field_names + ['SHAPE@']) as insert_cursor:
+                for oid, geom in search_cursor:
+                    area_hectares = geom.projectAs(eckert_iv_sr).area / 10000.0 if geom else None
 
-        return cleaned_shp_list
+                    insert_cursor.insertRow([str(oid), imazon_date, imazon_date, data_type, shp_name, area_hectares,
+                                             geom])
 
-    @staticmethod
-    def calculate_area_ha_eckert_iv(fc):
+        return clean_path
 
-        arcpy.AddField_management(fc, 'ha_eck_iv', 'DOUBLE')
+    def merge_sad_files(self, url_list, output_dataset):
+        """
+        Download and clean each SAD file as its own task in a pool of worker processes, and stream the cleaned
+        features into the output as each file is done
+        :param url_list: SAD zip file URLs
+        :param output_dataset: the shapefile to create
+        """
+        tasks = [(url, self.download_workspace, self.imazon_archive_folder, self.data_type(os.path.basename(url)),
+                  self.gfw_env) for url in url_list]
 
-        # Source: http://gis.stackexchange.com/a/43514/30899
-        eckert_iv_sr = arcpy.SpatialReference(54012)
+        workers = min(get_workers(self.gfw_env), len(tasks))
+        logging.info('Downloading and cleaning {0} SAD files with {1} workers'.format(len(tasks), workers))
+
+        cleaned_shps = parallel.imap_bounded(download_and_clean_sad_file, tasks, workers)
 
-        with arcpy.da.UpdateCursor(fc, ['ha_eck_iv', 'shape@area'], None, eckert_iv_sr) as cursor:
-            for row in cursor:
-                area_m2 = row[1]
-                area_hectares = area_m2 / 10000.0
+        # Like Merge, the output takes the first file's spatial reference and the rest are projected to it
+        first_shp = next(cleaned_shps)
+        spatial_reference = arcpy.Describe(first_shp).spatialReference
 
-                row[0] = area_hectares
-                cursor.updateRow(row)
+        create_sad_fc(output_dataset, spatial_reference)
+
+        sink = feature_sink.ArcpyFeatureSink(output_dataset, None, fields=[x[0] for x in SAD_FIELDS])
+
+        with sink:
+            for cleaned_shp in itertools.chain([first_shp], cleaned_shps):
+                logging.debug('Merging {0}'.format(cleaned_shp))
+
+                source = feature_sink.ArcpyFeatureSource(cleaned_shp, fields=sink.fields,
+                                                         spatial_reference=spatial_reference)
+                feature_sink.stream_features(source, sink)
+
+        logging.debug('Merged {0} features into {1}'.format(sink.row_count, output_dataset))
 
     def get_layer(self):
         """
@@ -252,17 +257,60 @@ class ImazonDataSource(DataSource):
         that can be used in our layer.update() workflow
         :return: an updated layerdef pointing ot a local source
         """
-        source_list = self.download_new_source_data()
-        input_layers = self.clean_source_shps(source_list)
+        to_download = self.find_new_sad_urls()
 
-        logging.info('merging datasets: {0}'.format(', '.join(input_layers)))
         output_dataset = os.path.join(self.download_workspace, 'imazon_sad.shp')
         logging.debug('output dataset: {0}\n'.format(output_dataset))
 
-        arcpy.Merge_management(input_layers, output_dataset)
+        self.merge_sad_files(to_download, output_dataset)
 
         # overwrite properties from original layerdef read
         # from the gfw-sync2 config Google Doc
         self.layerdef['source'] = output_dataset
 
         return self.layerdef
+
+
+def get_workers(gfw_env):
+    """
+    :param gfw_env: the environment
+    :return: number of worker processes to download and clean SAD files with, from settings.ini
+    """
+    return int(settings.get_settings(gfw_env).get('imazon', {}).get('workers', 1))
+
+
+def create_sad_fc(path, spatial_reference):
+    """
+    Create an empty polygon shapefile with the SAD_FIELDS
+    :param path: the shapefile to create
+    :param spatial_reference: its spatial reference
+    """
+    arcpy.CreateFeatureclass_management(os.path.dirname(path), os.path.basename(path), 'POLYGON',
+                                        spatial_reference=spatial_reference)
+
+    for field_name, field_type, field_length in SAD_FIELDS:
+        arcpy.AddField_management(path, field_name, field_type, "", "", field_length)
+
+    # Shapefiles must have a field, so CreateFeatureclass adds Id; it isn't one of ours
+    arcpy.DeleteField_management(path, 'Id')
+
+    dataset_cache.invalidate(path)
+
+
+def download_and_clean_sad_file(task):
+    """
+    Download one SAD zip file, copy it to the archive directory and clean its shapefile. Runs in a worker process,
+    so it's a module level function that can be pickled
+    :param task: tuple of (url, download workspace, archive directory, data type, gfw_env)
+    :return: the cleaned shapefile
+    """
+    url, download_workspace, imazon_archive_folder, data_type, gfw_env = task
+
+    zip_path = downloader.download(url, download_workspace, gfw_env)
+
+    logging.debug('Copying archive to ' + imazon_archive_folder)
+    shutil.copy2(zip_path, os.path.join(imazon_archive_folder, os.path.basename(zip_path)))
+
+    archive.extract_datasets(zip_path, download_workspace, ['.shp'])
+
+    return ImazonDataSource.clean_source_shp(ImazonDataSource.find_source_shp(zip_path), data_type)
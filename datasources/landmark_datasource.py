@@ -9,8 +9,8 @@ from osgeo import ogr
 
 from datasource import DataSource
 from utilities import archive
-from utilities import util
 from utilities import cartodb
+from utilities import ogr_util
 
 class LandMarkDataSource(DataSource):
     """
@@ -79,12 +79,11 @@ class LandMarkDataSource(DataSource):
             output = os.path.join(output_path, out_name + '.shp')
             shps.append(output)
 
-            cmd = ['ogr2ogr', '-a_srs', 'EPSG:3857', output, outfile, 'OGRGeoJSON']
             try:
-                util.run_subprocess(cmd)
+                ogr_util.translate(output, outfile, ['-a_srs', 'EPSG:3857'], layer_name='OGRGeoJSON')
                 logging.debug("shp created for {}".format(out_name))
-            except TypeError:
-                logging.debug("TypeError caused ogr2ogr to fail on {}".format(out_name))
+            except (TypeError, RuntimeError):
+                logging.debug("Unable to convert {} to shp".format(out_name))
 
         return shps
 
@@ -111,7 +110,7 @@ class LandMarkDataSource(DataSource):
 
                 logging.debug("fields calculated for {}".format(shp))
                 source = None
-            except TypeError:
+            except (TypeError, RuntimeError):
                 logging.debug("{} NoneType".format(shp))
 
     @staticmethod
@@ -145,13 +144,10 @@ class LandMarkDataSource(DataSource):
         point_output = output_path + '\\' + 'landmark_point.shp'
         poly_output = output_path + '\\' + 'landmark_poly.shp'
 
-        cmd_point_create = ['ogr2ogr', '-f', 'ESRI Shapefile', point_output, shps_point[0]]
-        cmd_poly_create = ['ogr2ogr', '-f', 'ESRI Shapefile', poly_output, shps_poly[0]]
-
-        #run subprocess to create polygon and point shps
-        util.run_subprocess(cmd_poly_create)
+        #create polygon and point shps
+        ogr_util.translate(poly_output, shps_poly[0], ['-f', 'ESRI Shapefile'])
         logging.debug("poly file created")
-        util.run_subprocess(cmd_point_create)
+        ogr_util.translate(point_output, shps_point[0], ['-f', 'ESRI Shapefile'])
         logging.debug("point file created")
 
         shps_point_max = len(shps_point)
@@ -159,11 +155,11 @@ class LandMarkDataSource(DataSource):
 
         #append shps to poly and point files
         for x in range(1, shps_point_max):
-            util.run_subprocess(['ogr2ogr', '-f', 'ESRI Shapefile', '-append', '-update', point_output, shps_point[x]])
+            ogr_util.translate(point_output, shps_point[x], ['-f', 'ESRI Shapefile', '-append', '-update'])
             logging.debug("append %s" %(shps_point[x]))
 
         for x in range(1, shps_poly_max):
-            util.run_subprocess(['ogr2ogr', '-f', 'ESRI Shapefile', '-append', '-update', poly_output, shps_poly[x]])
+            ogr_util.translate(poly_output, shps_poly[x], ['-f', 'ESRI Shapefile', '-append', '-update'])
             logging.debug("append %s" %(shps_poly[x]))
 
         #zip merged files
@@ -1,8 +1,16 @@
 import argparse
+import logging
+import sys
+
+import arcpy
 
 import layer_decision_tree
+from utilities import dataset_cache
+from utilities import fingerprint
+from utilities import geometry_repair
 from utilities import google_sheet as gs
 from utilities import logger
+from utilities import ogr_util
 from utilities import settings
 
 
@@ -13,31 +21,101 @@ def main():
     parser.add_argument('--environment', '-e', default='staging', choices=('staging', 'prod'),
                         help='the environment/config files to use for this run')
     parser.add_argument('--layer', '-l', required=True,
-                        help='the data layer to process; must match a value for tech_title in the config')
+                        help='the data layer to process; must match a value for tech_title in the config. '
+                             'Pass a comma separated list to run several layers in this process, one after another')
     parser.add_argument('--verbose', '-v', default='debug', choices=('debug', 'info', 'warning', 'error'),
                         help='set verbosity level to print and write to file')
+    parser.add_argument('--config-snapshot', '-s',
+                        help='path to a config table snapshot (written by cronjob.py) to read instead of the live sheet')
+    parser.add_argument('--update-journal', '-j',
+                        help='append config table updates to this file for cronjob.py to write, instead of '
+                             'writing them to the sheet')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='update even if the source and config are unchanged since the last update')
+    parser.add_argument('--log-file', '-o',
+                        help='write the log here instead of the daily log file in the logs dir')
     args = parser.parse_args()
 
-    # Instantiate logger; write to {dir}\logs
-    logging = logger.build_logger(args.verbose)
+    # Instantiate logger; write to {dir}\logs unless a log file is specified
+    logger.build_logger(args.verbose, args.log_file)
     logging.info("\n{0}\n{1} v{2}\n{0}\n".format('*' * 50, settings.get_settings(args.environment)['tool_info']['name'],
                                                  settings.get_settings(args.environment)['tool_info']['version']))
-    logging.critical('Starting | {0}'.format(args.layer))
 
-    # Open the correct sheet of the config table (PROD | DEV) and get the layerdef
-    # Config table: https://docs.google.com/spreadsheets/d/1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI/edit#gid=0
-    layerdef = gs.get_layerdef(args.layer, args.environment)
+    # If we've been handed a snapshot of the config table, read from that instead of downloading the sheet again
+    if args.config_snapshot:
+        gs.use_snapshot(args.config_snapshot)
+
+    if args.update_journal:
+        gs.defer_updates(args.update_journal)
+
+    if args.force:
+        fingerprint.ignore_stored()
+
+    # Run each layer in turn; arcpy, the sheet client and tokens stay loaded between them
+    layer_list = [x.strip() for x in args.layer.split(',') if x.strip()]
+    failed_layers = [x for x in layer_list if run_layer(x, args.environment) != 0]
+
+    if len(layer_list) > 1:
+        logging.info('Ran {0} layers; {1} failed: {2}'.format(len(layer_list), len(failed_layers),
+                                                               ', '.join(failed_layers)))
+
+    if failed_layers:
+        sys.exit(1)
+
+
+def run_layer(layername, gfw_env):
+    """
+    Update one layer. Layers call sys.exit() when they're done early or hit an error, so catch that here
+    and keep going with the next layer
+    :param layername: the layer's tech_title in the config table
+    :param gfw_env: the environment
+    :return: exit code for this layer; 0 if it finished or had nothing to update
+    """
+    logging.critical('Starting | {0}'.format(layername))
+
+    try:
+        # Open the correct sheet of the config table (PROD | DEV) and get the layerdef
+        # Config table: https://docs.google.com/spreadsheets/d/1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI/edit#gid=0
+        layerdef = gs.get_layerdef(layername, gfw_env)
+
+        # Pass the layerdef to the build_layer function
+        layer = layer_decision_tree.build_layer(layerdef, gfw_env)
+
+        # Update the layer in the output data sources
+        layer.update()
+
+        # Remember what we just processed so the next run can skip it if it hasn't changed
+        layer.record_fingerprint()
+
+        # Update the last-updated timestamp in the config table
+        gs.update_gs_timestamp(layername, gfw_env)
+        gs.flush_updates()
+
+    except SystemExit as e:
+        # sys.exit(0) is used by layers that were checked and didn't need an update
+        exit_code = e.code or 0
+
+        if exit_code != 0:
+            logging.error('{0} exited with code {1}'.format(layername, exit_code))
+
+        return exit_code
 
-    # Pass the layerdef to the build_layer function
-    layer = layer_decision_tree.build_layer(layerdef, args.environment)
+    except Exception:
+        logging.exception('Unhandled error updating {0}'.format(layername))
+        return 1
 
-    # Update the layer in the output data sources
-    layer.update()
+    finally:
+        # Don't let the next layer see this one's environment settings, workspace locks or cached datasets
+        arcpy.ResetEnvironments()
+        arcpy.ClearWorkspaceCache_management()
+        dataset_cache.clear()
+        geometry_repair.clear()
+        ogr_util.clear()
+        gs.discard_updates()
 
-    # Update the last-updated timestamp in the config table
-    gs.update_gs_timestamp(args.layer, args.environment)
+    logging.critical('Finished | {0}'.format(layername))
 
-    logging.critical('Finished | {0}'.format(args.layer))
+    return 0
 
 if __name__ == "__main__":
     main()
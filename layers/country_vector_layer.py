@@ -9,6 +9,7 @@ from vector_layer import VectorLayer
 from utilities import google_sheet as gs
 from utilities import field_map
 from utilities import util
+from utilities import dataset_cache
 
 
 class CountryVectorLayer(VectorLayer):
@@ -150,6 +151,7 @@ class CountryVectorLayer(VectorLayer):
         # Delete the country field if we had to add it for this purpose
         if country_added:
             arcpy.DeleteField_management(country_src, 'country')
+            dataset_cache.invalidate(country_src)
 
     def update(self):
         """
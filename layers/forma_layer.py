@@ -20,6 +20,9 @@ class FormaLayer(VectorLayer):
 
     def update(self):
 
+        # Fail on a bad config value now, before anything is exported
+        self.validate()
+
         forma_asset = ee.ImageCollection(self.source)
 
         forma_img = self.create_image(forma_asset)
@@ -93,6 +93,9 @@ class GlobalForestChangeLayer(RasterLayer):
 
     def update(self):
 
+        # Fail on a bad config value now, before anything is archived or written to an output
+        self.validate()
+
         if self.gfw_env == 'prod':
             self.create_tiles()
 
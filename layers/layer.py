@@ -7,8 +7,11 @@ import arcpy
 from utilities import archive
 from utilities import cartodb, settings
 from utilities import util
+from utilities import dataset_cache
 from utilities import field_map
+from utilities import fingerprint
 from utilities import metadata
+from utilities import ogr_util
 from utilities import tile_cache_service
 
 
@@ -22,6 +25,15 @@ class Layer(object):
     def __init__(self, layerdef):
         logging.debug('Starting layer class')
 
+        # Raw config table values for properties that haven't been validated yet. Validation (and any side effects,
+        # like copying the source locally) happens the first time a property is read; see _validate()
+        self._unvalidated = {}
+
+        # Fingerprint of the source and config for this run; set by source_is_unchanged() and recorded in the
+        # fingerprint store by record_fingerprint() once the update has finished
+        self.layerdef = layerdef
+        self.fingerprint = None
+
         self._name = None
         self.name = layerdef['tech_title']
 
@@ -36,46 +48,53 @@ class Layer(object):
         self.layer_type = layerdef['type']
 
         self._field_map = None
-        self.field_map = layerdef['field_map']
+        self._defer('field_map', layerdef['field_map'])
 
         self._source = None
-        self.source = layerdef['source']
+        self._defer('source', layerdef['source'])
 
         self._esri_service_output = None
-        self.esri_service_output = layerdef['esri_service_output']
+        self._defer('esri_service_output', layerdef['esri_service_output'])
 
         self._cartodb_service_output = None
-        self.cartodb_service_output = layerdef['cartodb_service_output']
+        self._defer('cartodb_service_output', layerdef['cartodb_service_output'])
 
         self._merge_where_field = None
-        self.merge_where_field = layerdef['merge_where_field']
+        self._defer('merge_where_field', layerdef['merge_where_field'])
 
         self._delete_features_input_where_clause = None
-        self.delete_features_input_where_clause = layerdef['delete_features_input_where_clause']
+        self._defer('delete_features_input_where_clause', layerdef['delete_features_input_where_clause'])
 
         self._archive_output = None
-        self.archive_output = layerdef['archive_output']
+        self._defer('archive_output', layerdef['archive_output'])
 
         self._download_output = None
-        self.download_output = layerdef['download_output']
+        self._defer('download_output', layerdef['download_output'])
 
         self._transformation = None
-        self.transformation = layerdef['transformation']
+        self._defer('transformation', layerdef['transformation'])
 
         self._global_layer = None
         self.global_layer = layerdef['global_layer']
 
         self._add_country_value = None
-        self.add_country_value = layerdef['add_country_value']
+        self._defer('add_country_value', layerdef['add_country_value'])
 
         self._vector_to_raster_output = None
-        self.vector_to_raster_output = layerdef['vector_to_raster_output']
+        self._defer('vector_to_raster_output', layerdef['vector_to_raster_output'])
 
         self._tile_cache_service = None
-        self.tile_cache_service = layerdef['tile_cache_service']
+        self._defer('tile_cache_service', layerdef['tile_cache_service'])
 
         self._post_process_script = None
-        self.post_process_script = layerdef['post_process_script']
+        self._defer('post_process_script', layerdef['post_process_script'])
+
+        # Optional column; older copies of the config table don't have it
+        self._differential_update = None
+        self.differential_update = layerdef.get('differential_update')
+
+        self._zip_compression_level = None
+        self.zip_compression_level = layerdef.get('zip_compression_level')
 
     # Validate name
     @property
@@ -103,15 +122,17 @@ class Layer(object):
     # Validate esri_service_output
     @property
     def esri_service_output(self):
+        self._validate('esri_service_output')
         return self._esri_service_output
 
     @esri_service_output.setter
     def esri_service_output(self, e):
+        self._unvalidated.pop('esri_service_output', None)
 
         l = e.split(',')
 
         for output_path in l:
-            if output_path and not arcpy.Exists(output_path):
+            if output_path and not dataset_cache.exists(output_path):
                 logging.error("esri_service_output {0} does not exist".format(output_path))
                 sys.exit(1)
 
@@ -120,10 +141,12 @@ class Layer(object):
     # Validate cartodb_service_output
     @property
     def cartodb_service_output(self):
+        self._validate('cartodb_service_output')
         return self._cartodb_service_output
 
     @cartodb_service_output.setter
     def cartodb_service_output(self, c):
+        self._unvalidated.pop('cartodb_service_output', None)
         if not c:
             logging.debug("No cartodb output specified")
             c = None
@@ -140,6 +163,7 @@ class Layer(object):
     # Validate merge_where_field
     @property
     def merge_where_field(self):
+        self._validate('merge_where_field')
         return self._merge_where_field
 
     @merge_where_field.setter
@@ -151,6 +175,8 @@ class Layer(object):
         :param m: the merge feild
         :return:
         """
+        self._unvalidated.pop('merge_where_field', None)
+
         if m:
             if m not in util.list_fields(self.source, self.gfw_env):
                 logging.debug("Where clause field {0} specified for merge_where_field but "
@@ -175,6 +201,7 @@ class Layer(object):
     # Validate delete_features_input_where_clause
     @property
     def delete_features_input_where_clause(self):
+        self._validate('delete_features_input_where_clause')
         return self._delete_features_input_where_clause
 
     @delete_features_input_where_clause.setter
@@ -185,6 +212,8 @@ class Layer(object):
         :param f: the where clause
         :return:
         """
+        self._unvalidated.pop('delete_features_input_where_clause', None)
+
         if f:
             if "'" not in f and '"' not in f:
                 logging.debug("delete_features_input_where_clause {0} doesn't have quoted strings. "
@@ -218,6 +247,7 @@ class Layer(object):
     # Validate layer field_map
     @property
     def field_map(self):
+        self._validate('field_map')
         return self._field_map
 
     @field_map.setter
@@ -227,6 +257,7 @@ class Layer(object):
         :param m: D:\path\to\fieldmap.ini\{keyname}
         :return:
         """
+        self._unvalidated.pop('field_map', None)
 
         if m:
             # Insert this so that global_vector layers can pass validation checks
@@ -246,6 +277,7 @@ class Layer(object):
     # Validate source
     @property
     def source(self):
+        self._validate('source')
         return self._source
 
     @source.setter
@@ -255,16 +287,18 @@ class Layer(object):
         :param s:
         :return:
         """
+        self._unvalidated.pop('source', None)
+
         valid = True
 
         if type(s) is list:
             for path in s:
-                if not arcpy.Exists(path):
+                if not dataset_cache.exists(path):
                     valid = False
                     break
 
         else:
-            if not arcpy.Exists(s):
+            if not dataset_cache.exists(s):
                 valid = False
 
         if not valid:
@@ -293,13 +327,13 @@ class Layer(object):
             # we want to simply determine if this is local/not local so we can copy the datasource
             # first determine if our source dataset is within a featuredataset
 
-            desc = arcpy.Describe(source_dirname)
+            desc = dataset_cache.describe(source_dirname)
             if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
                 source_dirname = os.path.dirname(source_dirname)
 
             # Test if it's an SDE database
             try:
-                server_address = arcpy.Describe(source_dirname).connectionProperties.server
+                server_address = dataset_cache.describe(source_dirname).connectionProperties.server
 
                 # If source SDE is localhost, don't need to worry about copying anywhere
                 if server_address == 'localhost':
@@ -325,10 +359,12 @@ class Layer(object):
     # Validate transformation
     @property
     def transformation(self):
+        self._validate('transformation')
         return self._transformation
 
     @transformation.setter
     def transformation(self, t):
+        self._unvalidated.pop('transformation', None)
 
         if type(self.source) is list:
             s = self.source
@@ -342,11 +378,11 @@ class Layer(object):
             esri_output = [self.esri_service_output]
 
         for dataset in s:
-            from_desc = arcpy.Describe(dataset)
+            from_desc = dataset_cache.describe(dataset)
             from_srs = from_desc.spatialReference
 
             if esri_output[0]:
-                to_srs = arcpy.Describe(esri_output[0]).spatialReference
+                to_srs = dataset_cache.describe(esri_output[0]).spatialReference
 
                 if from_srs.GCS != to_srs.GCS:
                     if not t:
@@ -370,10 +406,12 @@ class Layer(object):
     # Validate archive folder
     @property
     def archive_output(self):
+        self._validate('archive_output')
         return self._archive_output
 
     @archive_output.setter
     def archive_output(self, a):
+        self._unvalidated.pop('archive_output', None)
         if a:
             archive_dir = os.path.dirname(a)
 
@@ -385,10 +423,12 @@ class Layer(object):
     # Validate download folder
     @property
     def download_output(self):
+        self._validate('download_output')
         return self._download_output
 
     @download_output.setter
     def download_output(self, d):
+        self._unvalidated.pop('download_output', None)
         if not d:
             logging.warning("No download_output specified")
             d = None
@@ -413,17 +453,60 @@ class Layer(object):
 
         self._global_layer = g
 
+    # Validate differential_update
+    @property
+    def differential_update(self):
+        return self._differential_update
+
+    @differential_update.setter
+    def differential_update(self, d):
+        if not d:
+            d = False
+
+        elif str(d).strip().lower() in ['true', 'yes', '1']:
+            d = True
+
+        elif str(d).strip().lower() in ['false', 'no', '0']:
+            d = False
+
+        else:
+            logging.error('Unknown value for differential_update: {0}. Expecting TRUE or FALSE'.format(d))
+            sys.exit(1)
+
+        self._differential_update = d
+
+    # Validate zip_compression_level
+    @property
+    def zip_compression_level(self):
+        return self._zip_compression_level
+
+    @zip_compression_level.setter
+    def zip_compression_level(self, z):
+        if z is None or str(z).strip() == '':
+            z = archive.DEFAULT_COMPRESS_LEVEL
+
+        elif str(z).strip() in [str(x) for x in range(10)]:
+            z = int(z)
+
+        else:
+            logging.error('Unknown value for zip_compression_level: {0}. Expecting 0 (store) to 9'.format(z))
+            sys.exit(1)
+
+        self._zip_compression_level = z
+
     # Validate vector_to_raster_output
     @property
     def vector_to_raster_output(self):
+        self._validate('vector_to_raster_output')
         return self._vector_to_raster_output
 
     @vector_to_raster_output.setter
     def vector_to_raster_output(self, r):
+        self._unvalidated.pop('vector_to_raster_output', None)
         if not r:
             r = None
 
-        elif not arcpy.Exists(r):
+        elif not dataset_cache.exists(r):
             logging.error("Could not find raster_output {0}. Exiting.".format(r))
             sys.exit(1)
 
@@ -432,10 +515,12 @@ class Layer(object):
     # Validate tile_cache_service
     @property
     def tile_cache_service(self):
+        self._validate('tile_cache_service')
         return self._tile_cache_service
 
     @tile_cache_service.setter
     def tile_cache_service(self, t):
+        self._unvalidated.pop('tile_cache_service', None)
         if not t:
             t = None
 
@@ -447,11 +532,11 @@ class Layer(object):
             local_server_path = t[0:arcgis_index] + 'arcgis on localhost ' + t[admin_index:]
 
             # Validate path on PROD server
-            if arcpy.Describe(t).dataType != 'MapServer':
+            if dataset_cache.describe(t).dataType != 'MapServer':
                 logging.error("Tile cache service path {0} does not appear to be a map service. Exiting.".format(t))
                 sys.exit(1)
 
-            elif arcpy.Describe(local_server_path).dataType != 'MapServer':
+            elif dataset_cache.describe(local_server_path).dataType != 'MapServer':
                 logging.error("Does not appear to be a corresponding map service on localhost. This is required"
                               "to prevent the PROD server from being overworked. Local server path checked: "
                               "{0}".format(local_server_path))
@@ -461,10 +546,12 @@ class Layer(object):
     # Validate post_process_script
     @property
     def post_process_script(self):
+        self._validate('post_process_script')
         return self._post_process_script
 
     @post_process_script.setter
     def post_process_script(self, p):
+        self._unvalidated.pop('post_process_script', None)
         if not p:
             p = None
 
@@ -484,6 +571,7 @@ class Layer(object):
     # Validate add_country_value
     @property
     def add_country_value(self):
+        self._validate('add_country_value')
         return self._add_country_value
 
     @add_country_value.setter
@@ -493,6 +581,8 @@ class Layer(object):
         :param c: ISO3 country code
         :return:
         """
+        self._unvalidated.pop('add_country_value', None)
+
         if not c:
             c = None
 
@@ -506,13 +596,69 @@ class Layer(object):
 
         self._add_country_value = c
 
+    def _defer(self, prop, value):
+        """
+        Store a raw value from the config table; the property setter will validate it the first time it's read
+        :param prop: the property name
+        :param value: the value from the layerdef
+        """
+        self._unvalidated[prop] = value
+
+    def _validate(self, prop):
+        """
+        Run the setter for a deferred property. The setter removes the raw value, so this only happens once
+        :param prop: the property name
+        """
+        if prop in self._unvalidated:
+            logging.debug('Validating {0} for {1}'.format(prop, self.name))
+            setattr(self, prop, self._unvalidated[prop])
+
+    def validate(self):
+        """
+        Validate all properties now rather than as they're needed. Every update() calls this once it knows the layer
+        needs updating, so a bad config value stops the run before anything is written
+        """
+        for prop in self._unvalidated.keys():
+            self._validate(prop)
+
+    def source_is_unchanged(self):
+        """
+        Fingerprint the source (and the layer's config) and compare it to the last successful update
+        :return: True if neither has changed, so the update can be skipped
+        """
+        source = self.layerdef['source']
+        scratch_root = os.path.normcase(settings.get_settings(self.gfw_env)['paths']['scratch_workspace'])
+
+        # Sources that a datasource just downloaded always have a new modified time; hash their contents instead
+        first_source = source[0] if type(source) is list and source else source
+        downloaded = bool(first_source) and os.path.normcase(os.path.abspath(first_source)).startswith(scratch_root)
+
+        source_fingerprint = fingerprint.source_fingerprint(source, hash_contents=downloaded)
+        self.fingerprint = fingerprint.layer_fingerprint(self.layerdef, source_fingerprint)
+
+        if not self.fingerprint:
+            logging.debug('Unable to fingerprint source for {0}; updating it'.format(self.name))
+            return False
+
+        return fingerprint.is_unchanged(self.name, self.gfw_env, self.fingerprint)
+
+    def record_fingerprint(self):
+        """
+        Called by gfw-sync.py after a successful update, so the next run can skip this layer if nothing's changed
+        """
+        if self.fingerprint:
+            fingerprint.store(self.name, self.gfw_env, self.fingerprint)
+
     def _archive(self, input_fc, download_output, archive_output, sr_is_local=False):
         logging.debug('Starting layer._archive')
-        archive.zip_file(input_fc, self.scratch_workspace, download_output, archive_output, sr_is_local)
+        archive.zip_file(input_fc, self.scratch_workspace, download_output, archive_output, sr_is_local, self.gfw_env,
+                         self.zip_compression_level)
 
         return
 
     def cleanup(self):
+        # Close anything we've read with OGR so the files can be deleted
+        ogr_util.clear()
         shutil.rmtree(self.scratch_workspace)
 
     def update_esri_metadata(self):
@@ -55,6 +55,9 @@ class RasterLayer(Layer):
     def update(self):
         logging.info('Starting raster_layer.update for {0}'.format(self.name))
 
+        # Fail on a bad config value now, before anything is archived or written to an output
+        self.validate()
+
         # Creates timestamped backup and download from source
         self.archive()
 
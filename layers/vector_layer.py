@@ -3,6 +3,7 @@ __author__ = 'Thomas.Maschler'
 import os
 import sys
 import time
+import hashlib
 import logging
 import arcpy
 import shutil
@@ -11,6 +12,16 @@ from layer import Layer
 from utilities import cartodb
 from utilities import util
 from utilities import arcgis_server
+from utilities import dataset_cache
+from utilities import feature_sink
+from utilities import geometry_repair
+from utilities import gfwid
+from utilities import settings
+from utilities import token_util
+
+# Max rows, and max bytes of geometry, to delete or append in one geoprocessing call
+ESRI_CHUNK_ROWS = 1000
+ESRI_CHUNK_BYTES = 64 * 1024 * 1024
 
 
 class VectorLayer(Layer):
@@ -90,7 +101,7 @@ class VectorLayer(Layer):
 
     def update_gfwid(self):
         """
-        For each row, take the hash of the well known text representation of the geometry
+        For each row, take the hash of the well known binary representation of the geometry
          This will be used in the API to cache analysis results for geometries previously analyzed
         :return:
         """
@@ -98,20 +109,20 @@ class VectorLayer(Layer):
 
         if "gfwid" not in util.list_fields(self.source, self.gfw_env):
             arcpy.AddField_management(self.source, "gfwid", "TEXT", field_length=50, field_alias="GFW ID")
+            dataset_cache.invalidate(self.source)
 
-        # Required to prevent calcuate field failures-- will likely fail to hash the !Shape! object if there are
-        # null geometries
+        # Repair invalid geometries and delete null ones before hashing; the gfwid is the hash of the repaired shape
         logging.debug('Starting repair geometry')
-        arcpy.RepairGeometry_management(self.source, "DELETE_NULL")
+        geometry_repair.repair_esri(self.source, geometry_repair.get_workers(self.gfw_env))
+
+        gfwid_settings = settings.get_settings(self.gfw_env).get('gfwid', {})
+        workers = int(gfwid_settings.get('workers', 1))
+        batch_size = int(gfwid_settings.get('batch_size', gfwid.DEFAULT_BATCH_SIZE))
 
         logging.debug('Starting to calculate gfwid')
-        arcpy.CalculateField_management(self.source, "gfwid", "md5(!Shape!.WKT)", "PYTHON_9.3",
-                                        code_block="import hashlib\n"
-                                                   "def md5(shape):\n"
-                                                   "   hash = hashlib.md5()\n"
-                                                   "   hash.update(shape)\n"
-                                                   "   return hash.hexdigest()"
-                                        )
+        row_count = gfwid.calculate_gfwids(self.source, workers, batch_size)
+
+        logging.debug('Calculated gfwid for {0} rows'.format(row_count))
 
     def add_country_code(self):
         """
@@ -155,12 +166,10 @@ class VectorLayer(Layer):
         version_name = self.name + "_" + str(int(time.time()))
 
         sde_workspace = os.path.dirname(esri_output_fc)
-        desc = arcpy.Describe(sde_workspace)
+        desc = dataset_cache.describe(sde_workspace)
         if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
             sde_workspace = os.path.dirname(sde_workspace)
 
-        del desc
-
         if os.path.splitext(sde_workspace)[1] != '.sde':
             logging.error('Could not find proper SDE workspace. Exiting.')
             sys.exit(1)
@@ -168,7 +177,13 @@ class VectorLayer(Layer):
         arcpy.CreateVersion_management(sde_workspace, "sde.DEFAULT", version_name, "PRIVATE")
         arcpy.ChangeVersion_management("esri_service_output_fl", 'TRANSACTIONAL', 'gfw.' + version_name, '')
 
-        if input_where_clause:
+        # Input OIDs to append; None to append everything
+        append_oid_list = None
+
+        if self.differential_update and 'gfwid' in util.list_fields(esri_output_fc, self.gfw_env):
+            append_oid_list = self.delete_changed_features(fc_to_append, "esri_service_output_fl", input_where_clause)
+
+        elif input_where_clause:
             logging.debug('Deleting features from esri_service_output feature layer based on input_where_clause. '
                           'SQL statement: {0}'.format(input_where_clause))
 
@@ -181,67 +196,63 @@ class VectorLayer(Layer):
             logging.debug('No where clause for esri_service_output found; deleting all features before '
                           'appending from source')
 
-            sde_sql_conn = arcpy.ArcSDESQLExecute(sde_workspace)
-            esri_fc_name = os.path.basename(esri_output_fc)
-            print esri_fc_name
-
-            # why this, exactly?
-            # there's also a lbr_plantations_old feature class (for some reason)
-            # and lbr_plantation_evw points to that.
-            # I don't know why and I don't have time to fix it
-
-            # WDPA test - leave off
-            if esri_fc_name != 'gfw_countries.gfw.lbr_plantations':
-                esri_fc_name += '_evw'
-
-            # Find the min and max OID values
+            # Read the OIDs that actually exist in this version, so gaps left by earlier delete/appends
+            # don't turn into empty delete windows
             to_delete_oid_field = [f.name for f in arcpy.ListFields(esri_output_fc) if f.type == 'OID'][0]
+            to_delete_oid_list = util.get_oids("esri_service_output_fl")
 
-            sql = 'SELECT min({0}), max({0}) from {1}'.format(to_delete_oid_field, esri_fc_name)
-            to_delete_min_oid, to_delete_max_oid = sde_sql_conn.execute(sql)[0]
+            for wc in util.generate_chunk_where_clause(to_delete_oid_list, to_delete_oid_field, ESRI_CHUNK_ROWS):
 
-            # If there are features to delete, do it
-            if to_delete_min_oid and to_delete_max_oid:
+                logging.debug('Deleting features with {0}'.format(wc))
+                arcpy.MakeFeatureLayer_management("esri_service_output_fl", "fl_to_delete", wc)
 
-                for wc in util.generate_where_clause(to_delete_min_oid, to_delete_max_oid, to_delete_oid_field, 1000):
+                arcpy.DeleteRows_management("fl_to_delete")
+                arcpy.Delete_management("fl_to_delete")
 
-                    logging.debug('Deleting features with {0}'.format(wc))
-                    arcpy.MakeFeatureLayer_management("esri_service_output_fl", "fl_to_delete", wc)
+        esri_output_pre_append_count = int(arcpy.GetCount_management("esri_service_output_fl").getOutput(0))
 
-                    arcpy.DeleteRows_management("fl_to_delete")
-                    arcpy.Delete_management("fl_to_delete")
+        if append_oid_list is not None:
+            input_feature_count = len(append_oid_list)
+        else:
+            input_feature_count = int(arcpy.GetCount_management(fc_to_append).getOutput(0))
 
-            else:
-                pass
+        logging.debug('Starting to append to esri_service_output')
 
-        esri_output_pre_append_count = int(arcpy.GetCount_management("esri_service_output_fl").getOutput(0))
-        input_feature_count = int(arcpy.GetCount_management(fc_to_append).getOutput(0))
+        append_engine = self.get_append_engine()
 
-        logging.debug('Starting to append to esri_service_output')
+        if append_oid_list is not None:
+            to_append_oid_field = [f.name for f in arcpy.ListFields(fc_to_append) if f.type == 'OID'][0]
+            wc_list = util.generate_oid_list_where_clause(append_oid_list, to_append_oid_field, ESRI_CHUNK_ROWS)
 
         # don't need to batch append if it's coming from an SDE data source
         # these are used exclusively by country-vector layers
         # and the data is generally small, compared to things like WDPA
-        if 'sde' in fc_to_append:
-            logging.debug("Appending all features from {}- no wc because it's an SDE input".format(fc_to_append))
-
-            arcpy.MakeFeatureLayer_management(fc_to_append, "fl_to_append")
-            arcpy.Append_management("fl_to_append", "esri_service_output_fl", "NO_TEST")
-
-            arcpy.Delete_management("fl_to_append")
+        # The cursor engine doesn't need batches either; it streams everything in one edit session
+        elif 'sde' in fc_to_append or append_engine == 'cursor':
+            logging.debug("Appending all features from {0} in one pass".format(fc_to_append))
+            wc_list = [None]
 
         else:
-            # Find the min and max OID values
+            # Plan append windows from the OIDs and geometry sizes that actually exist in the source
             to_append_oid_field = [f.name for f in arcpy.ListFields(fc_to_append) if f.type == 'OID'][0]
-            to_append_min_oid, to_append_max_oid = cartodb.ogrinfo_min_max(fc_to_append, to_append_oid_field)
+            to_append_oid_list, to_append_sizes = util.get_oids_and_sizes(fc_to_append)
 
-            for wc in util.generate_where_clause(to_append_min_oid, to_append_max_oid, to_append_oid_field, 1000):
+            wc_list = util.generate_chunk_where_clause(to_append_oid_list, to_append_oid_field, ESRI_CHUNK_ROWS,
+                                                       to_append_sizes, ESRI_CHUNK_BYTES)
 
-                logging.debug('Appending features with {0}'.format(wc))
-                arcpy.MakeFeatureLayer_management(fc_to_append, "fl_to_append", wc)
+        if append_engine == 'cursor':
+            # The edit session has to be on the edit version as well as the insert cursor, so both go through a
+            # connection to the version rather than the sde.DEFAULT connection
+            version_workspace = self.create_version_connection(sde_workspace, 'gfw.' + version_name)
+            version_fc = os.path.join(version_workspace, os.path.relpath(esri_output_fc, sde_workspace))
 
-                arcpy.Append_management("fl_to_append", "esri_service_output_fl", "NO_TEST")
-                arcpy.Delete_management("fl_to_append")
+            self.append_features(fc_to_append, version_fc, version_workspace, wc_list, append_engine)
+
+            arcpy.ClearWorkspaceCache_management(version_workspace)
+            os.remove(version_workspace)
+
+        else:
+            self.append_features(fc_to_append, "esri_service_output_fl", sde_workspace, wc_list, append_engine)
 
         logging.debug('Append finished, starting to reconcile versions')
 
@@ -257,6 +268,9 @@ class VectorLayer(Layer):
         arcpy.Delete_management("esri_service_output_fl")
         arcpy.DeleteVersion_management(sde_workspace, 'gfw.' + version_name)
 
+        # Extent etc of the output have changed
+        dataset_cache.invalidate(esri_output_fc)
+
         post_append_count = int(arcpy.GetCount_management(esri_output_fc).getOutput(0))
 
         if esri_output_pre_append_count + input_feature_count == post_append_count:
@@ -274,11 +288,182 @@ class VectorLayer(Layer):
 
         return
 
+    def create_version_connection(self, sde_workspace, version):
+        """
+        Create a connection file like sde_workspace's, but to another version
+        :param sde_workspace: path to an .sde connection file
+        :param version: the version to connect to, i.e. gfw.{version_name}
+        :return: path to the new .sde file, in the scratch workspace
+        """
+        props = arcpy.Describe(sde_workspace).connectionProperties
+
+        # Direct connections have instances like sde:sqlserver:localhost
+        instance_parts = props.instance.split(':')
+        platforms = {'sqlserver': 'SQL_SERVER', 'postgresql': 'POSTGRESQL', 'oracle': 'ORACLE'}
+
+        if len(instance_parts) != 3 or instance_parts[1].lower() not in platforms:
+            logging.error('Unable to connect to version {0}: unknown instance {1} in {2}. '
+                          'Exiting.'.format(version, props.instance, sde_workspace))
+            sys.exit(1)
+
+        username, password = None, None
+
+        if props.authentication_mode == 'DBMS':
+            password_token = settings.get_settings(self.gfw_env).get('append', {}).get('sde_password_token')
+
+            if not password_token:
+                logging.error('{0} uses database authentication; set sde_password_token in the append section of '
+                              'settings.ini to connect to version {1}. Exiting.'.format(sde_workspace, version))
+                sys.exit(1)
+
+            username = props.user
+            password = token_util.get_token(password_token)
+
+        out_dir = os.path.join(settings.get_settings(self.gfw_env)['paths']['scratch_workspace'], 'connections')
+        util.mkdir_p(out_dir)
+
+        out_name = version.replace('.', '_') + '.sde'
+
+        if os.path.exists(os.path.join(out_dir, out_name)):
+            os.remove(os.path.join(out_dir, out_name))
+
+        auth = 'DATABASE_AUTH' if props.authentication_mode == 'DBMS' else 'OPERATING_SYSTEM_AUTH'
+
+        arcpy.CreateDatabaseConnection_management(out_dir, out_name, platforms[instance_parts[1].lower()],
+                                                  instance_parts[2], auth, username, password, 'SAVE_USERNAME',
+                                                  props.database, '', 'TRANSACTIONAL', version)
+
+        return os.path.join(out_dir, out_name)
+
+    def get_append_engine(self):
+        """
+        :return: the append engine set in settings.ini: 'geoprocessing' (the Append tool) or 'cursor'
+        """
+        append_settings = settings.get_settings(self.gfw_env).get('append', {})
+
+        return append_settings.get('engine', 'geoprocessing')
+
+    def append_features(self, fc_to_append, output_fl, sde_workspace, wc_list, append_engine):
+        """
+        Append features from the source to the versioned output, one where clause at a time
+        :param fc_to_append: the source data, already projected to the output SRS
+        :param output_fl: feature layer of the esri output, already switched to the edit version. For the cursor
+        engine, the output through a connection to the edit version
+        :param sde_workspace: the SDE workspace of output_fl; the cursor engine's edit session is started on it
+        :param wc_list: where clauses that select the features to append; [None] to append everything
+        :param append_engine: 'geoprocessing' to run the Append tool for each where clause, or 'cursor' to stream
+        features into an insert cursor in a single edit session
+        """
+        if append_engine == 'cursor':
+            append_settings = settings.get_settings(self.gfw_env).get('append', {})
+            commit_interval = int(append_settings.get('commit_interval', feature_sink.DEFAULT_COMMIT_INTERVAL))
+
+            source = feature_sink.ArcpyFeatureSource(fc_to_append)
+            sink = feature_sink.ArcpyFeatureSink(output_fl, sde_workspace, commit_interval=commit_interval)
+
+            feature_sink.match_fields(source, sink)
+
+            with sink:
+                for wc in wc_list:
+                    logging.debug('Streaming features with {0}'.format(wc))
+
+                    source.where_clause = wc
+                    feature_sink.stream_features(source, sink)
+
+            logging.debug('Streamed {0} features to {1}'.format(sink.row_count, output_fl))
+
+        elif append_engine == 'geoprocessing':
+            for wc in wc_list:
+
+                logging.debug('Appending features with {0}'.format(wc))
+                arcpy.MakeFeatureLayer_management(fc_to_append, "fl_to_append", wc)
+
+                arcpy.Append_management("fl_to_append", output_fl, "NO_TEST")
+                arcpy.Delete_management("fl_to_append")
+
+        else:
+            logging.error('Unknown append engine {0} in settings.ini. Exiting.'.format(append_engine))
+            sys.exit(1)
+
+    def delete_changed_features(self, input_fc, output_fl, where_clause):
+        """
+        Compare the input to the output by gfwid and a hash of the attributes they share. Delete output features that
+        are no longer in the input or have changed, and return the input features that need to be appended
+        :param input_fc: the input source data, with gfwid already calculated
+        :param output_fl: feature layer of the esri output, already switched to the edit version
+        :param where_clause: limits the comparison to these output features (i.e. from merge_where_field)
+        :return: list of input OIDs to append
+        """
+        logging.info('Starting vector_layer.delete_changed_features for {0}'.format(self.name))
+
+        # Geometry is covered by gfwid; skip fields the output calculates itself
+        skip_fields = ['gfwid', 'shape_length', 'shape_area', 'shape.starea()', 'shape.stlength()', 'globalid',
+                       'created_user', 'created_date', 'last_edited_user', 'last_edited_date']
+
+        output_fields = dict((f.name.lower(), f.name) for f in arcpy.ListFields(output_fl)
+                             if f.type not in ['OID', 'Geometry', 'GlobalID', 'Raster', 'Blob'])
+
+        input_fields = [f.name for f in arcpy.ListFields(input_fc) if f.name.lower() in output_fields and
+                        f.name.lower() not in skip_fields]
+
+        compare_fields = sorted(input_fields, key=lambda x: x.lower())
+        logging.debug('Comparing features by gfwid and fields {0}'.format(', '.join(compare_fields)))
+
+        input_rows = self._rows_by_feature_hash(input_fc, compare_fields)
+        output_rows = self._rows_by_feature_hash(output_fl, [output_fields[x.lower()] for x in compare_fields],
+                                                 where_clause)
+
+        # Same comparison as the cartoDB delta sync (carto_delta.plan_delta)
+        to_delete, to_append = util.diff_rows_by_key(output_rows, input_rows)
+
+        delete_oid_list = [oid for oid_list in to_delete.itervalues() for oid in oid_list]
+        append_oid_list = [oid for oid_list in to_append.itervalues() for oid in oid_list]
+
+        input_count = sum([len(x) for x in input_rows.itervalues()])
+        logging.info('{0} features unchanged, {1} to delete, {2} to append'.format(input_count - len(append_oid_list),
+                                                                                   len(delete_oid_list),
+                                                                                   len(append_oid_list)))
+
+        output_oid_field = [f.name for f in arcpy.ListFields(output_fl) if f.type == 'OID'][0]
+
+        for wc in util.generate_oid_list_where_clause(delete_oid_list, output_oid_field, ESRI_CHUNK_ROWS):
+
+            logging.debug('Deleting {0} vanished or changed features'.format(wc.count(',') + 1))
+            arcpy.MakeFeatureLayer_management(output_fl, "fl_to_delete", wc)
+
+            arcpy.DeleteRows_management("fl_to_delete")
+            arcpy.Delete_management("fl_to_delete")
+
+        return append_oid_list
+
+    @staticmethod
+    def _rows_by_feature_hash(in_fc, field_list, where_clause=None):
+        """
+        Group a dataset's OIDs by gfwid + a hash of the field_list values
+        :param in_fc: input FC or feature layer
+        :param field_list: fields to hash, in the same order for both datasets being compared
+        :param where_clause: optional where clause to select rows
+        :return: dict of {feature hash: [OIDs]}
+        """
+        rows = {}
+
+        with arcpy.da.SearchCursor(in_fc, ['OID@', 'gfwid'] + field_list, where_clause) as cursor:
+            for row in cursor:
+                attribute_hash = hashlib.md5()
+
+                for value in row[2:]:
+                    attribute_hash.update(util.normalize_value(value))
+                    attribute_hash.update('|')
+
+                rows.setdefault((row[1], attribute_hash.hexdigest()), []).append(row[0])
+
+        return rows
+
     def project_to_output_srs(self, input_fc, esri_output_fc):
 
         # Check if source SR matches esri_service_output SR
-        from_srs = arcpy.Describe(input_fc).spatialReference
-        to_srs = arcpy.Describe(esri_output_fc).spatialReference
+        from_srs = dataset_cache.describe(input_fc).spatialReference
+        to_srs = dataset_cache.describe(esri_output_fc).spatialReference
 
         if to_srs.exportToString() != from_srs.exportToString():
 
@@ -408,7 +593,8 @@ class VectorLayer(Layer):
             logging.info('Starting vector_layer.sync_cartodb for {0}. Output {1}, '
                          'wc {2}'.format(os.path.basename(input_fc), cartodb_output_fc, where_clause))
 
-            cartodb.cartodb_sync(input_fc, cartodb_output_fc, where_clause, self.gfw_env, self.scratch_workspace)
+            cartodb.cartodb_sync(input_fc, cartodb_output_fc, where_clause, self.gfw_env, self.scratch_workspace,
+                                 self.differential_update)
         else:
             logging.debug('No cartodb output fc specified. Moving on.')
 
@@ -425,6 +611,16 @@ class VectorLayer(Layer):
         Contains all relevant update functions for a vector layer
         :return:
         """
+        if self.source_is_unchanged():
+            # Important for the script that reads the log file and sends an email
+            # Including this 'Checked' message will show that we checked the layer but it didn't need updating
+            logging.info('Source and config for {0} unchanged since the last update'.format(self.name))
+            logging.critical('Checked | {0}'.format(self.name))
+            sys.exit(0)
+
+        # Fail on a bad config value now, before anything is archived or written to an output
+        self.validate()
+
         self.archive_source()
 
         self.filter_source_dataset(self.delete_features_input_where_clause)
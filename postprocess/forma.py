@@ -3,7 +3,7 @@ import logging
 import datetime
 import os
 
-from utilities import update_elastic, settings
+from utilities import update_elastic, settings, s3_transfer
 
 def post_process(layerdef):
     """
@@ -27,8 +27,7 @@ def post_process(layerdef):
 
     #Copy GEE output to S3
     temp_file = download_workspace + '\\' + os.path.basename(gee_path)
-    cmd = ['aws', 's3', 'cp', temp_file, 's3://gfw2-data/alerts-tsv/forma.csv']
-    subprocess.check_call(cmd)
+    s3_transfer.upload_file(temp_file, 's3://gfw2-data/alerts-tsv/forma.csv', layerdef.gfw_env)
     logging.debug('File copied to S3')
 
     #Charlie to trigger country page analyses
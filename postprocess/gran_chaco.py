@@ -1,5 +1,4 @@
 import logging
-import requests
 
 from utilities import cartodb
 
@@ -21,13 +20,9 @@ def update_layerspec(layerdef):
     sql = "UPDATE layerspec set maxdate = (SELECT max(date) + INTERVAL '1 day' " \
           "FROM gran_chaco_deforestation) WHERE table_name='gran_chaco_deforestation'"
 
-    key, api_url = cartodb.get_api_key_and_url(layerdef.gfw_env)
-    payload = {'api_key': key, 'q': sql}
+    try:
+        resp = cartodb.cartodb_sql(sql, layerdef.gfw_env)
+    except SyntaxError as e:
+        raise ValueError('Error in carto response: {0}'.format(e))
 
-    r = requests.get(api_url, params=payload)
-
-    resp = r.json()
     logging.debug(resp)
-
-    if 'error' in resp.keys():
-        raise ValueError('Error in carto response')
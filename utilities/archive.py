@@ -3,14 +3,53 @@ __author__ = 'Thomas.Maschler'
 import zipfile
 import os
 import sys
-import glob
 import arcpy
 import shutil
 import time
 import datetime
 import util
 import logging
-import subprocess
+import json
+import struct
+import zlib
+import argparse
+
+import export_estimate
+import fingerprint
+import parallel
+import s3_transfer
+import settings
+
+# Signatures of the records in a zip file
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_DIRECTORY_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+
+# Files that can make up a shapefile, in the order they're zipped
+SHP_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg', '.sbn', '.sbx', '.fbn', '.fbx', '.ain', '.aih', '.atx',
+                  '.ixs', '.mxs', '.qix', '.shp.xml']
+
+# Files that can make up a GeoTIFF
+TIF_EXTENSIONS = ['.tif', '.tfw', '.ovr', '.tif.ovr', '.aux.xml', '.tif.aux.xml']
+
+# Datasets extract_datasets can find in a zip file, and the files that make up each
+DATASET_EXTENSIONS = {'.shp': SHP_EXTENSIONS, '.tif': TIF_EXTENSIONS}
+
+# Bytes read from a zip file being extracted at a time
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+
+# Formats that are already compressed; deflating them again costs time and saves nothing
+STORED_EXTENSIONS = ['.zip', '.gz', '.7z', '.jpg', '.jpeg', '.png', '.jp2', '.sid', '.ecw', '.kmz']
+
+# Files whose first block deflates to more than this fraction of its size are stored instead
+STORE_RATIO = 0.95
+
+# Bytes of a file compressed at once by each thread
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_WORKERS = 4
 
 
 def unzip(source_filename, dest_dir):
@@ -24,77 +63,766 @@ def unzip(source_filename, dest_dir):
         zf.extractall(dest_dir)
 
 
-def add_to_zip(fname, zf):
+def _dataset_member(name, extensions):
     """
-    Will grab all files matching fname except those with .lock and .zip in a dir
-    :param fname: fname to match
-    :param zf: zipfile object we've alrady created
-    :return:
+    :param name: name of a member of a zip file
+    :param extensions: extensions of the datasets to look for, i.e. ['.shp', '.tif']
+    :return: tuple of (the dataset's main file in lower case, True if this is it), i.e. ('roads.shp', False) for
+    Roads.dbf, or None if the member isn't part of a dataset
     """
-    bname = os.path.basename(fname)
-    ending = os.path.splitext(bname)[1]
-    if not ending == ".lock" and not ending == ".zip":
-        zf.write(fname, bname)
+    if name.endswith('/') or name.startswith('__MACOSX/'):
+        return None
+
+    # Longest first, so roads.tif.aux.xml is part of roads.tif, not roads.tif.tif
+    suffixes = sorted([(x, ext) for ext in extensions for x in DATASET_EXTENSIONS[ext]], key=lambda x: -len(x[0]))
 
-    return
+    for suffix, ext in suffixes:
+        if name.lower().endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)].lower() + ext, suffix == ext
 
+    return None
 
-def zip_shp(input_shp):
+
+def _member_path(output_dir, name):
     """
-    :param input_shp: path to a shapefile
-    :return: zipped shapefile
+    :return: where a member of a zip file goes in output_dir, without any drive, absolute path or .. in its name
+    (the same way ZipFile.extract does it)
     """
-    basepath, fname, base_fname = util.gen_paths_shp(input_shp)
-    zip_path = os.path.join(basepath, base_fname + '.zip')
+    parts = name.replace('\\', '/').split('/')
+    parts = [x for x in parts if x not in ('', os.path.curdir, os.path.pardir)]
+
+    if parts:
+        parts[0] = os.path.splitdrive(parts[0])[1] or parts[0]
+
+    return os.path.join(output_dir, *parts)
+
+
+def extract_datasets(source, output_dir, extensions=('.shp', '.tif'), follow=False):
+    """
+    Extract only the datasets in a zip file (and the files that go with them, i.e. .dbf and .prj), leaving everything
+    else in it. The zip's central directory is read first to find them. If the zip is incomplete, i.e. still being
+    downloaded, it's read from start to finish instead, extracting the dataset files as it comes to them
+    :param source: path to a zip file, or a file-like object to read one from, i.e. an HTTP response
+    :param output_dir: dir to extract to
+    :param extensions: extensions of the datasets to extract
+    :param follow: if the zip file is still being written to, keep reading as more is written
+    :return: sorted list of the extracted datasets' paths
+    """
+    if isinstance(source, basestring) and not follow and zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            names = zf.namelist()
+            members = {x: _dataset_member(x, extensions) for x in names if _dataset_member(x, extensions)}
+
+            # Leave out sidecar files without their dataset, i.e. a standalone .dbf table
+            datasets = set([dataset for dataset, is_main in members.values() if is_main])
+            extract_list = [x for x in names if x in members and members[x][0] in datasets]
+
+            dataset_paths = []
+
+            for name in extract_list:
+                path = zf.extract(name, output_dir)
+
+                if members[name][1]:
+                    dataset_paths.append(path)
+
+        logging.debug('Extracted {0} of {1} files in {2}'.format(len(extract_list), len(names), source))
+
+    else:
+        if isinstance(source, basestring):
+            file_obj = FollowFile(source) if follow else open(source, 'rb')
+        else:
+            file_obj = source
+
+        try:
+            extract_list = [name for name in _stream_extract(file_obj, output_dir, extensions)]
+        finally:
+            if file_obj is not source:
+                file_obj.close()
+
+        members = {x: _dataset_member(x, extensions) for x in extract_list}
+        datasets = set([dataset for dataset, is_main in members.values() if is_main])
+
+        # Sidecar files can't be told apart from files without a dataset until the whole zip has been read
+        for name in extract_list:
+            if members[name][0] not in datasets:
+                os.remove(_member_path(output_dir, name))
+
+        dataset_paths = [_member_path(output_dir, x) for x in extract_list if members[x][1]]
+
+        logging.debug('Extracted {0} files from the zip stream'.format(len([x for x in extract_list
+                                                                             if members[x][0] in datasets])))
 
-    zf = zipfile.ZipFile(zip_path, 'w', allowZip64=False)
+    return sorted(dataset_paths)
 
-    search = os.path.join(basepath, "*.*")
-    files = glob.glob(search)
 
-    for f in files:
-        bname = os.path.basename(f)
-        if (base_fname in bname) and (bname != base_fname + ".zip"):
-            add_to_zip(f, zf)
+class FollowFile(object):
+    """
+    Reads a file that's still being written to from start to end, i.e. a download in progress, waiting for more when
+    it gets to the end. Gives up once nothing's been written for timeout seconds, and reads as the end of the file
+    :param path: the file; it doesn't have to exist yet
+    :param timeout: seconds to wait for more data
+    :param interval: seconds between checks for more data
+    """
+    def __init__(self, path, timeout=60, interval=0.5):
+        self.path = path
+        self.timeout = timeout
+        self.interval = interval
+
+        self._file = None
+
+    def read(self, size):
+        waited = 0
+
+        while True:
+            if not self._file and os.path.exists(self.path):
+                self._file = open(self.path, 'rb')
+
+            if self._file:
+                # Seeking to where we are clears the end of file, so what's been written since can be read
+                self._file.seek(self._file.tell())
+                data = self._file.read(size)
+
+                if data:
+                    return data
+
+            if waited >= self.timeout:
+                return ''
+
+            time.sleep(self.interval)
+            waited += self.interval
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class _StreamReader(object):
+    """
+    Reads exact numbers of bytes from a file-like object, and lets what's read too far be put back
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self._pending = ''
+
+    def read_some(self, size):
+        """
+        :return: up to size bytes, or '' at the end of the file
+        """
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            return data
+
+        return self.file_obj.read(size)
+
+    def read(self, size):
+        data = []
+        left = size
+
+        while left:
+            chunk = self.read_some(min(left, EXTRACT_BUFFER_SIZE))
 
-    zip_result = zip_path
+            if not chunk:
+                raise zipfile.BadZipfile('Zip file ended {0} bytes early'.format(left))
 
-    zf.close()
+            data.append(chunk)
+            left -= len(chunk)
 
-    return zip_result
+        return ''.join(data)
 
+    def unread(self, data):
+        self._pending = data + self._pending
 
-def zip_dir(input_folder):
+
+def _stream_extract(file_obj, output_dir, extensions):
+    """
+    Read a zip file from start to end through its local file headers, without its central directory, extracting the
+    files that make up datasets
+    :return: generator of the extracted files' names in the zip
+    """
+    reader = _StreamReader(file_obj)
+
+    while True:
+        signature = reader.read_some(4)
+
+        if not signature:
+            raise zipfile.BadZipfile('Zip file ended before its central directory')
+
+        signature = struct.unpack('<L', signature + reader.read(4 - len(signature)))[0]
+
+        # Past the last file
+        if signature in [CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE]:
+            return
+
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipfile('Bad zip file header signature {0:#x}'.format(signature))
+
+        (version, flags, method, mod_time, mod_date, crc, compress_size, file_size, name_length,
+         extra_length) = struct.unpack('<HHHHHLLLHH', reader.read(26))
+
+        name = reader.read(name_length)
+        extra = reader.read(extra_length)
+
+        if flags & 0x800:
+            name = name.decode('utf-8')
+
+        zip64 = False
+
+        while len(extra) >= 4:
+            header_id, data_size = struct.unpack('<HH', extra[:4])
+
+            if header_id == 1:
+                zip64 = True
+                values = list(struct.unpack('<{0}Q'.format(data_size // 8), extra[4:4 + data_size // 8 * 8]))
+
+                if file_size == 0xffffffff and values:
+                    file_size = values.pop(0)
+                if compress_size == 0xffffffff and values:
+                    compress_size = values.pop(0)
+
+            extra = extra[4 + data_size:]
+
+        if flags & 0x1:
+            raise zipfile.BadZipfile('{0} is encrypted'.format(name))
+
+        if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+            raise zipfile.BadZipfile('{0} is compressed with unsupported method {1}'.format(name, method))
+
+        has_descriptor = bool(flags & 0x8)
+
+        extract = _dataset_member(name, extensions) is not None
+        out_file = None
+
+        if extract:
+            path = _member_path(output_dir, name)
+            util.mkdir_p(os.path.dirname(path))
+
+            out_file = open(path, 'wb')
+
+        sizes = {'crc': 0}
+
+        def write(data):
+            if out_file:
+                out_file.write(data)
+
+            sizes['crc'] = zlib.crc32(data, sizes['crc']) & 0xffffffff
+
+        try:
+            if not has_descriptor:
+                decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+                left = compress_size
+
+                while left:
+                    chunk = reader.read(min(left, EXTRACT_BUFFER_SIZE))
+                    left -= len(chunk)
+
+                    write(decompressor.decompress(chunk) if decompressor else chunk)
+
+                if decompressor:
+                    write(decompressor.flush())
+
+            elif method == zipfile.ZIP_DEFLATED:
+                crc = _read_deflated_until_descriptor(reader, zip64, write)
+
+            else:
+                crc = _read_stored_until_descriptor(reader, zip64, write)
+
+        except zipfile.BadZipfile as e:
+            raise zipfile.BadZipfile('{0} ({1})'.format(e, name))
+
+        finally:
+            if out_file:
+                out_file.close()
+
+        if extract:
+            if sizes['crc'] != crc:
+                os.remove(path)
+                raise zipfile.BadZipfile('Bad CRC-32 for {0}'.format(name))
+
+            yield name
+
+
+def _read_deflated_until_descriptor(reader, zip64, write):
+    """
+    Read a deflated file with a data descriptor instead of sizes in its header. The deflate stream marks its own end,
+    and the descriptor comes right after it
+    :return: the file's CRC-32 from the descriptor
+    """
+    decompressor = zlib.decompressobj(-15)
+
+    while not decompressor.unused_data:
+        chunk = reader.read_some(EXTRACT_BUFFER_SIZE)
+
+        if not chunk:
+            raise zipfile.BadZipfile('Zip file ended part way through a file')
+
+        write(decompressor.decompress(chunk))
+
+    reader.unread(decompressor.unused_data)
+
+    descriptor = reader.read(4)
+
+    # The descriptor's signature is optional
+    if struct.unpack('<L', descriptor)[0] == DATA_DESCRIPTOR_SIGNATURE:
+        descriptor = reader.read(4)
+
+    reader.read(16 if zip64 else 8)
+
+    return struct.unpack('<L', descriptor)[0]
+
+
+def _read_stored_until_descriptor(reader, zip64, write):
+    """
+    Read a stored file with a data descriptor instead of sizes in its header, as StreamingZipFile writes already
+    compressed files. Nothing marks the end of the data, so it ends at the first descriptor signature followed by the
+    number of bytes read so far
+    :return: the file's CRC-32 from the descriptor
+    """
+    size_format = '<Q' if zip64 else '<L'
+    descriptor_size = 8 + 2 * struct.calcsize(size_format)
+    signature = struct.pack('<L', DATA_DESCRIPTOR_SIGNATURE)
+
+    read_size = 0
+    data = ''
+
+    while True:
+        chunk = reader.read_some(EXTRACT_BUFFER_SIZE)
+
+        if not chunk:
+            raise zipfile.BadZipfile('Zip file ended part way through a file')
+
+        data += chunk
+        index = data.find(signature)
+
+        while index != -1 and index + descriptor_size <= len(data):
+            compress_size = struct.unpack(size_format, data[index + 8:index + 8 + struct.calcsize(size_format)])[0]
+
+            if compress_size == read_size + index:
+                write(data[:index])
+                reader.unread(data[index + descriptor_size:])
+
+                return struct.unpack('<L', data[index + 4:index + 8])[0]
+
+            index = data.find(signature, index + 1)
+
+        # Keep anything that could be the start of a descriptor until there's enough of it to check
+        keep_from = index if index != -1 else max(len(data) - len(signature) + 1, 0)
+
+        write(data[:keep_from])
+        read_size += keep_from
+        data = data[keep_from:]
+
+
+def shp_files(input_shp):
+    """
+    :param input_shp: path to a shapefile
+    :return: list of the files that make up the shapefile that exist, main file first
+    """
+    base_path = os.path.splitext(input_shp)[0]
+
+    return [base_path + x for x in SHP_EXTENSIONS if os.path.exists(base_path + x)]
+
+
+def zip_shp(input_shp, compress_level=DEFAULT_COMPRESS_LEVEL, gfw_env='prod'):
+    """
+    :param input_shp: path to a shapefile
+    :param compress_level: deflate level; 0 stores everything
+    :param gfw_env: gfw env, for the settings
+    :return: zipped shapefile
+    """
+    basepath, fname, base_fname = util.gen_paths_shp(input_shp)
+    zip_path = os.path.join(basepath, base_fname + '.zip')
+
+    write_zip([(x, os.path.basename(x)) for x in shp_files(input_shp)], [zip_path], gfw_env, compress_level)
+
+    return zip_path
+
+
+def zip_dir(input_folder, compress_level=DEFAULT_COMPRESS_LEVEL, gfw_env='prod'):
     """
     :param input_folder: path to a dir
+    :param compress_level: deflate level; 0 stores everything
+    :param gfw_env: gfw env, for the settings
     :return: zipped dir
     """
-    output_dir = os.path.dirname(input_folder)
-    output_name = os.path.basename(input_folder)
-
-    zip_path = os.path.join(output_dir, output_name)
+    zip_path = input_folder + '.zip'
 
-    shutil.make_archive(zip_path, 'zip', input_folder)
+    write_zip(dir_files(input_folder), [zip_path], gfw_env, compress_level)
 
-    # Need to add '.zip' to zip_path; shutil doesn't want .zip on the end for the call used above
-    return zip_path + '.zip'
+    return zip_path
 
 
-def zip_tif(input_tif):
+def zip_tif(input_tif, compress_level=DEFAULT_COMPRESS_LEVEL, gfw_env='prod'):
     """
     :param input_tif: path to a tif
+    :param compress_level: deflate level; 0 stores everything
+    :param gfw_env: gfw env, for the settings
     :return: zipped tif
     """
     basepath, fname, base_fname = util.gen_paths_shp(input_tif)
     zip_path = os.path.join(basepath, base_fname + '.zip')
 
-    zf = zipfile.ZipFile(zip_path, 'w', allowZip64=True)
-    zf.write(input_tif)
-    zf.close()
+    write_zip([(input_tif, input_tif)], [zip_path], gfw_env, compress_level)
 
     return zip_path
 
 
+def dir_files(input_folder):
+    """
+    Lists a dir the way shutil.make_archive zips it: subdirs and files, named relative to the dir. Lock files are
+    left out
+    :param input_folder: path to a dir
+    :return: list of (path, name in the zip) tuples
+    """
+    file_list = []
+
+    for dirpath, dirnames, filenames in os.walk(input_folder):
+        for name in sorted(dirnames) + sorted(filenames):
+            path = os.path.join(dirpath, name)
+
+            if os.path.splitext(name)[1] != '.lock':
+                file_list.append((path, os.path.relpath(path, input_folder)))
+
+    return file_list
+
+
+def get_compress_workers(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: threads used to compress each zip member, from settings.ini
+    """
+    archive_settings = settings.get_settings(gfw_env).get('archive', {})
+
+    return int(archive_settings.get('compress_workers', DEFAULT_COMPRESS_WORKERS))
+
+
+def _compress_block(block):
+    data, compress_level = block
+
+    # A sync flush ends the output on a byte boundary without ending the deflate stream, so blocks compressed on
+    # their own can be written one after another
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _file_crc(fp, first_block):
+    """
+    CRC-32 of a file, read from the start; leaves fp just after first_block, where it was
+    :param fp: the open file
+    :param first_block: the first COMPRESS_BLOCK_SIZE bytes of the file
+    :return: the CRC
+    """
+    crc = zlib.crc32(first_block) & 0xffffffff
+
+    for block in iter(lambda: fp.read(COMPRESS_BLOCK_SIZE), ''):
+        crc = zlib.crc32(block, crc) & 0xffffffff
+
+    fp.seek(len(first_block))
+
+    return crc
+
+
+class StreamingZipFile(zipfile.ZipFile):
+    """
+    A ZipFile that can be written to a stream that can't seek, i.e. an S3 upload. The CRC and sizes of each deflated
+    file go in a data descriptor after its data, instead of being written back into its header. Stored files get a
+    normal header, with a CRC from a first pass over the file: nothing in stored data marks where it ends, so
+    streaming readers (i.e. Java's ZipInputStream) need the size up front.
+
+    Each file is deflated in blocks on several threads (zlib lets go of the GIL while it works). Files that are
+    already compressed are stored as they are: known compressed formats, and anything whose first block barely
+    compresses, i.e. compressed GeoTIFFs and GeoPackages of image tiles
+    :param file_obj: file-like object with write() and tell()
+    :param compress_level: deflate level; 0 stores everything
+    :param workers: threads to compress each file with
+    """
+    def __init__(self, file_obj, compress_level=DEFAULT_COMPRESS_LEVEL, workers=1):
+        zipfile.ZipFile.__init__(self, file_obj, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+        self.compress_level = compress_level
+        self.workers = workers
+
+    def write(self, filename, arcname=None, compress_type=None):
+        if os.path.isdir(filename):
+            return zipfile.ZipFile.write(self, filename, arcname, zipfile.ZIP_STORED)
+
+        st = os.stat(filename)
+        date_time = time.localtime(st.st_mtime)[0:6]
+
+        # Named the same way ZipFile.write names them
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+
+        with open(filename, 'rb') as fp:
+            first_block = fp.read(COMPRESS_BLOCK_SIZE)
+
+            if compress_type is None:
+                compress_type = self._choose_compression(filename, first_block)
+
+            # Compressed here, then reused if the file is deflated
+            first_compressed = None
+
+            if compress_type is None:
+                first_compressed = _compress_block((first_block, self.compress_level))
+
+                if len(first_compressed) > len(first_block) * STORE_RATIO:
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+
+            zinfo = zipfile.ZipInfo(arcname, date_time)
+            zinfo.external_attr = (st[0] & 0xFFFF) << 16L
+            zinfo.compress_type = compress_type
+            zinfo.file_size = st.st_size
+            zinfo.header_offset = self.fp.tell()
+
+            if compress_type == zipfile.ZIP_STORED:
+                zinfo.CRC = _file_crc(fp, first_block)
+                zinfo.compress_size = st.st_size
+                zip64 = st.st_size > zipfile.ZIP64_LIMIT
+
+            else:
+                zinfo.flag_bits = 0x08
+
+                # Compressed size can be larger than uncompressed size
+                zip64 = st.st_size * 1.05 > zipfile.ZIP64_LIMIT
+
+            self._writecheck(zinfo)
+            self._didModify = True
+
+            self.fp.write(zinfo.FileHeader(zip64))
+
+            sizes = {'crc': 0, 'file_size': 0, 'compress_size': 0}
+
+            def read_blocks():
+                block = first_block
+
+                while block:
+                    sizes['crc'] = zlib.crc32(block, sizes['crc']) & 0xffffffff
+                    sizes['file_size'] += len(block)
+
+                    yield block
+                    block = fp.read(COMPRESS_BLOCK_SIZE)
+
+            def write(buf):
+                sizes['compress_size'] += len(buf)
+                self.fp.write(buf)
+
+            if compress_type == zipfile.ZIP_STORED:
+                for block in read_blocks():
+                    write(block)
+
+            else:
+                blocks = read_blocks()
+
+                # The first block has already been compressed if the file was sampled
+                if first_compressed is not None:
+                    next(blocks)
+                    write(first_compressed)
+
+                for compressed in parallel.imap_bounded(_compress_block, ((x, self.compress_level) for x in blocks),
+                                                        self.workers, threads=True):
+                    write(compressed)
+
+                # An empty final block ends the deflate stream
+                write(zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush())
+
+        if compress_type == zipfile.ZIP_STORED:
+            # The header's already been written, so the file can't change now
+            if (sizes['crc'], sizes['file_size']) != (zinfo.CRC, zinfo.file_size):
+                raise IOError('{0} changed while it was being zipped'.format(filename))
+
+        else:
+            if not zip64 and max(sizes['file_size'], sizes['compress_size']) > zipfile.ZIP64_LIMIT:
+                raise zipfile.LargeZipFile('{0} grew too large for its header while zipping'.format(filename))
+
+            zinfo.CRC = sizes['crc']
+            zinfo.file_size = sizes['file_size']
+            zinfo.compress_size = sizes['compress_size']
+
+            descriptor_format = '<LLQQ' if zip64 else '<LLLL'
+            self.fp.write(struct.pack(descriptor_format, DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, zinfo.compress_size,
+                                      zinfo.file_size))
+
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def _choose_compression(self, filename, first_block):
+        """
+        :return: ZIP_STORED if the file shouldn't be deflated, or None to decide from how well its first block
+        compresses
+        """
+        if not self.compress_level or not first_block:
+            return zipfile.ZIP_STORED
+
+        if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+
+        return None
+
+
+class _TeeWriter(object):
+    """
+    Writes everything written to it to several file-like objects
+    """
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.position = 0
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+
+def write_zip(file_list, destinations, gfw_env, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Zip files straight to each destination, building the zip only once. Local destinations are written as the zip is
+    built, as is the first S3 destination (in parallel parts); other S3 destinations are server-side copies of it
+    :param file_list: list of (path, name in the zip) tuples
+    :param destinations: list of local paths and s3:// URLs
+    :param gfw_env: gfw env, for the settings
+    :param compress_level: deflate level; 0 stores everything
+    :return:
+    """
+    start_time = time.time()
+
+    s3_destinations = [x for x in destinations if s3_transfer.is_s3_url(x)]
+    local_destinations = [x for x in destinations if not s3_transfer.is_s3_url(x)]
+
+    outputs = [open(x, 'wb') for x in local_destinations]
+    s3_writer = None
+
+    if s3_destinations:
+        s3_writer = s3_transfer.open_writer(s3_destinations[0], gfw_env)
+        outputs.append(s3_writer)
+
+    try:
+        zf = StreamingZipFile(_TeeWriter(outputs), compress_level, get_compress_workers(gfw_env))
+
+        for path, arcname in file_list:
+            zf.write(path, arcname)
+
+        zf.close()
+
+        if s3_writer:
+            s3_writer.close()
+
+    except:
+        if s3_writer:
+            s3_writer.abort()
+        raise
+
+    finally:
+        for output in outputs:
+            if output is not s3_writer:
+                output.close()
+
+    stored = len([x for x in zf.infolist() if x.compress_type == zipfile.ZIP_STORED and x.file_size])
+    logging.debug('Zipped {0} files ({1} stored) to {2} in {3:.1f} seconds'.format(len(file_list), stored,
+                                                                                  destinations[0],
+                                                                                  time.time() - start_time))
+
+    for dst in s3_destinations[1:]:
+        s3_transfer.copy(s3_destinations[0], dst, gfw_env)
+
+
+def copy_output(src, dst, gfw_env):
+    """
+    Copy a zip between local paths and S3, in whichever direction. S3 to S3 is a server-side copy
+    :param src: local path or s3:// URL
+    :param dst: local path or s3:// URL
+    :param gfw_env: gfw env, for the S3 settings
+    """
+    if s3_transfer.is_s3_url(src) and s3_transfer.is_s3_url(dst):
+        s3_transfer.copy(src, dst, gfw_env)
+
+    elif s3_transfer.is_s3_url(src):
+        s3_transfer.download_file(src, dst, gfw_env)
+
+    elif s3_transfer.is_s3_url(dst):
+        s3_transfer.upload_file(src, dst, gfw_env)
+
+    else:
+        shutil.copy(src, dst)
+
+
+def output_exists(path, gfw_env):
+    if s3_transfer.is_s3_url(path):
+        return s3_transfer.exists(path, gfw_env)
+
+    return os.path.exists(path)
+
+
+def get_manifest_path(archive_output):
+    """
+    :param archive_output: the archive_output of a layer, i.e. s3://bucket/archive/layer.zip
+    :return: path to its manifest, next to the archives, i.e. s3://bucket/archive/layer_manifest.json
+    """
+    return os.path.splitext(archive_output)[0] + '_manifest.json'
+
+
+def read_manifest(archive_output, gfw_env):
+    """
+    :param archive_output: the archive_output of a layer
+    :param gfw_env: gfw env, for the S3 settings
+    :return: list of archive entries, oldest first; empty if there's no manifest yet
+    """
+    manifest_path = get_manifest_path(archive_output)
+
+    if not output_exists(manifest_path, gfw_env):
+        return []
+
+    if s3_transfer.is_s3_url(manifest_path):
+        return json.load(s3_transfer.open_reader(manifest_path, gfw_env))
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(archive_output, manifest, gfw_env):
+    """
+    :param archive_output: the archive_output of a layer
+    :param manifest: list of archive entries
+    :param gfw_env: gfw env, for the S3 settings
+    """
+    manifest_path = get_manifest_path(archive_output)
+    manifest_json = json.dumps(manifest, indent=4)
+
+    if s3_transfer.is_s3_url(manifest_path):
+        with s3_transfer.open_writer(manifest_path, gfw_env) as f:
+            f.write(manifest_json)
+
+    else:
+        with open(manifest_path, 'w') as f:
+            f.write(manifest_json)
+
+
+def find_archive(manifest, content_hash, gfw_env):
+    """
+    :param manifest: list of archive entries from read_manifest()
+    :param content_hash: content hash of the dataset about to be archived
+    :param gfw_env: gfw env, for the S3 settings
+    :return: the most recent archive of the same content that still exists, or None
+    """
+    for entry in reversed(manifest):
+        if entry['content_hash'] == content_hash and output_exists(entry['archive'], gfw_env):
+            return entry['archive']
+
+    return None
+
+
 def all_files_less_than_2gb(input_dir):
     """
     Checks a dir to see if all files are < 2.0 GB
@@ -115,75 +843,133 @@ def all_files_less_than_2gb(input_dir):
     return all_less_than_2gb
 
 
-def zip_file(input_fc, temp_zip_dir, download_output=None, archive_output=None, sr_is_local=False):
+def zip_file(input_fc, temp_zip_dir, download_output=None, archive_output=None, sr_is_local=False, gfw_env='prod',
+             compress_level=DEFAULT_COMPRESS_LEVEL):
     """
     :param input_fc: feature class/raster to zip
     :param temp_zip_dir: output zip dir
     :param download_output: path to the download output, if required
     :param archive_output: path to the archive output, if requried
     :param sr_is_local: if the spatial reference is local, will create a _local.zip in download_output
+    :param gfw_env: gfw env, for the S3 settings
+    :param compress_level: deflate level; 0 stores everything
     :return: None
     """
     logging.debug('Starting archive.zip_file')
 
     basepath, fname, base_fname = util.gen_paths_shp(input_fc)
-    temp_dir = util.create_temp_dir(temp_zip_dir)
 
     data_type = arcpy.Describe(input_fc).dataType
 
+    ts = time.time()
+    timestamp = datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d%H%M%S')
+
+    if sr_is_local and download_output:
+        download_output = os.path.splitext(download_output)[0] + "_local.zip"
+
+    # If the data is the same as in a previous archive, point the manifest at that archive instead of zipping it again
+    if archive_output:
+        content_hash = fingerprint.content_hash(input_fc)
+        manifest = read_manifest(archive_output, gfw_env)
+
+        existing_archive = find_archive(manifest, content_hash, gfw_env) if content_hash else None
+
+        if existing_archive:
+            logging.info('{0} is unchanged since {1}; not archiving it again'.format(base_fname, existing_archive))
+
+            manifest.append({'date': timestamp, 'content_hash': content_hash, 'archive': existing_archive,
+                             'reused': True})
+            write_manifest(archive_output, manifest, gfw_env)
+
+            if download_output:
+                logging.debug("Copying {0} to download folder {1}".format(existing_archive, download_output))
+                copy_output(existing_archive, download_output, gfw_env)
+
+            return
+
+    temp_dir = util.create_temp_dir(temp_zip_dir)
+
     if data_type in ['FeatureClass', 'ShapeFile']:
 
-        # Try to create a shapefile first, knowing that the data may be too large and may have to use an FGDB instead
-        logging.debug('trying to zip SHP-----------------')
-        arcpy.FeatureClassToShapefile_conversion(input_fc, temp_dir)
-        out_shp = os.path.join(temp_dir, fname)
+        # Pick the format up front; a shapefile can't have components > 2 GB
+        large_format = export_estimate.get_large_format(gfw_env)
+        export_format, estimate = export_estimate.choose_format(input_fc, large_format)
 
-        # If the dir with the shapefile is < 2GB, zip the shapefile
-        if all_files_less_than_2gb(temp_dir):
-            temp_zip = zip_shp(out_shp)
+        if export_format == 'shp':
+            arcpy.FeatureClassToShapefile_conversion(input_fc, temp_dir)
+            out_shp = os.path.join(temp_dir, fname)
 
-        else:
-            logging.debug('Some components of SHP > 2 GB; now exporting to GDB instead')
+            export_estimate.log_estimate_error(estimate, out_shp)
 
-            # Delete shapefile conversion dir and start fresh
-            temp_dir = util.create_temp_dir(temp_zip_dir)
+            if all_files_less_than_2gb(temp_dir):
+                file_list = [(x, os.path.basename(x)) for x in shp_files(out_shp)]
 
+            else:
+                export_format = large_format
+                logging.warning('Estimate was too low; some components of SHP > 2 GB. Now exporting to '
+                                '{0} instead'.format(export_format))
+
+                # Delete shapefile conversion dir and start fresh
+                temp_dir = util.create_temp_dir(temp_zip_dir)
+
+        if export_format == 'gdb':
             gdb_fc = util.fc_to_temp_gdb(input_fc, temp_dir)
             gdb_dir = os.path.dirname(os.path.dirname(gdb_fc))
 
-            temp_zip = zip_dir(gdb_dir)
+            file_list = dir_files(gdb_dir)
+
+        elif export_format == 'gpkg':
+            gpkg_path = os.path.dirname(util.fc_to_temp_gpkg(input_fc, temp_dir))
+            file_list = [(gpkg_path, os.path.basename(gpkg_path))]
 
     elif data_type == 'RasterDataset':
-        temp_zip = zip_tif(input_fc)
+        file_list = [(input_fc, input_fc)]
 
     else:
         logging.error('Unknown data_type: {0}. Exiting the program'.format(data_type))
         sys.exit(1)
 
-    # Define output path for archive zip file and copy temp zip there
+    destinations = []
+
+    # Define output path for archive zip file
     if archive_output:
         logging.debug('Archiving {0} in {1}'.format(base_fname, archive_output))
+        archive_dst = os.path.splitext(archive_output)[0] + '_{0}.zip'.format(timestamp)
 
-        ts = time.time()
-        timestamp = datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d%H%M%S')
-        dst = os.path.splitext(archive_output)[0] + '_{0}.zip'.format(timestamp)
-
-        if r's3://' in dst:
-            subprocess.check_call(['aws', 's3', 'cp', temp_zip, dst])
+        destinations.append(archive_dst)
 
-        else:
-            shutil.copy(temp_zip, dst)
-
-    # Define output path for download zip file and copy temp zip there
+    # Define output path for download zip file
     if download_output:
         logging.debug("Copying {0} to download folder {1}".format(base_fname, download_output))
+        destinations.append(download_output)
 
-        if sr_is_local:
-            dst = os.path.splitext(download_output)[0] + "_local.zip"
-        else:
-            dst = download_output
+    # Zip straight to the outputs; an S3 download copy is copied from the archive within S3
+    if destinations:
+        write_zip(file_list, destinations, gfw_env, compress_level)
 
-        if r's3://' in dst:
-            subprocess.check_call(['aws', 's3', 'cp', temp_zip, dst])
-        else:
-            shutil.copy(temp_zip, dst)
+    if archive_output and content_hash:
+        manifest.append({'date': timestamp, 'content_hash': content_hash, 'archive': archive_dst, 'reused': False})
+        write_manifest(archive_output, manifest, gfw_env)
+
+
+def main():
+    """
+    Extract the datasets from a zip file. Point it at a zip file that's still being downloaded with --follow to
+    extract as it downloads
+    """
+    parser = argparse.ArgumentParser(description='Extract the shapefiles and GeoTIFFs from a zip file.')
+    parser.add_argument('source', help='zip file')
+    parser.add_argument('--output-dir', '-o', required=True, help='dir to extract to')
+    parser.add_argument('--extensions', '-e', nargs='+', default=['.shp', '.tif'], choices=DATASET_EXTENSIONS.keys(),
+                        help='datasets to extract')
+    parser.add_argument('--follow', '-f', action='store_true', help='keep reading as the zip file is written')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    for dataset in extract_datasets(args.source, args.output_dir, args.extensions, args.follow):
+        logging.info(dataset)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,22 @@ import boto3
 
 import utilities.token_util
 
-token_info = utilities.token_util.get_token('boto.config')
-access_key = token_info[0][1]
-secret_key = token_info[1][1]
+# Connected on first use, then reused for the life of the process
+_ec2_conn = None
 
-ec2_conn = boto.ec2.connect_to_region('us-east-1', aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+
+def get_ec2_conn():
+    global _ec2_conn
+
+    if not _ec2_conn:
+        token_info = utilities.token_util.get_token('boto.config')
+        access_key = token_info[0][1]
+        secret_key = token_info[1][1]
+
+        _ec2_conn = boto.ec2.connect_to_region('us-east-1', aws_access_key_id=access_key,
+                                               aws_secret_access_key=secret_key)
+
+    return _ec2_conn
 
 
 def get_timestamps(bucket):
@@ -33,7 +44,7 @@ def get_timestamps(bucket):
 
 def get_aws_instance(server_name):
 
-    reservations = ec2_conn.get_all_reservations()
+    reservations = get_ec2_conn().get_all_reservations()
     for reservation in reservations:
         for instance in reservation.instances:
             if 'Name' in instance.tags:
@@ -48,7 +59,7 @@ def get_aws_instance(server_name):
 def set_server_instance_type(aws_instance_object, desired_type):
 
     instance_name = aws_instance_object.tags['Name']
-    current_type = ec2_conn.get_instance_attribute(aws_instance_object.id, 'instanceType')['instanceType']
+    current_type = get_ec2_conn().get_instance_attribute(aws_instance_object.id, 'instanceType')['instanceType']
 
     if current_type != desired_type:
         logging.debug('Changing {0} from type {1} to {2}'.format(instance_name, current_type, desired_type))
@@ -57,7 +68,7 @@ def set_server_instance_type(aws_instance_object, desired_type):
         if aws_instance_object.state != 'stopped':
             set_processing_server_state(aws_instance_object, 'stopped')
 
-        ec2_conn.modify_instance_attribute(aws_instance_object.id, 'instanceType', desired_type)
+        get_ec2_conn().modify_instance_attribute(aws_instance_object.id, 'instanceType', desired_type)
 
     else:
         logging.debug('Server {0} is already type {1}'.format(instance_name, desired_type))
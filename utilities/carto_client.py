@@ -0,0 +1,213 @@
+import csv
+import gzip
+import json
+import logging
+import StringIO
+import urllib
+import zlib
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connections kept open to the SQL API; enough for the chunk uploader's threads to each have their own
+DEFAULT_POOL_SIZE = 8
+
+# Request bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+# Statuses that mean the API is overloaded or down rather than that the statement is wrong
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CartoRetryableError(IOError):
+    """
+    The SQL API was rate limited (429), failed (5xx) or cancelled the statement for taking too long. The statement
+    itself may work if sent again later. SQL errors are raised as SyntaxError
+    :param status_code: the HTTP status
+    """
+    def __init__(self, message, status_code):
+        super(CartoRetryableError, self).__init__(message)
+        self.status_code = status_code
+
+
+class CartoClient(object):
+    """
+    Client for the cartoDB SQL and synchronization APIs. Holds one keep-alive session, so every statement in a run
+    reuses the same connections instead of opening a new one. SQL is sent in POST bodies, not the query string
+    :param sql_api: URL of the SQL API, i.e. https://wri-01.carto.com/api/v2/sql
+    :param api_key: the API key
+    :param sync_api: URL of the synchronization API, if we need to force syncs
+    :param compress_requests: gzip request bodies larger than COMPRESS_MIN_BYTES. Responses are always
+    requested gzipped
+    :param pool_size: max connections to keep open
+    :param timeout: seconds to wait for a response
+    """
+    def __init__(self, sql_api, api_key, sync_api=None, compress_requests=False, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=600):
+        self.sql_api = sql_api
+        self.api_key = api_key
+        self.sync_api = sync_api
+        self.compress_requests = compress_requests
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _post_sql(self, sql, stream=False, **params):
+        payload = {'q': sql, 'api_key': self.api_key}
+        payload.update(params)
+
+        # Encode ourselves rather than letting requests do it, so we can gzip the body
+        body = urllib.urlencode(dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                                     for k, v in payload.iteritems()))
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        if self.compress_requests and len(body) >= COMPRESS_MIN_BYTES:
+            buf = StringIO.StringIO()
+
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+        return self.session.post(self.sql_api, data=body, headers=headers, stream=stream, timeout=self.timeout)
+
+    def sql(self, sql):
+        """
+        Execute a SQL statement
+        :param sql: a SQL statement
+        :return: the JSON response, with rows and fields in the order the API returned them
+        """
+        logging.debug(sql)
+
+        return _raise_for_error(self._post_sql(sql))
+
+    def iter_rows(self, sql):
+        """
+        Execute a query and stream the results as CSV, so large result sets don't have to fit in memory as JSON
+        Values come back as strings
+        :param sql: a SELECT statement
+        :return: generator of OrderedDicts, one per row
+        """
+        logging.debug(sql)
+
+        r = self._post_sql(sql, stream=True, format='csv')
+
+        try:
+            if r.status_code != 200:
+                _raise_for_error(r)
+
+            # Read the raw stream, which keeps the line endings, so values with newlines in them parse as one field
+            r.raw.decode_content = True
+
+            reader = csv.reader(r.raw)
+            header = next(reader, None)
+
+            for row in reader:
+                yield OrderedDict(zip(header, row))
+
+        finally:
+            r.close()
+
+    def copy_from(self, copy_sql, chunks):
+        """
+        Stream rows into a table through the COPY endpoint: https://carto.com/developers/sql-api/guides/copy-queries/
+        The body is sent with chunked transfer encoding, so it's never held in memory all at once
+        :param copy_sql: a COPY ... FROM STDIN statement
+        :param chunks: iterable of str chunks of the data, in the format the statement specifies
+        :return: number of rows the server loaded
+        """
+        logging.debug(copy_sql)
+
+        headers = {'Content-Type': 'application/octet-stream'}
+
+        if self.compress_requests:
+            chunks = _gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+
+        r = self.session.post(self.sql_api + '/copyfrom', params={'q': copy_sql, 'api_key': self.api_key},
+                              data=chunks, headers=headers, timeout=self.timeout)
+
+        return int(_raise_for_error(r)['total_rows'])
+
+    def force_sync(self, table_name):
+        """
+        Force a sync of a sync table: https://carto.com/docs/carto-engine/import-api/sync-tables
+        :param table_name: the sync table's name
+        """
+        if not self.sync_api:
+            raise ValueError('No synchronization_api set for this account in settings.ini')
+
+        r = self.session.get(self.sync_api, params={'api_key': self.api_key}, timeout=self.timeout)
+        table_data = r.json()
+
+        table_id_list = [x['id'] for x in table_data['synchronizations'] if x['name'] == table_name]
+
+        if not table_id_list:
+            raise ValueError('No sync table named {0}'.format(table_name))
+
+        sync_tables_url = '{0}/{1}/sync_now'.format(self.sync_api, table_id_list[0])
+        r = self.session.put(sync_tables_url, params={'api_key': self.api_key}, timeout=self.timeout)
+
+        if r.status_code == 200:
+            logging.debug("Sync Table Success for {}".format(table_name))
+        else:
+            logging.debug(r.text)
+            raise ValueError('Request failed with code: {}'.format(r.status_code))
+
+    def close(self):
+        self.session.close()
+
+
+def _gzip_chunks(chunks):
+    """
+    Gzip a stream of chunks as they're read
+    :param chunks: iterable of str
+    :return: generator of gzipped str chunks
+    """
+    # wbits of 16 + MAX_WBITS writes a gzip header and trailer rather than a raw zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def _raise_for_error(r):
+    """
+    Raise if a SQL API response is an error: CartoRetryableError if sending it again might work, SyntaxError if the
+    API says the statement failed, or requests.HTTPError for anything else that isn't a success
+    :param r: a requests response
+    :return: the parsed JSON response, with rows and fields in the order the API returned them
+    """
+    try:
+        json_result = json.loads(r.content, object_pairs_hook=OrderedDict)
+    except ValueError:
+        json_result = None
+
+    error = json_result.get('error') if isinstance(json_result, dict) else None
+
+    if r.status_code in RETRYABLE_STATUSES or 'statement timeout' in json.dumps(error):
+        raise CartoRetryableError('SQL API returned {0}: {1}'.format(r.status_code, error or r.content[:500]),
+                                  r.status_code)
+
+    if error:
+        raise SyntaxError(error)
+
+    r.raise_for_status()
+
+    if json_result is None:
+        raise ValueError('SQL API returned {0} with a body that is not JSON: {1}'.format(r.status_code,
+                                                                                       r.content[:500]))
+
+    return json_result
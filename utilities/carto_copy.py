@@ -0,0 +1,367 @@
+import argparse
+import logging
+import struct
+import time
+
+import requests
+from osgeo import ogr
+from osgeo import osr
+from retrying import retry
+
+import carto_client
+
+# psycopg2 is only needed to load into a local PostgreSQL/PostGIS database instead of cartoDB, i.e. to test the
+# loader or measure throughput
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# Rows and bytes of CSV per COPY request. Each request is one transaction, so a request the server says failed can
+# be retried without leaving partial rows behind. Small enough to finish well inside the SQL API's timeouts
+COPY_BATCH_ROWS = 100000
+COPY_BATCH_BYTES = 32 * 1024 * 1024
+
+# Gateway errors from the proxy in front of the SQL API; the COPY behind it may still have committed
+GATEWAY_STATUSES = (502, 504)
+
+# Columns cartoDB populates itself
+SKIP_COLUMNS = ['cartodb_id', 'the_geom', 'the_geom_webmercator']
+
+GEOM_COLUMN = 'the_geom'
+
+# EWKB flag that says an SRID follows the geometry type
+EWKB_SRID_FLAG = 0x20000000
+
+
+class CopyTarget(object):
+    """
+    A database we can COPY CSV rows into
+    """
+    def copy(self, copy_sql, chunks):
+        """
+        Run a COPY ... FROM STDIN statement
+        :param copy_sql: the COPY statement
+        :param chunks: iterable of str chunks of CSV
+        :return: number of rows the server says it loaded
+        """
+        raise NotImplementedError
+
+    def count(self, table_name):
+        """
+        :param table_name: the table
+        :return: number of rows in the table
+        """
+        raise NotImplementedError
+
+
+class CartoCopyTarget(CopyTarget):
+    """
+    Loads rows through the SQL API's COPY endpoint
+    :param client: a carto_client.CartoClient
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def copy(self, copy_sql, chunks):
+        return self.client.copy_from(copy_sql, chunks)
+
+    def count(self, table_name):
+        return int(self.client.sql('SELECT count(*) AS row_count FROM {0}'.format(table_name))['rows'][0]['row_count'])
+
+
+class _ChunkReader(object):
+    """
+    File-like wrapper around an iterable of str chunks, for psycopg2's copy_expert
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class PostgresCopyTarget(CopyTarget):
+    """
+    Loads rows into a PostgreSQL/PostGIS database with psycopg2; stands in for cartoDB when testing
+    :param dsn: a libpq connection string, i.e. "dbname=gfw_test"
+    """
+    def __init__(self, dsn):
+        self.conn = psycopg2.connect(dsn)
+
+    def copy(self, copy_sql, chunks):
+        with self.conn:
+            with self.conn.cursor() as cursor:
+                cursor.copy_expert(copy_sql, _ChunkReader(chunks))
+                return cursor.rowcount
+
+    def count(self, table_name):
+        with self.conn:
+            with self.conn.cursor() as cursor:
+                cursor.execute('SELECT count(*) FROM {0}'.format(table_name))
+                return cursor.fetchone()[0]
+
+    def columns(self, table_name):
+        with self.conn:
+            with self.conn.cursor() as cursor:
+                cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_name = %s '
+                               'ORDER BY ordinal_position', (table_name, ))
+                return [x[0] for x in cursor.fetchall()]
+
+
+def csv_value(value):
+    """
+    Format a value for COPY ... WITH (FORMAT csv). The csv module writes None as "" when quoting text, which COPY
+    reads as an empty string; here None is an empty unquoted field, which COPY reads as NULL
+    :param value: a field value from OGR
+    :return: str
+    """
+    if value is None:
+        return ''
+
+    # repr keeps a float's full precision; str for ints, since repr adds an L to longs
+    if isinstance(value, float):
+        return repr(value)
+
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return '"{0}"'.format(str(value).replace('"', '""'))
+
+
+def to_ewkb_hex(geom, srid=4326):
+    """
+    Write a geometry as hex EWKB, the text form PostGIS reads fastest and without any loss of precision
+    :param geom: a 2D ogr.Geometry
+    :param srid: SRID to embed
+    :return: hex str
+    """
+    wkb = geom.ExportToWkb(ogr.wkbNDR)
+    geom_type = struct.unpack('<I', wkb[1:5])[0]
+
+    return (wkb[0] + struct.pack('<II', geom_type | EWKB_SRID_FLAG, srid) + wkb[5:]).encode('hex')
+
+
+def _get_transform(layer):
+    """
+    :param layer: an ogr.Layer
+    :return: a transformation from the layer's SRS to WGS84, or None if it's already WGS84/unknown
+    """
+    source_srs = layer.GetSpatialRef()
+
+    if not source_srs:
+        return None
+
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromEPSG(4326)
+
+    # GDAL 3 follows the EPSG axis order (lat, long) unless told otherwise
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    if source_srs.IsSame(target_srs):
+        return None
+
+    return osr.CoordinateTransformation(source_srs, target_srs)
+
+
+def match_columns(source_fields, target_columns):
+    """
+    Pair up source fields with table columns, ignoring case, like ogr2ogr -append does with the CartoDB driver
+    :param source_fields: field names in the source layer
+    :param target_columns: column names in the target table
+    :return: list of (source field, target column) tuples
+    """
+    target_dict = dict((x.lower(), x) for x in target_columns if x.lower() not in SKIP_COLUMNS)
+
+    return [(x, target_dict[x.lower()]) for x in source_fields if x.lower() in target_dict]
+
+
+def iter_csv_rows(path, target_columns, layer_name=None, id_field=None, id_list=None):
+    """
+    Read a layer from an OGR datasource (i.e. the validated spatialite DB) as CSV lines for COPY
+    :param path: path to the datasource
+    :param target_columns: columns in the table we're loading
+    :param layer_name: the layer to read; defaults to the first one
+    :param id_field: with id_list, an ID field to select features by
+    :param id_list: only read features with these IDs; None to read everything
+    :return: tuple of (list of target columns in the order written, generator of CSV lines)
+    """
+    datasource = ogr.Open(path)
+    layer = datasource.GetLayerByName(layer_name) if layer_name else datasource.GetLayer(0)
+
+    layer_defn = layer.GetLayerDefn()
+    source_fields = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+
+    column_pairs = match_columns(source_fields, target_columns)
+    field_indexes = [layer_defn.GetFieldIndex(x[0]) for x in column_pairs]
+
+    copy_columns = [x[1] for x in column_pairs] + [GEOM_COLUMN]
+
+    transform = _get_transform(layer)
+
+    id_set = set(id_list) if id_list is not None else None
+    id_index = layer_defn.GetFieldIndex(id_field) if id_field else None
+
+    def read_rows():
+        # Keep a reference to the datasource; the layer is invalid once it's garbage collected
+        ds = datasource
+
+        for feature in layer:
+            if id_set is not None and feature.GetField(id_index) not in id_set:
+                continue
+
+            values = [feature.GetField(i) for i in field_indexes]
+
+            geom = feature.GetGeometryRef()
+
+            if geom:
+                geom = geom.Clone()
+                geom.FlattenTo2D()
+
+                if transform:
+                    geom.Transform(transform)
+
+                values.append(to_ewkb_hex(geom))
+            else:
+                values.append(None)
+
+            yield ','.join([csv_value(x) for x in values]) + '\n'
+
+    return copy_columns, read_rows()
+
+
+def iter_batches(lines, batch_rows=COPY_BATCH_ROWS, batch_bytes=COPY_BATCH_BYTES):
+    """
+    Group CSV lines into COPY requests by row count and size
+    :param lines: iterable of CSV lines
+    :param batch_rows: max rows per request
+    :param batch_bytes: max bytes per request
+    :return: generator of lists of lines
+    """
+    batch = []
+    size = 0
+
+    for line in lines:
+        batch.append(line)
+        size += len(line)
+
+        if len(batch) >= batch_rows or size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield batch
+
+
+def _is_retryable(exception):
+    # Only retry when we know the batch wasn't loaded: the API turned it away (429, 5xx from the API itself, statement
+    # timeouts) or we never connected. If the response was lost (a gateway error, a read timeout or a dropped
+    # connection), the COPY may have committed, and sending it again would load the rows twice
+    if isinstance(exception, carto_client.CartoRetryableError):
+        return exception.status_code not in GATEWAY_STATUSES
+
+    return isinstance(exception, requests.exceptions.ConnectTimeout)
+
+
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=64000, stop_max_attempt_number=8,
+       retry_on_exception=_is_retryable)
+def copy_batch(target, copy_sql, batch):
+    """
+    COPY one batch of rows, retrying with exponential backoff, up to 8 attempts, if the API turned it away. The
+    batch is a single transaction, so a failed attempt leaves nothing behind. Anything else fails straight away
+    :param target: a CopyTarget
+    :param copy_sql: the COPY statement
+    :param batch: list of CSV lines
+    :return: rows loaded
+    """
+    loaded = target.copy(copy_sql, iter(batch))
+
+    if loaded != len(batch):
+        raise SyntaxError('COPY loaded {0} rows, sent {1}'.format(loaded, len(batch)))
+
+    return loaded
+
+
+def bulk_load(target, path, table_name, target_columns, layer_name=None, id_field=None, id_list=None,
+              batch_rows=COPY_BATCH_ROWS, batch_bytes=COPY_BATCH_BYTES):
+    """
+    Stream every feature in an OGR datasource into a table with COPY FROM STDIN, then check the table's row
+    count on the server
+    :param target: a CopyTarget
+    :param path: path to the datasource
+    :param table_name: table to load
+    :param target_columns: the table's columns
+    :param layer_name: the layer to read; defaults to the first one
+    :param id_field: with id_list, an ID field to select features by
+    :param id_list: only load features with these IDs; None to load everything
+    :param batch_rows: max rows per COPY request
+    :param batch_bytes: max bytes per COPY request
+    :return: number of rows loaded
+    """
+    start_time = time.time()
+    start_count = target.count(table_name)
+
+    copy_columns, lines = iter_csv_rows(path, target_columns, layer_name, id_field, id_list)
+
+    copy_sql = 'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(table_name, ', '.join(copy_columns))
+    logging.debug(copy_sql)
+
+    row_count = 0
+
+    for batch in iter_batches(lines, batch_rows, batch_bytes):
+        row_count += copy_batch(target, copy_sql, batch)
+        logging.debug('Loaded {0} rows into {1}'.format(row_count, table_name))
+
+    end_count = target.count(table_name)
+
+    if end_count - start_count != row_count:
+        raise ValueError('Row count check failed for {0}: sent {1} rows but the table grew by '
+                         '{2}'.format(table_name, row_count, end_count - start_count))
+
+    logging.info('Loaded {0} rows into {1} in {2:.1f} seconds'.format(row_count, table_name,
+                                                                      time.time() - start_time))
+
+    return row_count
+
+
+def main():
+    """
+    Load an OGR datasource into a local PostgreSQL/PostGIS table the same way we load cartoDB staging tables, to test
+    the loader or measure throughput. The table must already exist with a the_geom column
+    """
+    parser = argparse.ArgumentParser(description='Bulk load an OGR datasource into PostGIS with COPY.')
+    parser.add_argument('source', help='source datasource, i.e. the out.sqlite we push to cartoDB')
+    parser.add_argument('table', help='table to load')
+    parser.add_argument('--dsn', '-d', required=True, help='libpq connection string, i.e. "dbname=gfw_test"')
+    parser.add_argument('--batch-rows', '-b', type=int, default=COPY_BATCH_ROWS, help='rows per COPY request')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    target = PostgresCopyTarget(args.dsn)
+    bulk_load(target, args.source, args.table, target.columns(args.table), batch_rows=args.batch_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from osgeo import ogr
+
+import util
+
+# Columns cartoDB populates itself, and gfwid, which is the key rather than part of the hash
+SKIP_COLUMNS = ['cartodb_id', 'the_geom', 'the_geom_webmercator', 'gfwid', 'created_at', 'updated_at']
+
+# Decimal places numbers are compared to
+NUMBER_PLACES = 8
+
+
+class DeltaReport(object):
+    """
+    What a delta sync changed in a cartoDB table
+    :param table_name: the production table
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+        self.unchanged = 0
+        self.added_gfwids = []
+        self.removed_gfwids = []
+
+        # Source IDs (the temp ID field) to insert and cartodb_ids to delete
+        self.append_ids = []
+        self.delete_ids = []
+
+    def __str__(self):
+        return '{0}: {1} rows added, {2} removed, {3} unchanged'.format(self.table_name, len(self.append_ids),
+                                                                       len(self.delete_ids), self.unchanged)
+
+    def write(self, out_dir):
+        """
+        Write the report to a JSON file
+        :param out_dir: directory to write to
+        :return: path to the report
+        """
+        report_path = os.path.join(out_dir, 'cartodb_delta_{0}.json'.format(self.table_name))
+
+        with open(report_path, 'w') as f:
+            json.dump({'table': self.table_name, 'date': datetime.datetime.now().isoformat(),
+                       'added': len(self.append_ids), 'removed': len(self.delete_ids), 'unchanged': self.unchanged,
+                       'added_gfwids': sorted(set(self.added_gfwids)),
+                       'removed_gfwids': sorted(set(self.removed_gfwids))}, f, indent=4)
+
+        return report_path
+
+
+def get_column_types(client, table_name):
+    """
+    :param client: a CartoClient
+    :param table_name: cartoDB table
+    :return: dict of {column: cartoDB type}, i.e. number, string, date, boolean
+    """
+    fields = client.sql('SELECT * FROM {0} LIMIT 0'.format(table_name))['fields']
+
+    return dict((column, field_info.get('type')) for column, field_info in fields.iteritems())
+
+
+def hash_expression(column, carto_type):
+    """
+    SQL that formats a column the way format_value() does in python, so hashes built on the server and locally match
+    :param column: column name
+    :param carto_type: the cartoDB type of the column
+    :return: SQL expression that's never NULL
+    """
+    if carto_type == 'number':
+        expression = 'round({0}::numeric, {1})::text'.format(column, NUMBER_PLACES)
+
+    elif carto_type == 'date':
+        expression = """to_char({0}, 'YYYY-MM-DD"T"HH24:MI:SS')""".format(column)
+
+    elif carto_type == 'boolean':
+        expression = '{0}::text'.format(column)
+
+    else:
+        expression = "btrim({0}::text, ' ')".format(column)
+
+    return "coalesce({0}, '')".format(expression)
+
+
+def format_value(value, carto_type):
+    """
+    Format a value read from the source with OGR the way hash_expression() formats it in SQL. A value formatted
+    differently only means the row is deleted and inserted again, never that a change is missed
+    :param value: field value from OGR; dates as a list from GetFieldAsDateTime
+    :param carto_type: the cartoDB type of the column
+    :return: str
+    """
+    if value is None:
+        return ''
+
+    if carto_type == 'number':
+        try:
+            if isinstance(value, (int, long)):
+                return '{0}.{1}'.format(value, '0' * NUMBER_PLACES)
+
+            formatted = '{0:.{1}f}'.format(float(value), NUMBER_PLACES)
+
+            # Postgres numerics have no negative zero
+            return formatted.lstrip('-') if float(formatted) == 0 else formatted
+
+        except ValueError:
+            pass
+
+    elif carto_type == 'date' and isinstance(value, list):
+        return '{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}'.format(*[int(x) for x in value[:6]])
+
+    elif carto_type == 'boolean':
+        return 'true' if str(value).lower() in ['1', 'true', 't'] else 'false'
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return str(value).strip(' ')
+
+
+def remote_rows(client, table_name, columns, column_types, where_clause=None):
+    """
+    Read the cartodb_id, gfwid and a hash of the columns of every row in a cartoDB table, in one streamed query.
+    The hash is computed on the server, so only IDs and hashes come back
+    :param client: a CartoClient
+    :param table_name: cartoDB table
+    :param columns: columns to hash, in the same order as for local_rows()
+    :param column_types: dict of {column: cartoDB type}
+    :param where_clause: limits the rows compared (i.e. from merge_where_field)
+    :return: dict of {(gfwid, hash): [cartodb_ids]}
+    """
+    if columns:
+        hash_sql = 'md5({0})'.format(" || ".join(["{0} || '|'".format(hash_expression(x, column_types[x]))
+                                                   for x in columns]))
+    else:
+        hash_sql = "md5('')"
+
+    sql = "SELECT cartodb_id, coalesce(gfwid, '') AS gfwid, {0} AS attribute_hash FROM {1}".format(hash_sql,
+                                                                                                  table_name)
+
+    if where_clause:
+        sql += ' WHERE {0}'.format(where_clause)
+
+    rows = {}
+
+    for row in client.iter_rows(sql):
+        rows.setdefault((row['gfwid'], row['attribute_hash']), []).append(int(row['cartodb_id']))
+
+    return rows
+
+
+def local_rows(path, id_field, columns, column_types):
+    """
+    Read the ID, gfwid and a hash of the columns of every feature in an OGR datasource (the validated spatialite DB)
+    :param path: path to the datasource
+    :param id_field: the temp ID field, used to select the rows to upload
+    :param columns: cartoDB columns to hash, matched to source fields ignoring case
+    :param column_types: dict of {column: cartoDB type}
+    :return: dict of {(gfwid, hash): [IDs]}
+    """
+    datasource = ogr.Open(path)
+    layer = datasource.GetLayer(0)
+    layer_defn = layer.GetLayerDefn()
+
+    field_indexes = dict((layer_defn.GetFieldDefn(i).GetName().lower(), i) for i in range(layer_defn.GetFieldCount()))
+    date_types = [ogr.OFTDate, ogr.OFTDateTime]
+
+    column_indexes = [field_indexes[x.lower()] for x in columns]
+    gfwid_index = field_indexes['gfwid']
+    id_index = field_indexes[id_field.lower()]
+
+    rows = {}
+
+    for feature in layer:
+        values = []
+
+        for column, i in zip(columns, column_indexes):
+            if not feature.IsFieldSet(i) or feature.GetField(i) is None:
+                values.append('')
+
+            elif layer_defn.GetFieldDefn(i).GetType() in date_types:
+                values.append(format_value(feature.GetFieldAsDateTime(i), column_types[column]))
+
+            else:
+                values.append(format_value(feature.GetField(i), column_types[column]))
+
+        attribute_hash = hashlib.md5(''.join([x + '|' for x in values])).hexdigest()
+        gfwid = feature.GetField(gfwid_index) or ''
+
+        rows.setdefault((gfwid, attribute_hash), []).append(feature.GetField(id_index))
+
+    return rows
+
+
+def compare_columns(field_names, column_types):
+    """
+    :param field_names: field names in the source
+    :param column_types: dict of {column: cartoDB type} for the production table
+    :return: sorted list of the cartoDB columns the source also has, other than those cartoDB sets itself
+    """
+    field_names = [x.lower() for x in field_names]
+
+    return sorted([x for x in column_types if x.lower() in field_names and x.lower() not in SKIP_COLUMNS and
+                   column_types[x] != 'geometry'])
+
+
+def plan_delta(table_name, local, remote):
+    """
+    Work out which rows to delete from and insert into the table, the same way the esri outputs are compared
+    (util.diff_rows_by_key)
+    :param table_name: the production table
+    :param local: rows from local_rows()
+    :param remote: rows from remote_rows()
+    :return: a DeltaReport
+    """
+    report = DeltaReport(table_name)
+
+    to_delete, to_append = util.diff_rows_by_key(remote, local)
+
+    for key, id_list in to_delete.iteritems():
+        report.delete_ids.extend(id_list)
+        report.removed_gfwids.extend([key[0]] * len(id_list))
+
+    for key, id_list in to_append.iteritems():
+        report.append_ids.extend(id_list)
+        report.added_gfwids.extend([key[0]] * len(id_list))
+
+    report.unchanged = sum([len(x) for x in local.itervalues()]) - len(report.append_ids)
+
+    return report
+
+
+def source_fields(path):
+    """
+    :param path: path to an OGR datasource
+    :return: the field names of its first layer
+    """
+    datasource = ogr.Open(path)
+    layer_defn = datasource.GetLayer(0).GetLayerDefn()
+
+    return [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+
+
+def diff(client, path, table_name, id_field, where_clause=None):
+    """
+    Compare the validated source to the production table by gfwid and a hash of the columns they share
+    :param client: a CartoClient
+    :param path: path to the validated spatialite DB
+    :param table_name: the production table
+    :param id_field: the temp ID field in the source
+    :param where_clause: limits the rows compared in the production table
+    :return: a DeltaReport
+    """
+    column_types = get_column_types(client, table_name)
+    columns = compare_columns(source_fields(path), column_types)
+
+    logging.debug('Comparing rows by gfwid and columns {0}'.format(', '.join(columns)))
+
+    remote = remote_rows(client, table_name, columns, column_types, where_clause)
+    local = local_rows(path, id_field, columns, column_types)
+
+    report = plan_delta(table_name, local, remote)
+    logging.info('Delta for {0}'.format(report))
+
+    return report
@@ -0,0 +1,291 @@
+import heapq
+import logging
+import Queue
+import threading
+import time
+
+import util
+
+# Max chunks in flight at once, unless settings.ini says otherwise
+DEFAULT_MAX_WORKERS = 4
+
+# Smallest chunk we'll shrink to when the API is struggling
+MIN_CHUNK_ROWS = 50
+
+# Rows added to the chunk size after each round of fast, successful chunks
+CHUNK_ROWS_STEP = 50
+
+# A chunk that takes longer than this is treated like a failure: too much in flight, or chunks too big
+TARGET_LATENCY = 60
+
+# Backoff between retries of a failed chunk: 2^x seconds up to 8.5 minutes, giving up 5 hours after its first failure
+MAX_BACKOFF = 512
+MAX_RETRY_SECONDS = 5 * 60 * 60
+
+# Seconds between progress messages
+REPORT_INTERVAL = 60
+
+
+class Chunk(object):
+    """
+    A window of IDs to upload, and its retry state
+    """
+    def __init__(self, first_id, last_id, row_count, where_clause):
+        self.first_id = first_id
+        self.last_id = last_id
+        self.row_count = row_count
+        self.where_clause = where_clause
+
+        self.attempts = 0
+        self.first_failure = None
+        self.started = None
+
+    def __str__(self):
+        # ID lists get long; keep log messages readable
+        if len(self.where_clause) <= 100:
+            return self.where_clause
+
+        return '{0} rows with IDs {1} to {2}'.format(self.row_count, self.first_id, self.last_id)
+
+
+class RangePlanner(object):
+    """
+    Plans chunks as ranges of consecutive IDs, i.e. c_temp_id >= 1 and c_temp_id <= 500, over the IDs that exist
+    :param id_list: the row IDs to process
+    :param id_field: field to use to build the where clauses
+    :param row_sizes: size in bytes of each row in id_list; if given, also limits the bytes per chunk
+    :param max_bytes: max bytes per chunk
+    """
+    def __init__(self, id_list, id_field, row_sizes=None, max_bytes=None):
+        self.id_field = id_field
+        self.planner = util.IdWindowPlanner(id_list, row_sizes, max_bytes)
+
+    def remaining(self):
+        return self.planner.remaining()
+
+    def next_chunk(self, target_rows):
+        """
+        :param target_rows: max rows in this chunk
+        :return: a Chunk, or None when every ID has been handed out
+        """
+        window = self.planner.next_window(target_rows)
+
+        if not window:
+            return None
+
+        first_id, last_id, row_count = window
+
+        return Chunk(first_id, last_id, row_count, util.chunk_where_clause(self.id_field, first_id, last_id))
+
+
+class IdListPlanner(object):
+    """
+    Plans chunks as lists of IDs, i.e. cartodb_id IN (1, 5, 9), for when only some of the IDs in a range should be
+    selected
+    :param id_list: the row IDs to process
+    :param id_field: field to use to build the where clauses
+    """
+    def __init__(self, id_list, id_field):
+        self.id_list = sorted(id_list)
+        self.id_field = id_field
+        self.position = 0
+
+    def remaining(self):
+        return len(self.id_list) - self.position
+
+    def next_chunk(self, target_rows):
+        chunk_ids = self.id_list[self.position:self.position + target_rows]
+
+        if not chunk_ids:
+            return None
+
+        self.position += len(chunk_ids)
+        where_clause = '{0} IN ({1})'.format(self.id_field, ', '.join([str(x) for x in chunk_ids]))
+
+        return Chunk(chunk_ids[0], chunk_ids[-1], len(chunk_ids), where_clause)
+
+
+class AimdController(object):
+    """
+    Sets how many chunks are in flight and how big they are, like TCP congestion control: both grow a step at a
+    time while chunks succeed quickly, and are halved when a chunk fails or is slow
+    :param max_workers: most chunks in flight at once
+    :param max_rows: largest chunk, in rows
+    :param min_rows: smallest chunk, in rows
+    :param target_latency: seconds; a chunk slower than this counts as congestion
+    """
+    def __init__(self, max_workers, max_rows, min_rows=MIN_CHUNK_ROWS, target_latency=TARGET_LATENCY):
+        self.max_workers = max_workers
+        self.max_rows = max_rows
+        self.min_rows = min(min_rows, max_rows)
+        self.target_latency = target_latency
+
+        # Start with one chunk in flight and the largest chunk size, and grow the concurrency from there
+        self.workers = 1
+        self.chunk_rows = max_rows
+
+        self._successes = 0
+        self._last_decrease = 0
+
+    def on_success(self, chunk, latency):
+        if latency > self.target_latency:
+            self._decrease(chunk)
+            return
+
+        self._successes += 1
+
+        # One step per round, i.e. once every chunk in flight has come back
+        if self._successes >= self.workers:
+            self._successes = 0
+
+            self.workers = min(self.workers + 1, self.max_workers)
+            self.chunk_rows = min(self.chunk_rows + CHUNK_ROWS_STEP, self.max_rows)
+
+    def on_failure(self, chunk):
+        self._decrease(chunk)
+
+    def _decrease(self, chunk):
+        # Chunks sent before the last decrease were sent at the old rate; don't halve again for them
+        if chunk.started < self._last_decrease:
+            return
+
+        self._last_decrease = time.time()
+        self._successes = 0
+
+        self.workers = max(1, self.workers / 2)
+        self.chunk_rows = max(self.min_rows, self.chunk_rows / 2)
+
+        logging.debug('Backing off: {0} chunks in flight, {1} rows per chunk'.format(self.workers, self.chunk_rows))
+
+
+class UploadStats(object):
+    """
+    Throughput of an upload
+    """
+    def __init__(self):
+        self.start_time = time.time()
+
+        self.chunks = 0
+        self.rows = 0
+        self.retries = 0
+
+    def rows_per_second(self):
+        return self.rows / max(time.time() - self.start_time, 0.001)
+
+    def __str__(self):
+        return '{0} rows in {1} chunks in {2:.1f} seconds ({3:.0f} rows/second, {4} retries)'.format(
+            self.rows, self.chunks, time.time() - self.start_time, self.rows_per_second(), self.retries)
+
+
+def _run_chunk(execute_chunk, chunk, results):
+    try:
+        execute_chunk(chunk.where_clause)
+        results.put((chunk, None))
+
+    # Not just Exception: some helpers call sys.exit() on errors, and the scheduler has to hear about every chunk or it
+    # will wait forever
+    except BaseException as e:
+        results.put((chunk, e))
+
+
+def upload_chunks(planner, execute_chunk, max_workers, max_rows):
+    """
+    Run execute_chunk for each chunk from planner, keeping several chunks in flight. The number in flight and the
+    chunk size adapt to how fast chunks come back and whether they fail; failed chunks are retried on their own with
+    exponential backoff while the rest keep going
+    :param planner: a RangePlanner or IdListPlanner
+    :param execute_chunk: function that takes a where clause and processes the rows it selects
+    :param max_workers: most chunks in flight at once; 1 runs one chunk at a time, like before
+    :param max_rows: max rows per chunk
+    :return: an UploadStats
+    """
+    controller = AimdController(max_workers, max_rows)
+    stats = UploadStats()
+
+    results = Queue.Queue()
+
+    # Failed chunks waiting to be retried, as (time to retry, sequence, chunk)
+    retry_heap = []
+    retry_sequence = 0
+
+    in_flight = 0
+    fatal_error = None
+    last_report = time.time()
+
+    while True:
+        # Launch chunks until we're at the controller's concurrency: retries first, then new windows
+        while in_flight < controller.workers and not fatal_error:
+            if retry_heap and retry_heap[0][0] <= time.time():
+                chunk = heapq.heappop(retry_heap)[2]
+
+            else:
+                chunk = planner.next_chunk(controller.chunk_rows)
+
+                if not chunk:
+                    break
+
+            chunk.started = time.time()
+
+            thread = threading.Thread(target=_run_chunk, args=(execute_chunk, chunk, results))
+            thread.daemon = True
+            thread.start()
+
+            in_flight += 1
+
+        if not in_flight:
+            if fatal_error or not retry_heap:
+                break
+
+            # Nothing running; wait until the next retry is due
+            time.sleep(max(0, retry_heap[0][0] - time.time()))
+            continue
+
+        # Wake up when the next retry is due, even if nothing has finished
+        timeout = max(0.1, retry_heap[0][0] - time.time()) if retry_heap else None
+
+        try:
+            chunk, error = results.get(timeout=timeout) if timeout else results.get()
+        except Queue.Empty:
+            continue
+
+        in_flight -= 1
+
+        if error:
+            chunk.attempts += 1
+            controller.on_failure(chunk)
+
+            if not chunk.first_failure:
+                chunk.first_failure = time.time()
+
+            if time.time() - chunk.first_failure > MAX_RETRY_SECONDS:
+                logging.error('Giving up on {0} after {1} attempts'.format(chunk, chunk.attempts))
+
+                # Let the chunks in flight finish before raising, so nothing is left running
+                fatal_error = error
+                continue
+
+            backoff = min(2 ** chunk.attempts, MAX_BACKOFF)
+            logging.debug('Chunk {0} failed ({1}); retrying in {2} seconds'.format(chunk, error, backoff))
+
+            stats.retries += 1
+
+            heapq.heappush(retry_heap, (time.time() + backoff, retry_sequence, chunk))
+            retry_sequence += 1
+
+        else:
+            controller.on_success(chunk, time.time() - chunk.started)
+
+            stats.chunks += 1
+            stats.rows += chunk.row_count
+
+        if time.time() - last_report > REPORT_INTERVAL:
+            last_report = time.time()
+            logging.debug('Uploaded {0}; {1} rows left, {2} chunks in flight'.format(stats, planner.remaining(),
+                                                                                   in_flight))
+
+    if fatal_error:
+        raise fatal_error
+
+    logging.info('Uploaded {0}'.format(stats))
+
+    return stats
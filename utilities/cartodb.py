@@ -1,65 +1,84 @@
-import json
 import logging
 import os
+import sqlite3
 import sys
-import urllib
-import requests
 import arcpy
-from collections import OrderedDict
-from retrying import retry
 
 import util
+import carto_client
+import carto_copy
+import carto_delta
+import carto_uploader
 import settings
 import token_util
+import dataset_cache
+import geometry_repair
+import ogr_util
+
+# Max rows, and max bytes of geometry, per API transaction. Per the cartoDB developers, we keep rows at 500
+CARTO_CHUNK_ROWS = 500
+CARTO_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+# One client per environment, so every statement in a run reuses the same connections
+_clients = {}
 
 
 def get_api_key_and_url(gfw_env):
 
     key = token_util.get_token(settings.get_settings(gfw_env)['cartodb']['token'])
     api_url = settings.get_settings(gfw_env)["cartodb"]["sql_api"]
-    # sync_api = settings.get_settings(gfw_env)["cartodb"]["synchronization_api"]
 
-    return key, api_url#, sync_api
+    return key, api_url
 
 
-def cartodb_sql(sql, gfw_env):
+def get_client(gfw_env):
     """
-    Execute a SQL statement using the API
-    :param sql: a SQL statment
-    :param gfw_env: the gfw_env-- used to grab the correct API token
-    :return:
+    Get the CartoClient for this environment, creating it the first time it's used
+    :param gfw_env: the gfw_env-- used to grab the correct API token and URLs
+    :return: a CartoClient
     """
+    if gfw_env not in _clients:
+        carto_settings = settings.get_settings(gfw_env)['cartodb']
+        key, api_url = get_api_key_and_url(gfw_env)
 
-    logging.debug(sql)
-    key, api_url = get_api_key_and_url(gfw_env)
-
-    result = urllib.urlopen("{0!s}?api_key={1!s}&q={2!s}".format(api_url, key, sql))
-    print "{0!s}?api_key={1!s}&q={2!s}".format(api_url, key, sql)
-    json_result = json.loads(result.readlines()[0], object_pairs_hook=OrderedDict)
-
-    print json_result
+        _clients[gfw_env] = carto_client.CartoClient(api_url, key,
+                                                     sync_api=carto_settings.get('synchronization_api'),
+                                                     compress_requests=carto_settings.get('compress_requests',
+                                                                                          'FALSE') == 'TRUE')
 
-    if "error" in json_result.keys():
-        raise SyntaxError(json_result['error'])
+    return _clients[gfw_env]
 
-    return json_result
 
+def cartodb_sql(sql, gfw_env):
+    """
+    Execute a SQL statement using the API
+    :param sql: a SQL statment
+    :param gfw_env: the gfw_env-- used to grab the correct API token
+    :return: the JSON response
+    """
+    return get_client(gfw_env).sql(sql)
 
-def sqlite_row_count(sqlite_db):
 
-    ogrinfo = util.run_subprocess(['ogrinfo', '-q', sqlite_db])
+def sqlite_ids_and_sizes(sqlite_db, id_field):
+    """
+    Read the ID and geometry size of every row in a spatialite DB with a single table, to plan upload chunks
+    :param sqlite_db: path to the sqlite DB created by cartodb_make_valid_geom_local
+    :param id_field: the temp ID field
+    :return: tuple of lists (ids, sizes in bytes)
+    """
+    conn = sqlite3.connect(sqlite_db)
 
-    # Grab the first line from the ogrinfo command, split it, and take the second value
-    # Example ogrinfo output: "1: tiger_conservation_landscapes (Multi Polygon)"
-    table_name = ogrinfo[0].split()[1]
+    try:
+        table_name, geom_column = conn.execute('SELECT f_table_name, f_geometry_column '
+                                               'FROM geometry_columns').fetchone()
 
-    ogr_row_count_text = util.run_subprocess(['ogrinfo', sqlite_db, '-q',
-                                         '-sql', 'SELECT count(*) FROM {0}'.format(table_name)])
+        rows = conn.execute('SELECT {0}, length({1}) FROM {2}'.format(id_field, geom_column, table_name)).fetchall()
 
-    # Response looks like this ['', 'Layer  name: SELECT', 'OGRFeature(SELECT):0', 'count(*) (Integer) = 76', '']
-    row_count = int(ogr_row_count_text[-1].split(' = ')[1])
+    finally:
+        conn.close()
 
-    return row_count
+    return [x[0] for x in rows], [x[1] or 0 for x in rows]
 
 
 def get_layer_type(in_fc):
@@ -71,8 +90,7 @@ def get_layer_type(in_fc):
     """
 
     if os.path.splitext(in_fc)[1] == '.sqlite':
-        ogrinfo = util.run_subprocess(['ogrinfo', '-q', in_fc], log=False)
-        shapetype = ogrinfo[0].split('(')[1].lower()
+        shapetype = ogr_util.geometry_type(in_fc)
 
     else:
         shapetype = arcpy.Describe(in_fc).shapeType.lower()
@@ -88,7 +106,16 @@ def get_layer_type(in_fc):
     return layer_type
 
 
-def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw_env):
+def get_ingest_method(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: how staging tables are filled, from settings.ini: 'ogr2ogr' (one ogr2ogr append per chunk of rows) or
+    'copy' (stream the rows through the COPY endpoint)
+    """
+    return settings.get_settings(gfw_env)['cartodb'].get('ingest', 'ogr2ogr')
+
+
+def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw_env, id_list=None):
     """
     Create a new dataset/table on cartodb
     :param sqlite_path: path to sqlite database with geometry-cleaned FC
@@ -96,6 +123,7 @@ def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw
     :param output_table: name of the new table to create and push data to
     :param temp_id_field: temp id field that will be used to build where_clauses when uploading to cartodb
     :param gfw_env: the gfw-env-- required to pick the API key
+    :param id_list: temp ids of the rows to upload; None to upload everything
     :return:
     """
     logging.debug("upload data from {0} to staging table {1}".format(sqlite_path, output_table))
@@ -118,52 +146,44 @@ def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw
     else:
         cartodb_sql("select cdb_cartodbfytable('{0}', '{1}');".format(account_name, output_table), gfw_env)
 
-    # Count dataset rows and compare them to the append limit we're using for each API transaction
-    row_count = sqlite_row_count(sqlite_path)
+    # New table, and cdb_cartodbfytable adds columns to it
+    dataset_cache.invalidate(output_table, gfw_env)
+
+    if get_ingest_method(gfw_env) == 'copy':
+        # Stream every row through the COPY endpoint in a few large requests, then check the row count
+        target = carto_copy.CartoCopyTarget(get_client(gfw_env))
+        carto_copy.bulk_load(target, sqlite_path, output_table, get_column_order(output_table, gfw_env),
+                             id_field=temp_id_field, id_list=id_list)
 
-    # Use cartodb_execute_where_clause to generate where_clauses and append them with exponential backoff
-    cartodb_execute_where_clause(0, row_count, temp_id_field, sqlite_path, output_table, gfw_env)
+    elif id_list is not None:
+        # Only some of the rows; ranges of IDs would pick up the others in between
+        planner = carto_uploader.IdListPlanner(id_list, temp_id_field)
+        cartodb_run_chunks(planner, sqlite_path, output_table, gfw_env)
 
+    else:
+        # Read the IDs and geometry sizes so each API transaction stays under the row and size limits
+        id_list, row_sizes = sqlite_ids_and_sizes(sqlite_path, temp_id_field)
 
-def add_fc_to_ogr2ogr_cmd(in_path, cmd):
+        # Use cartodb_execute_where_clause to generate where_clauses and append them with exponential backoff
+        cartodb_execute_where_clause(id_list, temp_id_field, sqlite_path, output_table, gfw_env, row_sizes=row_sizes)
+
+
+def get_geometry_type_options(in_path):
     """
-    Add FC or spatialite DB to ogr2ogr, handling issue of different format for .shp vs GDB FC vs spatialite
-    Also add conversion from multiline string to singleline string if it's a line FC
+    ogr2ogr options to set the output geometry type: convert multiline strings to single line strings for line FCs,
+    and make everything multipolygons for polygon FCs
     :param in_path: path to shape/GDB/spatialite DB
-    :param cmd: current list of CMD parameters
-    :return: updated cmd list of parameters
+    :return: list of ogr2ogr options
     """
-
     layer_type = get_layer_type(in_path)
 
     if layer_type == 'LINE':
-        cmd += ['-nlt', 'LINESTRING']
+        return ['-nlt', 'LINESTRING']
 
     elif layer_type == 'POLYGON':
-        cmd += ['-nlt', 'MULTIPOLYGON']
+        return ['-nlt', 'MULTIPOLYGON']
 
-    # Check if the input FC is a GDB
-    if os.path.splitext(in_path)[1] == '':
-        cmd += [os.path.dirname(in_path), os.path.basename(in_path)]
-
-    else:
-        cmd += [in_path]
-
-    return cmd
-
-
-def add_where_clause_to_ogr2ogr_cmd(in_where_clause, cmd):
-    """
-    Add where clause to cmd list of parameters if it exists
-    :param in_where_clause: where clause
-    :param cmd: current list of CMD parameters
-    :return: updated cmd list of parameters
-    """
-    if in_where_clause:
-        cmd.insert(1, '-where')
-        cmd.insert(2, in_where_clause)
-
-    return cmd
+    return []
 
 
 def cartodb_append(sqlite_db_path, out_cartodb_name, gfw_env, where_clause=None):
@@ -180,13 +200,13 @@ def cartodb_append(sqlite_db_path, out_cartodb_name, gfw_env, where_clause=None)
 
     # Help: http://www.gdal.org/ogr2ogr.html
     # The -dim 2 option ensures that only two dimensional data is created; no Z or M values
-    cmd = [r'C:\Program Files\GDAL\ogr2ogr', '--config', 'CARTODB_API_KEY', key, '-append', '-skipfailures', '-t_srs', 'EPSG:4326',
-           '-f', 'CartoDB',  '-nln', out_cartodb_name, '-dim', '2', 'CartoDB:{0}'.format(account_name)]
+    options = ['-append', '-skipfailures', '-t_srs', 'EPSG:4326', '-f', 'CartoDB', '-nln', out_cartodb_name,
+               '-dim', '2'] + get_geometry_type_options(sqlite_db_path)
 
-    cmd = add_fc_to_ogr2ogr_cmd(sqlite_db_path, cmd)
-    cmd = add_where_clause_to_ogr2ogr_cmd(where_clause, cmd)
+    if where_clause:
+        options += ['-where', where_clause]
 
-    util.run_subprocess(cmd)
+    ogr_util.translate('CartoDB:{0}'.format(account_name), sqlite_db_path, options, {'CARTODB_API_KEY': key})
 
 
 def get_account_name(gfw_env):
@@ -197,55 +217,39 @@ def get_account_name(gfw_env):
 
 def cartodb_check_exists(table_name, gfw_env):
     """
-    Check if the table exists by executing a LIMIT 1 query against it
+    Check if the table exists by executing a LIMIT 1 query against it; cached for the run
     :param table_name: cartoDB table name
     :param gfw_env: gfw env
     :return: True | False
     """
-    sql = "SELECT * FROM {0} LIMIT 1".format(table_name)
-
-    try:
-        cartodb_sql(sql, gfw_env)
-        table_exists = True
-    except SyntaxError:
-        table_exists = False
-
-    return table_exists
+    return dataset_cache.carto_exists(table_name, gfw_env)
 
 
 def get_column_order(table_name, gfw_env):
     """
-    Get column order-- used to list fields for cartoDB datasets
+    Get column order-- used to list fields for cartoDB datasets; cached for the run
     :param table_name: cartoDB table
     :param gfw_env: gfw env
     :return: field list
     """
-    sql = 'SELECT * FROM {0} LIMIT 1'.format(table_name)
-
-    return cartodb_sql(sql, gfw_env)['fields'].keys()
+    return dataset_cache.carto_fields(table_name, gfw_env)
 
 
-def cartodb_min_max(table_name, gfw_env):
+def cartodb_ids(table_name, gfw_env):
     """
-    Get min/max id for cartodb_id in table
+    Get all cartodb_id values in a table
     :param table_name: cartoDB table
     :param gfw_env: gfw env
-    :return: int value of row count
+    :return: list of cartodb_ids
     """
-    sql = "SELECT min(cartodb_id) as a, max(cartodb_id) as b FROM {0}".format(table_name)
-    result = cartodb_sql(sql, gfw_env)['rows'][0]
-    print '\n\n'
-    print result
-    print '\n\n'
+    sql = "SELECT cartodb_id FROM {0}".format(table_name)
 
-    min_cartodb_id = result['a']
+    # Stream as CSV; a JSON response for a big table has to be held in memory all at once
+    id_list = [int(x['cartodb_id']) for x in get_client(gfw_env).iter_rows(sql)]
 
-    # Add 1 to this value so that it's included in any >= and < statements
-    max_cartodb_id = result['b'] + 1
+    logging.debug('Found {0} cartodb_ids in {1}'.format(len(id_list), table_name))
 
-    logging.debug('CartoDB ID min: {0}, max: {1}'.format(min_cartodb_id, max_cartodb_id))
-
-    return min_cartodb_id, max_cartodb_id
+    return id_list
 
 
 def cartodb_push_to_production(staging_table, production_table, gfw_env):
@@ -258,7 +262,7 @@ def cartodb_push_to_production(staging_table, production_table, gfw_env):
     """
     logging.debug("push staging to production table: {0}".format(production_table))
 
-    min_cartodb_id, max_cartodb_id = cartodb_min_max(staging_table, gfw_env)
+    id_list = cartodb_ids(staging_table, gfw_env)
 
     prod_columns = get_column_order(production_table, gfw_env)
     staging_columns = get_column_order(staging_table, gfw_env)
@@ -270,27 +274,55 @@ def cartodb_push_to_production(staging_table, production_table, gfw_env):
     sql = 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE {3}'
     format_tuple = (production_table, final_columns_sql, staging_table)
 
-    cartodb_execute_where_clause(min_cartodb_id, max_cartodb_id, 'cartodb_id', None, None, gfw_env, sql, format_tuple)
+    cartodb_execute_where_clause(id_list, 'cartodb_id', None, None, gfw_env, sql, format_tuple)
 
 
-def cartodb_execute_where_clause(start_row, end_row, id_field, src_fc, out_table, gfw_env, sql=None, format_tuple=None):
+def cartodb_execute_where_clause(id_list, id_field, src_fc, out_table, gfw_env, sql=None, format_tuple=None,
+                                 row_sizes=None):
     """
     Generates a where clause and executes it to append to a cartodb table or execute SQL against the API
-    :param start_row: first row ID of the where clause
-    :param end_row: last row ID
+    :param id_list: the row IDs to process; where clauses are planned from these so gaps in the IDs are skipped
     :param id_field: field to use to build integer where clauses
     :param src_fc: source FC, if appending from a local esri FC
     :param out_table: out table, if appending to a cartoDB table
     :param gfw_env: need to know which account to use
     :param sql: SQL statement to execute against the cartoDB API
     :param format_tuple: tuple to pass when formatting the SQL statement
+    :param row_sizes: size in bytes of each row in id_list; if given, also limits the bytes sent per transaction
     :return:
     """
-    for wc in util.generate_where_clause(start_row, end_row, id_field, 500):
-        cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc)
+    planner = carto_uploader.RangePlanner(id_list, id_field, row_sizes, CARTO_CHUNK_BYTES)
 
+    cartodb_run_chunks(planner, src_fc, out_table, gfw_env, sql, format_tuple)
 
-def cartodb_make_valid_geom_local(src_fc):
+
+def cartodb_run_chunks(planner, src_fc, out_table, gfw_env, sql=None, format_tuple=None):
+    """
+    Append to a cartodb table or execute SQL against the API for each where clause from a planner
+    :param planner: a carto_uploader RangePlanner or IdListPlanner
+    :param src_fc: source FC, if appending from a local esri FC
+    :param out_table: out table, if appending to a cartoDB table
+    :param gfw_env: need to know which account to use
+    :param sql: SQL statement to execute against the cartoDB API
+    :param format_tuple: tuple to pass when formatting the SQL statement
+    :return:
+    """
+    def execute_chunk(wc):
+        cartodb_execute_chunk(src_fc, out_table, gfw_env, sql, format_tuple, wc)
+
+    # Several chunks at a time; the uploader backs off and retries failed chunks on its own
+    carto_uploader.upload_chunks(planner, execute_chunk, get_upload_workers(gfw_env), CARTO_CHUNK_ROWS)
+
+
+def get_upload_workers(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: max chunks to upload at once, from settings.ini
+    """
+    return int(settings.get_settings(gfw_env)['cartodb'].get('upload_workers', carto_uploader.DEFAULT_MAX_WORKERS))
+
+
+def cartodb_make_valid_geom_local(src_fc, gfw_env):
 
     if os.path.splitext(src_fc)[1] == '.shp':
         source_dir = os.path.dirname(src_fc)
@@ -309,27 +341,23 @@ def cartodb_make_valid_geom_local(src_fc):
 
     out_sqlite_path = os.path.join(sqlite_dir, 'out.sqlite')
 
-    cmd = ['ogr2ogr', '-f', 'SQLite', out_sqlite_path]
-    cmd = add_fc_to_ogr2ogr_cmd(src_fc, cmd)
-    cmd += ["-dsco", "SPATIALITE=yes", '-dim', '2']
+    options = ['-f', 'SQLite', '-dsco', 'SPATIALITE=yes', '-dim', '2'] + get_geometry_type_options(src_fc)
 
     logging.debug('Creating sqlite database')
-    util.run_subprocess(cmd)
+    ogr_util.translate(out_sqlite_path, src_fc, options)
 
-    table_name = util.gen_paths_shp(src_fc)[2]
-    sql = 'UPDATE {0} SET GEOMETRY = ST_MakeValid(GEOMETRY) WHERE ST_IsValid(GEOMETRY) <> 1;'.format(table_name)
-    cmd = ['spatialite', out_sqlite_path, sql]
+    logging.debug('Created {0} with {1} features'.format(out_sqlite_path, ogr_util.feature_count(out_sqlite_path)))
 
-    util.run_subprocess(cmd)
+    # Geometries that were already checked when the source was repaired are skipped
+    geometry_repair.repair_ogr(out_sqlite_path, geometry_repair.get_workers(gfw_env))
+    ogr_util.invalidate(out_sqlite_path)
 
     return out_sqlite_path
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=512000, stop_max_delay=18000000)
-def cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc):
+def cartodb_execute_chunk(src_fc, out_table, gfw_env, sql, format_tuple, wc):
     """
-    Used to retry the ogr2ogr append/SQL query defined from by the where clause
-    Wait 2^x seconds between each retry, up to 8.5 minutes, then 8.5 minutes afterwards until we hit 5 hours
+    Run the ogr2ogr append/SQL query defined by the where clause. Retried by carto_uploader if it fails
     :param src_fc: the source fc, if appending
     :param out_table: the out table, if appending
     :param gfw_env: gfw_env to know which cartodb account
@@ -377,30 +405,72 @@ def delete_staging_table_if_exists(staging_table_name, in_gfw_env):
     sql = 'DROP TABLE IF EXISTS {0} CASCADE'.format(staging_table_name)
     cartodb_sql(sql, in_gfw_env)
 
+    dataset_cache.invalidate(staging_table_name, in_gfw_env)
+
+
+def get_full_replace_method(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: how a production table is replaced when there's no where clause, from settings.ini: 'truncate'
+    (truncate it, then push the staging table in chunks) or 'transaction' (delete its rows and insert the whole
+    staging table in one transaction)
+    """
+    return settings.get_settings(gfw_env)['cartodb'].get('full_replace', 'truncate')
+
+
+def cartodb_replace_in_transaction(staging_table, production_table, gfw_env):
+    """
+    Replace the rows of the production table with the staging table's in a single transaction: delete every row,
+    then insert everything from staging. The production table itself is kept, along with its cartoDB metadata,
+    grants, indexes and dependent views. DELETE, unlike TRUNCATE, doesn't lock out readers, so map and tile queries
+    keep seeing the old rows until the transaction commits, then the new ones; never an empty or partial table. If
+    the statement fails (i.e. times out), it rolls back and production is unchanged. The table is vacuumed
+    afterwards to reclaim the deleted rows
+    :param staging_table: staging table, fully loaded
+    :param production_table: prod table
+    :param gfw_env: gfw env
+    :return:
+    """
+    logging.debug("replace production table {0} with staging table {1}".format(production_table, staging_table))
+
+    prod_columns = get_column_order(production_table, gfw_env)
+    staging_columns = get_column_order(staging_table, gfw_env)
+
+    # Find the columns they have in common, excluding cartodb_id
+    final_columns_sql = ', '.join([x for x in prod_columns if x in staging_columns if x != 'cartodb_id'])
 
-def ogrinfo_min_max(input_fc, oid_fieldname):
-    input_table_name = os.path.basename(os.path.splitext(input_fc)[0])
+    statements = ['BEGIN',
+                  'DELETE FROM {0}'.format(production_table),
+                  'INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(production_table, final_columns_sql,
+                                                                     staging_table),
+                  'COMMIT']
 
-    # ogrinfo doesn't recognize OBJECTID in these cases, apparently
-    # Also need to only have the GDB as an input, doesn't want entire FC path
-    if '.gdb' in input_fc:
-        oid_fieldname = 'FID'
-        input_fc = os.path.dirname(input_fc)
+    cartodb_sql(';\n'.join(statements) + ';', gfw_env)
 
-    sql_statement = 'SELECT min({0}), max({0}) FROM {1}'.format(oid_fieldname, input_table_name)
-    ogrinfo = util.run_subprocess([r'C:\Program Files\GDAL\ogrinfo', input_fc, '-sql', sql_statement])
+    # VACUUM can't run in a transaction, and needs to own the table; the new rows are in either way
+    try:
+        cartodb_sql('VACUUM ANALYZE {0}'.format(production_table), gfw_env)
 
-    # Grab the last two lines with data
-    result_lines = ogrinfo[-2:]
+    except SyntaxError as e:
+        logging.warning('Unable to vacuum {0} ({1}); analyzing it instead'.format(production_table, e))
+        cartodb_sql('ANALYZE {0}'.format(production_table), gfw_env)
 
-    # Result lines look like `MIN_FID (Integer) = 0`
-    # Split them at the ' = ' and grab the result then convert to int()
-    result_vals = [int(l.split(' = ')[1]) for l in result_lines]
+    dataset_cache.invalidate(production_table, gfw_env)
 
-    return result_vals[0], result_vals[1]
 
+def cartodb_delete_ids(production_table, cartodb_id_list, gfw_env):
+    """
+    Delete rows from a cartoDB table by cartodb_id
+    :param production_table: prod table
+    :param cartodb_id_list: cartodb_ids to delete
+    :param gfw_env: gfw env
+    :return:
+    """
+    planner = carto_uploader.IdListPlanner(cartodb_id_list, 'cartodb_id')
+    cartodb_run_chunks(planner, None, None, gfw_env, 'DELETE FROM {0} WHERE {1}', (production_table, ))
 
-def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace):
+
+def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace, differential=False):
     """
     Function called by VectorLayer and other Layer objects as part of layer.update()
     Will carry out the sync process from start to finish-- pushing the shp to a staging table on cartodb, then
@@ -410,6 +480,8 @@ def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace
     :param where_clause: where_clause to use when adding/deleting from final prod table
     :param gfw_env: gfw env
     :param scratch_workspace: scratch workspace
+    :param differential: only delete and insert the rows that changed, comparing by gfwid and a hash of the
+    attributes. Needs a gfwid column in the source and the production table
     :return:
     """
 
@@ -425,13 +497,42 @@ def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace
     # Create a temp ID field (set equal to OBJECTID) that we'll use to manage pushing to cartodb incrementally
     temp_id_field = util.create_temp_id_field(shp, gfw_env)
 
-    validated_fc_in_sqlite = cartodb_make_valid_geom_local(shp)
+    validated_fc_in_sqlite = cartodb_make_valid_geom_local(shp, gfw_env)
+
+    if differential and 'gfwid' in get_column_order(production_table, gfw_env) and \
+            'gfwid' in [x.lower() for x in carto_delta.source_fields(validated_fc_in_sqlite)]:
+
+        delta = carto_delta.diff(get_client(gfw_env), validated_fc_in_sqlite, production_table, temp_id_field,
+                                 where_clause)
+        logging.debug('Wrote delta report to {0}'.format(delta.write(scratch_workspace)))
+
+        # Stage only the new and changed rows, delete the changed and vanished ones, then push
+        cartodb_create(validated_fc_in_sqlite, production_table, staging_table, temp_id_field, gfw_env,
+                       delta.append_ids)
+
+        cartodb_delete_ids(production_table, delta.delete_ids, gfw_env)
+
+        cartodb_push_to_production(staging_table, production_table, gfw_env)
+        dataset_cache.invalidate(production_table, gfw_env)
+
+        delete_staging_table_if_exists(staging_table, gfw_env)
+
+        return
 
     cartodb_create(validated_fc_in_sqlite, production_table, staging_table, temp_id_field, gfw_env)
 
+    # Full replacement: refill production from the finished staging table in one transaction, rather than
+    # truncating it and pushing in chunks
+    if not where_clause and get_full_replace_method(gfw_env) == 'transaction':
+        cartodb_replace_in_transaction(staging_table, production_table, gfw_env)
+        delete_staging_table_if_exists(staging_table, gfw_env)
+
+        return
+
     cartodb_delete_where_clause_or_truncate_prod_table(production_table, where_clause, gfw_env)
 
     cartodb_push_to_production(staging_table, production_table, gfw_env)
+    dataset_cache.invalidate(production_table, gfw_env)
 
     delete_staging_table_if_exists(staging_table, gfw_env)
 
@@ -441,29 +542,4 @@ def cartodb_force_sync(gfw_env, table_name):
     :param gfw_env: gfw_env
     :param table_name: carto table name
     """
-
-    key, api_url, sync_api = get_api_key_and_url(gfw_env)
-
-    #get synced tables data
-    get_tables_url = ("{0!s}/?api_key={1!s}".format(sync_api, key))
-
-    r = requests.get(get_tables_url)
-    table_data = r.json()
-
-    #get sync table id
-    for entry in table_data['synchronizations']:
-        if entry['name'] == table_name:
-            table_id = entry['id']
-
-    #force table sync
-    sync_tables_url = ("{0!s}/{1!s}/sync_now?api_key={2!s}".format(sync_api, table_id, key))
-
-    r = requests.put(sync_tables_url)
-    status = r.status_code
-
-    if status == 200:
-        logging.debug("Sync Table Success for {}".format(table_name))
-    else:
-        print r.text
-        logging.debug(r.text)
-        raise ValueError('Request failed with code: {}'.format(status))
+    get_client(gfw_env).force_sync(table_name)
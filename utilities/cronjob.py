@@ -1,14 +1,21 @@
-import subprocess
+import os
 import datetime
 import argparse
 import calendar
 
 import google_sheet as gs
 import email_stats
+import logger
+import scheduler
+import settings
 
 parser = argparse.ArgumentParser(description='Pass environment to kick off gfw-sync cron job.')
 parser.add_argument('--environment', '-e', default='staging', choices=('staging', 'prod'),
                     help='the environment/config files to use for this run')
+parser.add_argument('--workers', '-w', type=int,
+                    help='number of layers to run at once; defaults to the scheduler workers in settings.ini')
+parser.add_argument('--verbose', '-v', default='info', choices=('debug', 'info', 'warning', 'error'),
+                    help='logging level for the scheduler\'s own messages')
 args = parser.parse_args()
 
 
@@ -66,18 +73,74 @@ def parse_update_freq(field_text):
 
 
 def main():
+    # Scheduler messages go to the daily log with the layers' logs, so email_stats sees them
+    logger.build_logger(args.verbose)
+
+    env_settings = settings.get_settings(args.environment)
+
+    # Download the config table once and share the snapshot with every gfw-sync.py run in this batch
+    scratch_workspace = env_settings['paths']['scratch_workspace']
+    snapshot_path = os.path.join(scratch_workspace, 'config_snapshot_{0}.json'.format(args.environment))
+
+    # Each run appends its config table updates to its own journal; we write them all to the sheet
+    # in one batch at the end
+    journal_dir = os.path.join(scratch_workspace, 'config_updates_{0}'.format(args.environment))
+
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    gs.use_snapshot(snapshot_path)
+    gs.get_snapshot(args.environment, refresh=True)
+
+    # Write anything left over from a batch that didn't finish
+    gs.apply_update_journal(list_journals(journal_dir))
+
     all_layer_dict = gs.sheet_to_dict(args.environment)
 
-    for layername, layerdef in all_layer_dict.iteritems():
+    workers = args.workers or int(env_settings['scheduler']['workers'])
+    log_dir = os.path.join(os.getcwd(), 'logs')
+
+    layer_scheduler = scheduler.LayerScheduler(workers, env_settings['scheduler']['resources'], log_dir)
+
+    layers_per_process = int(env_settings['scheduler'].get('layers_per_process', 1))
+
+    # Layers that need the same resources can't overlap anyway, so run them in the same gfw-sync.py process
+    batches = {}
+
+    for layername, layerdef in sorted(all_layer_dict.iteritems()):
 
         update_layer_today = parse_update_freq(layerdef['update_days'])
 
         if update_layer_today:
+            resource_classes = tuple(scheduler.get_resource_classes(layerdef))
+            batches.setdefault(resource_classes, []).append(layername)
+
+    for resource_classes, layer_list in batches.iteritems():
+        for i in range(0, len(layer_list), layers_per_process):
+            batch = layer_list[i:i + layers_per_process]
+
             python_exe = r'C:\PYTHON27\ArcGIS10.6\python'
-            subprocess.call([python_exe, 'gfw-sync.py', '-l', layername, '-e', args.environment])
+            journal_path = os.path.join(journal_dir, batch[0] + '.jsonl')
+
+            cmd = [python_exe, 'gfw-sync.py', '-l', ','.join(batch), '-e', args.environment,
+                   '-s', snapshot_path, '-j', journal_path]
+
+            layer_scheduler.add_layer(','.join(batch), cmd, list(resource_classes))
+
+    layer_scheduler.run()
+
+    gs.apply_update_journal(list_journals(journal_dir))
 
     email_stats.send_summary()
 
 
+def list_journals(journal_dir):
+    """
+    :param journal_dir: dir with config table update journals from gfw-sync.py runs
+    :return: list of journal paths
+    """
+    return [os.path.join(journal_dir, x) for x in os.listdir(journal_dir) if os.path.splitext(x)[1] == '.jsonl']
+
+
 if __name__ == '__main__':
     main()
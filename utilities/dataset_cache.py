@@ -0,0 +1,127 @@
+import logging
+import os
+
+import arcpy
+
+import cartodb
+
+# Per-run caches of dataset probes. Esri datasets are keyed by normalized path, cartoDB tables by (gfw_env, table)
+_exists_cache = {}
+_describe_cache = {}
+_fields_cache = {}
+_carto_fields_cache = {}
+
+
+def _path_key(input_dataset):
+    return os.path.normcase(os.path.normpath(input_dataset))
+
+
+def exists(input_dataset):
+    """
+    Memoized arcpy.Exists
+    :param input_dataset: path to an esri dataset
+    :return: True | False
+    """
+    key = _path_key(input_dataset)
+
+    if key not in _exists_cache:
+        _exists_cache[key] = arcpy.Exists(input_dataset)
+
+    return _exists_cache[key]
+
+
+def describe(input_dataset):
+    """
+    Memoized arcpy.Describe. The describe object reflects the dataset when it was first described, so stages that
+    write to a dataset must call invalidate() afterwards
+    :param input_dataset: path to an esri dataset
+    :return: arcpy describe object
+    """
+    key = _path_key(input_dataset)
+
+    if key not in _describe_cache:
+        _describe_cache[key] = arcpy.Describe(input_dataset)
+
+    return _describe_cache[key]
+
+
+def esri_fields(input_dataset):
+    """
+    Memoized field names for an esri dataset
+    :param input_dataset: path to an esri dataset
+    :return: list of field names
+    """
+    key = _path_key(input_dataset)
+
+    if key not in _fields_cache:
+        _fields_cache[key] = [x.name for x in arcpy.ListFields(input_dataset)]
+
+    return list(_fields_cache[key])
+
+
+def carto_fields(table_name, gfw_env):
+    """
+    Memoized field names for a cartoDB table. Checking if the table exists and listing its columns both run the
+    same LIMIT 1 query, so one round trip answers both
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return: list of field names, or None if the table doesn't exist
+    """
+    key = (gfw_env, table_name)
+
+    if key not in _carto_fields_cache:
+        sql = "SELECT * FROM {0} LIMIT 1".format(table_name)
+
+        try:
+            _carto_fields_cache[key] = cartodb.cartodb_sql(sql, gfw_env)['fields'].keys()
+        except SyntaxError:
+            _carto_fields_cache[key] = None
+
+    fields = _carto_fields_cache[key]
+
+    if fields is None:
+        return None
+    else:
+        return list(fields)
+
+
+def carto_exists(table_name, gfw_env):
+    """
+    Memoized cartodb_check_exists
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return: True | False
+    """
+    return carto_fields(table_name, gfw_env) is not None
+
+
+def invalidate(input_dataset, gfw_env=None):
+    """
+    Drop everything we know about a dataset. Call this after writing to it (adding fields, appending, etc)
+    :param input_dataset: path to an esri dataset or a cartoDB table name
+    :param gfw_env: gfw env, if this is a cartoDB table
+    """
+    if not input_dataset:
+        return
+
+    logging.debug('Clearing cached dataset info for {0}'.format(input_dataset))
+
+    key = _path_key(input_dataset)
+
+    for cache in [_exists_cache, _describe_cache, _fields_cache]:
+        cache.pop(key, None)
+
+    if gfw_env:
+        _carto_fields_cache.pop((gfw_env, input_dataset), None)
+
+    else:
+        for carto_key in [k for k in _carto_fields_cache.keys() if k[1] == input_dataset]:
+            del _carto_fields_cache[carto_key]
+
+
+def clear():
+    """
+    Drop all cached dataset info
+    """
+    for cache in [_exists_cache, _describe_cache, _fields_cache, _carto_fields_cache]:
+        cache.clear()
@@ -0,0 +1,538 @@
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from retrying import retry
+
+import settings
+
+# Bytes read from the network and written to disk at a time
+BUFFER_SIZE = 1024 * 1024
+
+# Files smaller than this per segment aren't worth splitting
+MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+
+# Segments per file, and files at once, unless settings.ini says otherwise
+DEFAULT_SEGMENT_WORKERS = 4
+DEFAULT_FILE_WORKERS = 4
+
+# Bytes downloaded between saves of a partial download's progress
+STATE_INTERVAL = 16 * 1024 * 1024
+
+# Cached files not used for this many days are evicted, then the least recently used until the cache is under
+# the size cap, unless settings.ini says otherwise
+DEFAULT_CACHE_MAX_DAYS = 30
+DEFAULT_CACHE_MAX_GB = 50
+
+# Files used this recently are never evicted, as another process (an Imazon worker or another layer) may be using them
+MIN_CACHE_AGE = 60 * 60
+
+# One session per thread, so each keeps its connections open between requests
+_local = threading.local()
+
+
+class DownloadChangedError(Exception):
+    """
+    The file on the server changed part way through a download
+    """
+    pass
+
+
+def get_session():
+    if not hasattr(_local, 'session'):
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=DEFAULT_SEGMENT_WORKERS))
+        session.mount('https://', HTTPAdapter(pool_maxsize=DEFAULT_SEGMENT_WORKERS))
+
+        _local.session = session
+
+    return _local.session
+
+
+def get_download_settings(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: tuple of (cache dir, segments per file, files at once, max bytes in the cache, max seconds since a
+    cached file was used)
+    """
+    gfw_settings = settings.get_settings(gfw_env)
+    download_settings = gfw_settings.get('download', {})
+
+    cache_dir = os.path.join(gfw_settings['paths']['scratch_workspace'], 'download_cache')
+    segment_workers = int(download_settings.get('segment_workers', DEFAULT_SEGMENT_WORKERS))
+    file_workers = int(download_settings.get('file_workers', DEFAULT_FILE_WORKERS))
+    max_bytes = int(float(download_settings.get('cache_max_gb', DEFAULT_CACHE_MAX_GB)) * 1024 ** 3)
+    max_age = int(float(download_settings.get('cache_max_days', DEFAULT_CACHE_MAX_DAYS)) * 24 * 60 * 60)
+
+    return cache_dir, segment_workers, file_workers, max_bytes, max_age
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    # Write then rename, so a crash never leaves half a file behind. The temp name is per thread, as the same cache
+    # entry can be written by more than one
+    temp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+
+    _replace(temp_path, path)
+
+
+def _replace(src, dst):
+    # os.rename won't overwrite on Windows
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    os.rename(src, dst)
+
+
+def plan_segments(size, workers):
+    """
+    :param size: bytes in the file
+    :param workers: most segments
+    :return: list of segments, as dicts of start, end (inclusive) and offset (the next byte to download)
+    """
+    segment_count = max(1, min(workers, size // MIN_SEGMENT_SIZE))
+    segment_size = -(-size // segment_count)
+
+    segments = []
+
+    for start in range(0, size, segment_size):
+        segments.append({'start': start, 'end': min(start + segment_size, size) - 1, 'offset': start})
+
+    return segments
+
+
+class _Progress(object):
+    """
+    Saves a partial download's segment offsets every STATE_INTERVAL bytes, so it can be resumed
+    """
+    def __init__(self, state, state_path):
+        self.state = state
+        self.state_path = state_path
+
+        self.lock = threading.RLock()
+        self.unsaved = 0
+
+    def add(self, byte_count):
+        with self.lock:
+            self.unsaved += byte_count
+
+            if self.unsaved >= STATE_INTERVAL:
+                self.save()
+
+    def save(self):
+        with self.lock:
+            _write_json(self.state_path, self.state)
+            self.unsaved = 0
+
+
+def _is_retryable(exception):
+    # Asking again won't help if the file has changed
+    return not isinstance(exception, DownloadChangedError)
+
+
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=60000, stop_max_attempt_number=8,
+       retry_on_exception=_is_retryable)
+def _fetch_segment(url, part_path, segment, validator, progress):
+    """
+    Download one byte range into its place in the partial file, from where it left off
+    """
+    if segment['offset'] > segment['end']:
+        return
+
+    headers = {'Range': 'bytes={0}-{1}'.format(segment['offset'], segment['end'])}
+
+    # If the file has changed, the server sends all of it (200) instead of the range (206)
+    if validator:
+        headers['If-Range'] = validator
+
+    r = get_session().get(url, headers=headers, stream=True, timeout=60)
+
+    try:
+        if r.status_code == 200:
+            raise DownloadChangedError('{0} changed on the server during the download'.format(url))
+
+        r.raise_for_status()
+
+        # Unbuffered, so every byte counted in the saved offsets is with the OS
+        with open(part_path, 'r+b', 0) as f:
+            f.seek(segment['offset'])
+
+            for chunk in r.iter_content(BUFFER_SIZE):
+                f.write(chunk)
+
+                segment['offset'] += len(chunk)
+                progress.add(len(chunk))
+
+    finally:
+        r.close()
+
+    if segment['offset'] <= segment['end']:
+        raise IOError('Connection closed with {0} bytes of {1} left'.format(segment['end'] - segment['offset'] + 1,
+                                                                           url))
+
+
+def _download_segments(url, part_path, state, state_path):
+    segments = [x for x in state['segments'] if x['offset'] <= x['end']]
+
+    if not segments:
+        return
+
+    validator = state['etag'] or state['last_modified']
+
+    progress = _Progress(state, state_path)
+    progress.save()
+
+    pool = ThreadPool(len(segments))
+
+    try:
+        pool.map(lambda x: _fetch_segment(url, part_path, x, validator, progress), segments)
+
+    finally:
+        pool.close()
+        pool.join()
+
+        # Whatever happened, save how far each segment got
+        progress.save()
+
+
+def _is_s3(headers):
+    return 'x-amz-request-id' in headers or headers.get('Server') == 'AmazonS3'
+
+
+def _expected_md5(headers):
+    """
+    :return: the file's md5 hex digest if the server tells us it: Content-MD5, or the ETag of an S3 object. S3 ETags
+    are the md5 of objects uploaded in one part, unless they're encrypted with KMS; other servers' ETags are opaque,
+    even when they look like an md5
+    """
+    if headers.get('Content-MD5'):
+        return base64.b64decode(headers['Content-MD5']).encode('hex')
+
+    if not _is_s3(headers) or headers.get('x-amz-server-side-encryption') == 'aws:kms':
+        return None
+
+    # Multipart uploads have ETags like {md5 of the part md5s}-{part count}, which this skips
+    etag = (headers.get('ETag') or '').strip('"')
+
+    if len(etag) == 32 and all(x in '0123456789abcdef' for x in etag.lower()):
+        return etag.lower()
+
+    return None
+
+
+def _file_md5(path):
+    h = hashlib.md5()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), ''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def fetch(url, cache_dir, workers=DEFAULT_SEGMENT_WORKERS):
+    """
+    Get a URL into the download cache. If it's already cached, the server is asked whether it has changed
+    (If-None-Match/If-Modified-Since) and it's only downloaded again if it has. Large files on servers that accept
+    range requests are downloaded in several segments at once, and a download that's interrupted picks up where it
+    left off next time, as long as the file hasn't changed
+    :param url: the URL
+    :param cache_dir: dir to cache downloads in
+    :param workers: most segments to download at once
+    :return: path to the cached file
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    data_path = os.path.join(cache_dir, hashlib.md5(url).hexdigest())
+    meta_path = data_path + '.json'
+    part_path = data_path + '.part'
+    state_path = part_path + '.json'
+
+    meta = _read_json(meta_path) if os.path.exists(data_path) else None
+    headers = {}
+
+    # Outputs are hard links to the cached file, so writing to one would change the cache too
+    if meta and meta.get('mtime') != os.path.getmtime(data_path):
+        logging.info('The cached copy of {0} has been modified; downloading it again'.format(url))
+        meta = None
+
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    r = get_session().get(url, headers=headers, stream=True, timeout=60)
+
+    if r.status_code == 304:
+        r.close()
+        logging.info('{0} is unchanged since it was downloaded; using the cached copy'.format(url))
+
+        meta['last_used'] = time.time()
+        _write_json(meta_path, meta)
+
+        return data_path
+
+    r.raise_for_status()
+
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    expected_md5 = _expected_md5(r.headers)
+
+    # Content-Length is the compressed size if the server compresses the response
+    size = None
+
+    if r.headers.get('Content-Length') and not r.headers.get('Content-Encoding'):
+        size = int(r.headers['Content-Length'])
+
+    start_time = time.time()
+
+    if size and r.headers.get('Accept-Ranges') == 'bytes':
+        r.close()
+
+        state = _read_json(state_path)
+
+        if (state and os.path.exists(part_path) and state['size'] == size and state['etag'] == etag and
+                state['last_modified'] == last_modified and (etag or last_modified)):
+            remaining = sum([x['end'] - x['offset'] + 1 for x in state['segments']])
+            logging.info('Resuming download of {0}; {1} of {2} bytes left'.format(url, remaining, size))
+
+        else:
+            state = {'url': url, 'size': size, 'etag': etag, 'last_modified': last_modified,
+                     'segments': plan_segments(size, workers)}
+
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+
+        logging.info("Downloading {0!s} in {1} segments".format(url, len(state['segments'])))
+        _download_segments(url, part_path, state, state_path)
+
+    else:
+        logging.info("Downloading {0!s}".format(url))
+
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in r.iter_content(BUFFER_SIZE):
+                    f.write(chunk)
+        finally:
+            r.close()
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise IOError('Downloaded {0} bytes of {1}, expected {2}'.format(os.path.getsize(part_path), url, size))
+
+    if expected_md5 and _file_md5(part_path) != expected_md5:
+        os.remove(part_path)
+        raise IOError('Checksum of {0} does not match the server'.format(url))
+
+    _replace(part_path, data_path)
+
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    _write_json(meta_path, {'url': url, 'etag': etag, 'last_modified': last_modified, 'size': size,
+                            'md5': expected_md5, 'mtime': os.path.getmtime(data_path), 'last_used': time.time()})
+
+    logging.debug("Download complete in {0:.1f} seconds.".format(time.time() - start_time))
+
+    return data_path
+
+
+def evict(cache_dir, max_bytes, max_age, keep=None):
+    """
+    Remove cached files that haven't been used for max_age seconds, then the least recently used until the cache
+    holds at most max_bytes. Partial downloads are removed once they're max_age old. Files used in the last
+    MIN_CACHE_AGE seconds are kept regardless
+    :param cache_dir: the download cache
+    :param max_bytes: most bytes to keep
+    :param max_age: most seconds since a file was last used
+    :param keep: paths to cached files to keep regardless, i.e. the ones just downloaded
+    """
+    if not os.path.exists(cache_dir):
+        return
+
+    keep = set([os.path.abspath(x) for x in keep or []])
+    now = time.time()
+
+    entries = []
+
+    for fname in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, fname)
+
+        try:
+            mtime = os.path.getmtime(path)
+
+            # Partial downloads and their saved progress, and temp files left by a crash
+            if fname.endswith('.part') or fname.endswith('.part.json') or fname.endswith('.tmp'):
+                if now - mtime > max_age:
+                    _remove_cache_files(path)
+                continue
+
+            if '.' in fname:
+                continue
+
+            meta = _read_json(path + '.json') or {}
+            size = os.path.getsize(path)
+
+        except (OSError, ValueError):
+            # Removed by another process as we went
+            continue
+
+        # The file is renamed into place before its metadata is written, so it may be newer than last_used
+        last_used = max(meta.get('last_used', 0), mtime)
+
+        if path not in keep and now - last_used > MIN_CACHE_AGE:
+            entries.append((last_used, size, path))
+
+    total_bytes = sum([x[1] for x in entries])
+
+    evicted_count = 0
+    evicted_bytes = 0
+
+    for last_used, size, path in sorted(entries):
+        if now - last_used <= max_age and total_bytes - evicted_bytes <= max_bytes:
+            break
+
+        _remove_cache_files(path, path + '.json')
+
+        evicted_count += 1
+        evicted_bytes += size
+
+    if evicted_count:
+        logging.info('Evicted {0} files ({1} bytes) from the download cache'.format(evicted_count, evicted_bytes))
+
+
+def _remove_cache_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link a cached file into the output dir, so large downloads aren't written twice. The cache only ever
+    replaces files by renaming a new file into place, so an update never changes a file already linked somewhere
+    else, and fetch downloads a file again if its output was written to. Falls back to a copy where links aren't
+    possible, i.e. across volumes
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    try:
+        if hasattr(os, 'link'):
+            os.link(src, dst)
+        else:
+            # os.link is Unix only in python 2
+            import win32file
+            win32file.CreateHardLink(dst, src)
+
+        return
+
+    except Exception as e:
+        logging.debug('Unable to link {0} to {1} ({2}); copying it instead'.format(src, dst, e))
+
+    shutil.copyfile(src, dst)
+
+
+def _download(url, output_dir, cache_dir, segment_workers):
+    fname = os.path.split(url)[1]
+    path = os.path.join(output_dir, fname)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    cached_path = fetch(url, cache_dir, segment_workers)
+
+    logging.debug('Linking {0} to {1}'.format(cached_path, path))
+    _link_or_copy(cached_path, path)
+
+    return path, cached_path
+
+
+def download(url, output_dir, gfw_env='prod'):
+    """
+    Download a URL to a dir, through the download cache
+    :param url: the URL
+    :param output_dir: dir to download to
+    :param gfw_env: gfw env, for the settings
+    :return: path to the downloaded file
+    """
+    cache_dir, segment_workers, file_workers, max_bytes, max_age = get_download_settings(gfw_env)
+
+    path, cached_path = _download(url, output_dir, cache_dir, segment_workers)
+    evict(cache_dir, max_bytes, max_age, [cached_path])
+
+    return path
+
+
+def download_all(url_list, output_dir, gfw_env='prod'):
+    """
+    Download several URLs at once
+    :param url_list: list of URLs
+    :param output_dir: dir to download to
+    :param gfw_env: gfw env, for the settings
+    :return: list of paths to the downloaded files, in the same order as url_list
+    """
+    if not url_list:
+        return []
+
+    cache_dir, segment_workers, file_workers, max_bytes, max_age = get_download_settings(gfw_env)
+
+    pool = ThreadPool(min(file_workers, len(url_list)))
+
+    try:
+        results = pool.map(lambda x: _download(x, output_dir, cache_dir, segment_workers), url_list)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    evict(cache_dir, max_bytes, max_age, [x[1] for x in results])
+
+    return [x[0] for x in results]
+
+
+def main():
+    """
+    Download URLs through a download cache, i.e. to test against a local HTTP server. Run it twice to see the
+    conditional requests, or interrupt it to see a download resume
+    """
+    parser = argparse.ArgumentParser(description='Download files in parallel segments, with a cache.')
+    parser.add_argument('urls', nargs='+', help='URLs to download')
+    parser.add_argument('--output-dir', '-o', required=True, help='dir to download to')
+    parser.add_argument('--cache-dir', '-c', required=True, help='dir to cache downloads in')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_SEGMENT_WORKERS, help='segments per file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    for url in args.urls:
+        _download(url, args.output_dir, args.cache_dir, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import logging
+import os
+
+import arcpy
+
+import dataset_cache
+import settings
+
+# Shapefile components can't be larger than this (the same limit archive.all_files_less_than_2gb checks)
+SHP_MAX_BYTES = 2e9
+
+# Estimates above this fraction of the limit are exported to the large format, to leave room for estimate error
+SAFETY_MARGIN = 0.8
+
+# Geometries read to estimate the average size of a .shp record, spread evenly across the OID range
+SAMPLE_ROWS = 1000
+
+# OIDs per IN (...) where clause when reading the sample; Oracle allows at most 1000
+SAMPLE_BATCH_SIZE = 500
+
+# Width of each field type in a .dbf record; strings are as wide as the field, up to 254
+DBF_FIELD_WIDTHS = {'SmallInteger': 5, 'Integer': 10, 'Single': 13, 'Double': 19, 'Date': 8, 'GUID': 38,
+                    'GlobalID': 38}
+
+# Field types that aren't written to the .dbf
+SKIP_FIELD_TYPES = ['OID', 'Geometry', 'Blob', 'Raster']
+
+# Formats to use when a shapefile would be too large
+LARGE_FORMATS = ['gdb', 'gpkg']
+
+
+class ExportEstimate(object):
+    """
+    Estimated size of the .shp and .dbf a feature class would export to
+    """
+    def __init__(self, row_count, shp_bytes, dbf_bytes, sampled_rows):
+        self.row_count = row_count
+        self.shp_bytes = shp_bytes
+        self.dbf_bytes = dbf_bytes
+        self.sampled_rows = sampled_rows
+
+    def largest(self):
+        return max(self.shp_bytes, self.dbf_bytes)
+
+    def __str__(self):
+        return '.shp {0:.0f} MB, .dbf {1:.0f} MB ({2} rows, {3} geometries sampled)'.format(
+            self.shp_bytes / 1e6, self.dbf_bytes / 1e6, self.row_count, self.sampled_rows)
+
+
+def get_large_format(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: the format to export to when a shapefile would be too large, from settings.ini
+    """
+    large_format = settings.get_settings(gfw_env).get('archive', {}).get('large_format', 'gdb')
+
+    if large_format not in LARGE_FORMATS:
+        raise ValueError('Unknown large_format {0} in settings.ini; expecting one of '
+                         '{1}'.format(large_format, ', '.join(LARGE_FORMATS)))
+
+    return large_format
+
+
+def dbf_record_size(field_list):
+    """
+    :param field_list: fields from arcpy.ListFields
+    :return: bytes per .dbf record, including the deletion flag
+    """
+    size = 1
+
+    for f in field_list:
+        if f.type in SKIP_FIELD_TYPES:
+            continue
+
+        if f.type == 'String':
+            size += min(f.length, 254)
+        else:
+            size += DBF_FIELD_WIDTHS.get(f.type, 19)
+
+    return size
+
+
+def shp_record_size(geometry, has_z=False, has_m=False):
+    """
+    :param geometry: an arcpy geometry, or None
+    :param has_z: the feature class has z values
+    :param has_m: the feature class has m values
+    :return: bytes the geometry takes up in a .shp, including the record header
+    """
+    if not geometry:
+        return 12
+
+    point_count = geometry.pointCount
+    measures = int(has_z) + int(has_m)
+
+    if geometry.type == 'point':
+        size = 20 + 8 * measures
+
+    elif geometry.type == 'multipoint':
+        size = 40 + 16 * point_count + measures * (16 + 8 * point_count)
+
+    else:
+        size = 44 + 4 * geometry.partCount + 16 * point_count + measures * (16 + 8 * point_count)
+
+    return 8 + size
+
+
+def estimate_shp_size(input_fc):
+    """
+    Estimate the size of the shapefile a feature class would export to. The .dbf size follows from the fields and
+    the row count; the .shp size is the row count times the average size of SAMPLE_ROWS geometries, sampled evenly
+    across the OID range so data appended in batches (small points first, big polygons later) doesn't skew it
+    :param input_fc: the feature class
+    :return: an ExportEstimate
+    """
+    desc = dataset_cache.describe(input_fc)
+
+    row_count = int(arcpy.GetCount_management(input_fc).getOutput(0))
+    field_list = [f for f in arcpy.ListFields(input_fc) if f.type not in SKIP_FIELD_TYPES]
+
+    dbf_bytes = 32 + 32 * len(field_list) + 1 + row_count * dbf_record_size(field_list)
+
+    sample_bytes = 0
+    sampled_rows = 0
+
+    for geometry in sample_geometries(input_fc, row_count):
+        sample_bytes += shp_record_size(geometry, desc.hasZ, desc.hasM)
+        sampled_rows += 1
+
+    average_bytes = float(sample_bytes) / sampled_rows if sampled_rows else 0
+    shp_bytes = 100 + row_count * average_bytes
+
+    return ExportEstimate(row_count, shp_bytes, dbf_bytes, sampled_rows)
+
+
+def oid_range(input_fc, row_count):
+    """
+    :param input_fc: the feature class
+    :param row_count: rows in the feature class
+    :return: tuple of the lowest and highest OIDs, or None if they can't be read
+    """
+    desc = dataset_cache.describe(input_fc)
+
+    # Shapefile FIDs always run from 0, with no gaps; shapefiles don't support ORDER BY either
+    if desc.dataType == 'ShapeFile':
+        return 0, row_count - 1
+
+    bounds = []
+
+    for direction in ['ASC', 'DESC']:
+        sql_clause = (None, 'ORDER BY {0} {1}'.format(desc.OIDFieldName, direction))
+
+        with arcpy.da.SearchCursor(input_fc, ['OID@'], sql_clause=sql_clause) as cursor:
+            bounds.append(next(iter(cursor), [None])[0])
+
+    low, high = bounds
+
+    # Workspaces that ignore the ORDER BY return the same row twice; OIDs are unique, so the range can't be smaller
+    # than the row count
+    if low is None or high is None or high - low + 1 < row_count:
+        return None
+
+    return low, high
+
+
+def sample_geometries(input_fc, row_count):
+    """
+    Read about SAMPLE_ROWS geometries at evenly spaced OIDs. OIDs deleted since they were assigned are skipped, so
+    fewer may come back. Falls back to the first SAMPLE_ROWS rows if the OID range can't be read
+    :param input_fc: the feature class
+    :param row_count: rows in the feature class
+    :return: generator of arcpy geometries (or None for null geometries)
+    """
+    bounds = oid_range(input_fc, row_count) if row_count > SAMPLE_ROWS else None
+
+    if not bounds:
+        with arcpy.da.SearchCursor(input_fc, ['SHAPE@']) as cursor:
+            for i, row in enumerate(cursor):
+                if i >= SAMPLE_ROWS:
+                    break
+
+                yield row[0]
+
+        return
+
+    low, high = bounds
+    step = (high - low) / float(SAMPLE_ROWS)
+
+    oid_list = sorted(set([low + int(i * step) for i in range(SAMPLE_ROWS)]))
+    oid_field = arcpy.AddFieldDelimiters(input_fc, dataset_cache.describe(input_fc).OIDFieldName)
+
+    for i in range(0, len(oid_list), SAMPLE_BATCH_SIZE):
+        where_clause = '{0} IN ({1})'.format(oid_field, ', '.join([str(x) for x in oid_list[i:i + SAMPLE_BATCH_SIZE]]))
+
+        with arcpy.da.SearchCursor(input_fc, ['SHAPE@'], where_clause) as cursor:
+            for row in cursor:
+                yield row[0]
+
+
+def choose_format(input_fc, large_format):
+    """
+    Pick the format to export a feature class to before exporting it, rather than exporting to shapefile and
+    starting again if it's too large
+    :param input_fc: the feature class
+    :param large_format: format to use if a shapefile would be too large; gdb or gpkg
+    :return: tuple of (shp or large_format, the ExportEstimate)
+    """
+    estimate = estimate_shp_size(input_fc)
+
+    if estimate.largest() < SHP_MAX_BYTES * SAFETY_MARGIN:
+        export_format = 'shp'
+    else:
+        export_format = large_format
+
+    logging.info('Estimated shapefile size of {0}: {1}; exporting to {2}'.format(os.path.basename(input_fc),
+                                                                                estimate, export_format))
+
+    return export_format, estimate
+
+
+def log_estimate_error(estimate, out_shp):
+    """
+    Log how far off the estimate was, so SAMPLE_ROWS and SAFETY_MARGIN can be tuned
+    :param estimate: the ExportEstimate
+    :param out_shp: the shapefile that was exported
+    """
+    base_path = os.path.splitext(out_shp)[0]
+
+    for extension, estimated_bytes in [('.shp', estimate.shp_bytes), ('.dbf', estimate.dbf_bytes)]:
+        actual_bytes = os.path.getsize(base_path + extension)
+        error = (estimated_bytes - actual_bytes) / float(actual_bytes) if actual_bytes else 0
+
+        logging.info('Shapefile size estimate for {0}{1}: {2:.0f} MB estimated, {3:.0f} MB actual '
+                     '({4:+.1%})'.format(os.path.basename(base_path), extension, estimated_bytes / 1e6,
+                                         actual_bytes / 1e6, error))
@@ -0,0 +1,386 @@
+import argparse
+import logging
+import os
+import time
+
+from osgeo import ogr
+
+# Rows to write between commits, unless the sink is given another value
+DEFAULT_COMMIT_INTERVAL = 5000
+
+# Fields the output calculates itself; never copied from the source
+SKIP_FIELDS = ['shape_length', 'shape_area', 'shape.starea()', 'shape.stlength()', 'globalid']
+
+
+class FeatureSource(object):
+    """
+    Streams features from a dataset as (attribute values, WKB geometry) tuples
+    :param fields: attribute fields to read, in the order the values are returned
+    """
+    def __init__(self, fields=None):
+        self.fields = fields
+
+    def list_fields(self):
+        """
+        :return: the names of the attribute fields that can be copied from this source
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+
+class FeatureSink(object):
+    """
+    Writes features to a dataset in one edit session, committing every commit_interval rows
+    Use as a context manager: edits are committed on a clean exit and rolled back if there's an error
+    :param fields: attribute fields to write, in the same order as the values passed to write()
+    :param commit_interval: rows to write between commits
+    """
+    def __init__(self, fields=None, commit_interval=DEFAULT_COMMIT_INTERVAL):
+        self.fields = fields
+        self.commit_interval = commit_interval
+
+        self.row_count = 0
+        self._uncommitted = 0
+
+    def list_fields(self):
+        """
+        :return: the names of the attribute fields that can be written to this sink
+        """
+        raise NotImplementedError
+
+    def open(self):
+        """
+        Connect to the output and start the first edit session/transaction
+        """
+        raise NotImplementedError
+
+    def begin(self):
+        """
+        Start a new edit session/transaction after a commit
+        """
+        raise NotImplementedError
+
+    def _insert(self, values, wkb):
+        raise NotImplementedError
+
+    def commit(self):
+        """
+        Save everything written since the last commit and end the edit session/transaction
+        """
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+    def write(self, values, wkb):
+        """
+        Insert one feature, committing if we've reached the commit interval
+        :param values: attribute values, in the same order as self.fields
+        :param wkb: the geometry as WKB
+        """
+        self._insert(values, wkb)
+
+        self.row_count += 1
+        self._uncommitted += 1
+
+        if self._uncommitted >= self.commit_interval:
+            self.commit()
+            self.begin()
+
+            self._uncommitted = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.commit()
+
+        self.close()
+
+    def close(self):
+        pass
+
+
+class ArcpyFeatureSource(FeatureSource):
+    """
+    Reads features from an esri FC or feature layer with a search cursor
+    :param in_fc: path to the FC, or a feature layer
+    :param where_clause: optional where clause
+    :param spatial_reference: optional spatial reference to project the geometries to as they're read
+    """
+    def __init__(self, in_fc, where_clause=None, fields=None, spatial_reference=None):
+        super(ArcpyFeatureSource, self).__init__(fields)
+
+        self.in_fc = in_fc
+        self.where_clause = where_clause
+        self.spatial_reference = spatial_reference
+
+    def list_fields(self):
+        return _esri_copy_fields(self.in_fc)
+
+    def __iter__(self):
+        # arcpy is imported where it's used, so the OGR source and sink can be tested and benchmarked without ArcGIS
+        import arcpy
+
+        with arcpy.da.SearchCursor(self.in_fc, self.fields + ['SHAPE@WKB'], self.where_clause,
+                                   self.spatial_reference) as cursor:
+            for row in cursor:
+                yield list(row[:-1]), row[-1]
+
+
+class ArcpyFeatureSink(FeatureSink):
+    """
+    Writes features to an esri FC or feature layer with an insert cursor inside an arcpy.da.Editor session
+    :param out_fc: path to the FC, or a feature layer that's been switched to an edit version
+    :param workspace: the workspace that contains out_fc; the edit session is started on it. None to write without
+    an edit session, i.e. to a shapefile
+    :param versioned: True if out_fc is versioned (i.e. in SDE), so the session is started in multiuser mode
+    """
+    def __init__(self, out_fc, workspace, versioned=True, fields=None, commit_interval=DEFAULT_COMMIT_INTERVAL):
+        super(ArcpyFeatureSink, self).__init__(fields, commit_interval)
+
+        self.out_fc = out_fc
+        self.workspace = workspace
+        self.versioned = versioned
+
+        self._editor = None
+        self._cursor = None
+
+    def list_fields(self):
+        return _esri_copy_fields(self.out_fc)
+
+    def open(self):
+        import arcpy
+
+        if self.workspace:
+            self._editor = arcpy.da.Editor(self.workspace)
+
+        self.begin()
+
+    def begin(self):
+        import arcpy
+
+        if self._editor:
+            self._editor.startEditing(False, self.versioned)
+            self._editor.startOperation()
+
+        self._cursor = arcpy.da.InsertCursor(self.out_fc, self.fields + ['SHAPE@WKB'])
+
+    def _stop(self, save):
+        del self._cursor
+        self._cursor = None
+
+        # Without an edit session, rows are saved as they're inserted
+        if not self._editor:
+            return
+
+        if save:
+            self._editor.stopOperation()
+        else:
+            self._editor.abortOperation()
+
+        self._editor.stopEditing(save)
+
+    def _insert(self, values, wkb):
+        self._cursor.insertRow(values + [wkb])
+
+    def commit(self):
+        logging.debug('Committing {0} rows to {1}'.format(self.row_count, self.out_fc))
+
+        self._stop(True)
+
+    def abort(self):
+        logging.debug('Rolling back uncommitted rows in {0}'.format(self.out_fc))
+        self._stop(False)
+
+
+class OgrFeatureSource(FeatureSource):
+    """
+    Reads features from any OGR datasource (GeoPackage, shapefile, etc)
+    :param path: path to the datasource
+    :param layer_name: the layer to read; defaults to the first one
+    :param where_clause: optional attribute filter
+    """
+    def __init__(self, path, layer_name=None, where_clause=None, fields=None):
+        super(OgrFeatureSource, self).__init__(fields)
+
+        self.path = path
+        self.layer_name = layer_name
+        self.where_clause = where_clause
+
+    def _open_layer(self):
+        datasource = ogr.Open(self.path)
+
+        if self.layer_name:
+            layer = datasource.GetLayerByName(self.layer_name)
+        else:
+            layer = datasource.GetLayer(0)
+
+        return datasource, layer
+
+    def list_fields(self):
+        datasource, layer = self._open_layer()
+        layer_defn = layer.GetLayerDefn()
+
+        return [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+
+    def __iter__(self):
+        # Keep a reference to the datasource; the layer is invalid once it's garbage collected
+        datasource, layer = self._open_layer()
+
+        if self.where_clause:
+            layer.SetAttributeFilter(self.where_clause)
+
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            wkb = geom.ExportToWkb() if geom else None
+
+            yield [feature.GetField(x) for x in self.fields], wkb
+
+
+class OgrFeatureSink(FeatureSink):
+    """
+    Writes features to an existing layer in an OGR datasource, i.e. a GeoPackage, in transactions of
+    commit_interval rows
+    :param path: path to the datasource
+    :param layer_name: the layer to write to; defaults to the first one
+    """
+    def __init__(self, path, layer_name=None, fields=None, commit_interval=DEFAULT_COMMIT_INTERVAL):
+        super(OgrFeatureSink, self).__init__(fields, commit_interval)
+
+        self.path = path
+        self.layer_name = layer_name
+
+        self._datasource = None
+        self._layer = None
+
+    def _open_layer(self):
+        self._datasource = ogr.Open(self.path, update=True)
+
+        if self.layer_name:
+            self._layer = self._datasource.GetLayerByName(self.layer_name)
+        else:
+            self._layer = self._datasource.GetLayer(0)
+
+    def list_fields(self):
+        if not self._layer:
+            self._open_layer()
+
+        layer_defn = self._layer.GetLayerDefn()
+
+        return [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+
+    def open(self):
+        if not self._layer:
+            self._open_layer()
+
+        self.begin()
+
+    def begin(self):
+        self._datasource.StartTransaction()
+
+    def _insert(self, values, wkb):
+        feature = ogr.Feature(self._layer.GetLayerDefn())
+
+        for field_name, value in zip(self.fields, values):
+            feature.SetField(field_name, value)
+
+        if wkb:
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(str(wkb)))
+
+        self._layer.CreateFeature(feature)
+
+    def commit(self):
+        logging.debug('Committing {0} rows to {1}'.format(self.row_count, self.path))
+
+        self._datasource.CommitTransaction()
+
+    def abort(self):
+        logging.debug('Rolling back uncommitted rows in {0}'.format(self.path))
+        self._datasource.RollbackTransaction()
+
+    def close(self):
+        # Dereferencing the datasource closes it and flushes everything to disk
+        self._layer = None
+        self._datasource = None
+
+
+def _esri_copy_fields(in_fc):
+    import arcpy
+
+    return [f.name for f in arcpy.ListFields(in_fc) if f.type not in ['OID', 'Geometry', 'GlobalID', 'Raster', 'Blob']
+            and f.editable and f.name.lower() not in SKIP_FIELDS]
+
+
+def match_fields(source, sink):
+    """
+    Set source and sink to copy the fields they have in common (case insensitive), like Append with NO_TEST
+    :param source: a FeatureSource
+    :param sink: a FeatureSink
+    :return: the list of source field names
+    """
+    sink_fields = dict((x.lower(), x) for x in sink.list_fields())
+    source_fields = [x for x in source.list_fields() if x.lower() in sink_fields and x.lower() not in SKIP_FIELDS]
+
+    source.fields = source_fields
+    sink.fields = [sink_fields[x.lower()] for x in source_fields]
+
+    return source_fields
+
+
+def stream_features(source, sink):
+    """
+    Copy every feature from source to an open sink
+    :param source: a FeatureSource, with fields set
+    :param sink: a FeatureSink, with fields in the same order
+    :return: number of features written
+    """
+    start_count = sink.row_count
+
+    for values, wkb in source:
+        sink.write(values, wkb)
+
+    return sink.row_count - start_count
+
+
+def main():
+    """
+    Benchmark the append engine on OGR layers: copy every feature from one OGR layer into an existing layer with the
+    same schema, i.e. an empty copy made with ogr2ogr -where "1=0"
+    """
+    parser = argparse.ArgumentParser(description='Benchmark streaming features from one OGR layer to another.')
+    parser.add_argument('source', help='source datasource, i.e. a GeoPackage')
+    parser.add_argument('output', help='output datasource; must already have a layer with matching fields')
+    parser.add_argument('--source-layer', help='source layer name; defaults to the first layer')
+    parser.add_argument('--output-layer', help='output layer name; defaults to the first layer')
+    parser.add_argument('--commit-interval', '-c', type=int, default=DEFAULT_COMMIT_INTERVAL,
+                        help='rows to write between commits')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    source = OgrFeatureSource(args.source, args.source_layer)
+    sink = OgrFeatureSink(args.output, args.output_layer, commit_interval=args.commit_interval)
+
+    match_fields(source, sink)
+
+    start_time = time.time()
+
+    with sink:
+        row_count = stream_features(source, sink)
+
+    elapsed = time.time() - start_time
+
+    logging.info('Wrote {0} features to {1} in {2:.1f} seconds ({3:.0f} features/second, commit interval '
+                 '{4})'.format(row_count, os.path.basename(args.output), elapsed, row_count / max(elapsed, 0.001),
+                               args.commit_interval))
+
+
+if __name__ == '__main__':
+    main()
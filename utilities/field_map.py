@@ -4,6 +4,7 @@ import logging
 
 import util
 import settings
+import dataset_cache
 import subtypes_and_domains as sub
 
 
@@ -582,6 +583,9 @@ def _cleanup_output_fc(in_fc, field_list):
     for field_name in temp_str_fields:
         arcpy.AlterField_management(in_fc, field_name, field_name.replace('__string__', ''))
 
+    # Fields have been added/removed/renamed
+    dataset_cache.invalidate(in_fc)
+
 
 def ini_fieldmap_to_fc(in_fc, dataset_name, ini_dict, out_workspace):
     """
@@ -0,0 +1,337 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import arcpy
+import requests
+import validators
+
+import dataset_cache
+import settings
+
+# Columns in the config table that change on every run and shouldn't count as a change to the layer
+VOLATILE_COLUMNS = ['last_updated']
+
+# Set with ignore_stored(); every layer is treated as changed
+_force = False
+
+
+def ignore_stored(force=True):
+    """
+    Treat every source as changed, regardless of what's in the store. Used by gfw-sync.py --force
+    :param force: True to ignore stored fingerprints
+    """
+    global _force
+
+    _force = force
+
+
+def get_store_path(gfw_env):
+    """
+    :param gfw_env: the environment
+    :return: path to the fingerprint database, in the root of the scratch workspace
+    """
+    scratch_workspace = settings.get_settings(gfw_env)['paths']['scratch_workspace']
+
+    return os.path.join(scratch_workspace, 'source_fingerprints_{0}.sqlite'.format(gfw_env))
+
+
+def _connect(gfw_env):
+    store_path = get_store_path(gfw_env)
+
+    if not os.path.exists(os.path.dirname(store_path)):
+        os.makedirs(os.path.dirname(store_path))
+
+    # Several layers can finish at once when run by cronjob.py; wait for the lock rather than failing
+    conn = sqlite3.connect(store_path, timeout=60)
+    conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (layer TEXT PRIMARY KEY, fingerprint TEXT, '
+                 'updated REAL)')
+
+    return conn
+
+
+def get_stored(layername, gfw_env):
+    """
+    :param layername: the layer's tech_title
+    :param gfw_env: the environment
+    :return: the fingerprint recorded after the last successful update of this layer, or None
+    """
+    conn = _connect(gfw_env)
+
+    try:
+        row = conn.execute('SELECT fingerprint FROM fingerprints WHERE layer = ?', (layername, )).fetchone()
+    finally:
+        conn.close()
+
+    return row[0] if row else None
+
+
+def store(layername, gfw_env, fingerprint):
+    """
+    Record the fingerprint of a layer that updated successfully
+    :param layername: the layer's tech_title
+    :param gfw_env: the environment
+    :param fingerprint: the fingerprint from layer_fingerprint()
+    """
+    conn = _connect(gfw_env)
+
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO fingerprints (layer, fingerprint, updated) VALUES (?, ?, ?)',
+                         (layername, fingerprint, time.time()))
+    finally:
+        conn.close()
+
+
+def is_unchanged(layername, gfw_env, fingerprint):
+    """
+    :param layername: the layer's tech_title
+    :param gfw_env: the environment
+    :param fingerprint: the current fingerprint from layer_fingerprint(); None if it couldn't be worked out
+    :return: True if the fingerprint matches the last successful update
+    """
+    if _force or not fingerprint:
+        return False
+
+    return get_stored(layername, gfw_env) == fingerprint
+
+
+def layer_fingerprint(layerdef, source_fingerprint=None):
+    """
+    Combine a fingerprint of the source data with the layer's config, so that editing the layer in the config
+    table (a new field map, a different output, etc) counts as a change too
+    :param layerdef: the layerdef from the config table
+    :param source_fingerprint: fingerprint of the source from source_fingerprint(); None if it's not known
+    :return: an md5 hex digest, or None if we can't fingerprint the source
+    """
+    if not source_fingerprint:
+        return None
+
+    config = dict((k, v) for k, v in layerdef.iteritems() if k not in VOLATILE_COLUMNS and k != 'source_fingerprint')
+
+    h = hashlib.md5()
+    h.update(json.dumps(config, sort_keys=True, default=str))
+    h.update(source_fingerprint)
+
+    return h.hexdigest()
+
+
+def source_fingerprint(source, hash_contents=False):
+    """
+    Get a cheap fingerprint of a source: the ETag/Last-Modified of a URL, the sizes and modified times of the
+    files that make up a local dataset, or the row count, extent and latest edit (or an attribute hash) of an SDE
+    feature class
+    :param source: the source from the config table; a path, a URL or a list of either
+    :param hash_contents: hash file contents instead of using modified times. Use for files we've just
+    downloaded, which are always new
+    :return: an md5 hex digest, or None if the source can't be fingerprinted
+    """
+    if type(source) is list:
+        parts = [source_fingerprint(s, hash_contents) for s in source]
+
+        if None in parts:
+            return None
+
+        return hashlib.md5(''.join(parts)).hexdigest()
+
+    if not source:
+        return None
+
+    if validators.url(source):
+        return url_fingerprint(source)
+
+    if '.sde' in source.lower():
+        return table_fingerprint(source)
+
+    file_list = dataset_files(source)
+
+    if not file_list:
+        return None
+
+    h = hashlib.md5()
+
+    for path in file_list:
+        h.update(os.path.basename(path).lower())
+        h.update(str(os.path.getsize(path)))
+
+        if hash_contents:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    h.update(chunk)
+        else:
+            h.update(str(os.path.getmtime(path)))
+
+    return h.hexdigest()
+
+
+def url_fingerprint(url):
+    """
+    :param url: a URL to a file
+    :return: md5 of the ETag, Last-Modified and Content-Length headers, or None if the server doesn't send any
+    """
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=60)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.debug('Unable to get headers for {0}: {1}'.format(url, e))
+        return None
+
+    headers = [r.headers.get(x) for x in ['ETag', 'Last-Modified', 'Content-Length']]
+
+    if not any(headers):
+        return None
+
+    return hashlib.md5('|'.join([x or '' for x in headers])).hexdigest()
+
+
+def dataset_files(source):
+    """
+    List the files on disk that make up a dataset
+    :param source: path to a shapefile, raster, file gdb feature class or directory
+    :return: sorted list of file paths; empty if the source isn't on disk
+    """
+    # Shapefiles and rasters are a main file plus sidecars with the same basename
+    if os.path.isfile(source):
+        return sorted(glob.glob(os.path.splitext(source)[0] + '.*'))
+
+    # File gdb feature classes aren't separate files; use the whole gdb
+    gdb_dir = source
+
+    while gdb_dir and os.path.splitext(gdb_dir)[1].lower() != '.gdb':
+        parent = os.path.dirname(gdb_dir)
+
+        if parent == gdb_dir:
+            gdb_dir = None
+        else:
+            gdb_dir = parent
+
+    if gdb_dir:
+        source = gdb_dir
+
+    if not os.path.isdir(source):
+        return []
+
+    file_list = []
+
+    for dirpath, dirnames, filenames in os.walk(source):
+        file_list.extend([os.path.join(dirpath, x) for x in filenames if os.path.splitext(x)[1] != '.lock'])
+
+    return sorted(file_list)
+
+
+def table_fingerprint(fc):
+    """
+    Cheaply fingerprint a feature class in a database, where we can't look at files on disk. With editor tracking,
+    the latest edit date and highest OID say whether anything has changed; without it, the attributes are hashed,
+    but not the geometries
+    :param fc: path to the feature class
+    :return: md5 of its row count, extent and either its latest edit and highest OID or its attributes
+    """
+    if not dataset_cache.exists(fc):
+        return None
+
+    desc = dataset_cache.describe(fc)
+
+    h = hashlib.md5()
+    h.update(arcpy.GetCount_management(fc).getOutput(0))
+
+    extent = desc.extent
+    h.update(str([extent.XMin, extent.YMin, extent.XMax, extent.YMax]))
+
+    if getattr(desc, 'editorTrackingEnabled', False) and desc.editedAtFieldName:
+        for field_name in [desc.editedAtFieldName, desc.OIDFieldName]:
+            h.update(repr(_max_value(fc, field_name)))
+
+    else:
+        h.update(rows_hash(fc, include_geometry=False))
+
+    return h.hexdigest()
+
+
+def _max_value(fc, field_name):
+    """
+    :return: the highest value of a field, read with an ORDER BY so only the first row is fetched
+    """
+    order_by = 'ORDER BY {0} DESC'.format(field_name)
+
+    with arcpy.da.SearchCursor(fc, [field_name], '{0} IS NOT NULL'.format(field_name),
+                               sql_clause=(None, order_by)) as cursor:
+        for row in cursor:
+            return row[0]
+
+    return None
+
+
+def _hash_fields(fc):
+    """
+    :return: sorted names of the fields that hold the data, leaving out ones that are filled in anew every time the
+    data is exported or edited: OIDs, GlobalIDs/GUIDs, editor tracking fields and shape length/area
+    """
+    desc = dataset_cache.describe(fc)
+
+    skip_fields = ['shape_length', 'shape_area', 'shape.starea()', 'shape.stlength()']
+
+    if getattr(desc, 'editorTrackingEnabled', False):
+        skip_fields += [x.lower() for x in [desc.creatorFieldName, desc.createdAtFieldName, desc.editorFieldName,
+                                            desc.editedAtFieldName] if x]
+
+    return sorted([f.name for f in arcpy.ListFields(fc) if f.type not in ['OID', 'Geometry', 'GlobalID', 'Guid']
+                   and f.name.lower() not in skip_fields])
+
+
+def rows_hash(fc, include_geometry=True):
+    """
+    Hash every row of a feature class, in OID order. This reads the whole table
+    :param fc: path to the feature class
+    :param include_geometry: hash each row's geometry as well as its attributes
+    :return: an md5 hex digest
+    """
+    field_list = _hash_fields(fc)
+
+    if include_geometry:
+        field_list.append('SHAPE@WKB')
+
+    order_by = 'ORDER BY {0}'.format(dataset_cache.describe(fc).OIDFieldName)
+
+    h = hashlib.md5()
+
+    with arcpy.da.SearchCursor(fc, field_list, sql_clause=(None, order_by)) as cursor:
+        for row in cursor:
+            h.update(repr(row))
+
+    return h.hexdigest()
+
+
+def content_hash(dataset):
+    """
+    Hash what's in a dataset, so the same data exported again (i.e. to a new SDE feature class) hashes the same.
+    Used to tell whether a dataset has already been archived
+    :param dataset: path to a feature class, shapefile or raster
+    :return: an md5 hex digest, or None if the dataset can't be hashed
+    """
+    desc = dataset_cache.describe(dataset)
+
+    # Rasters are hashed by the bytes of their files; rasters in a GDB aren't separate files
+    if desc.dataType == 'RasterDataset':
+        if not os.path.isfile(dataset):
+            return None
+
+        return source_fingerprint(dataset, hash_contents=True)
+
+    if not dataset_cache.exists(dataset):
+        return None
+
+    # The same rows with a different schema or projection are a different download
+    schema = [(f.name, f.type, f.length) for f in arcpy.ListFields(dataset)]
+
+    h = hashlib.md5()
+    h.update(repr(schema))
+    h.update(desc.spatialReference.exportToString())
+    h.update(arcpy.GetCount_management(dataset).getOutput(0))
+    h.update(rows_hash(dataset))
+
+    return h.hexdigest()
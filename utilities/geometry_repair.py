@@ -0,0 +1,336 @@
+import hashlib
+import logging
+import struct
+import time
+
+from osgeo import gdal
+from osgeo import ogr
+
+import parallel
+import settings
+
+# Rows per batch sent to a worker
+DEFAULT_BATCH_SIZE = 1000
+
+# Max bytes of WKB per batch, so a handful of huge polygons don't all land on one worker
+DEFAULT_BATCH_BYTES = 32 * 1024 * 1024
+
+# What happened to each feature
+VALID = 'valid'
+REPAIRED = 'repaired'
+UNREPAIRED = 'unrepaired'
+DELETED = 'deleted'
+
+# md5 digests of the WKB of geometries we've already found or made valid in this process, so the same geometry read
+# again by a later stage (the cartoDB export, for example) isn't validated a second time. Single parts are hashed as
+# one-part multis, as the shapefile round trip and -nlt MULTIPOLYGON before the cartoDB export change the type
+# code; anything that changes the coordinates changes the digest, so that gets checked again
+_known_valid = set()
+
+# WKB type codes of points, lines and polygons, ignoring Z/M; adding 3 gives the multi type
+_SINGLE_PART_TYPES = (1, 2, 3)
+
+# Base OGR type of each geometry family; repairs that return a collection are cut back to this type
+_BASE_TYPES = {ogr.wkbPolygon: ogr.wkbMultiPolygon, ogr.wkbMultiPolygon: ogr.wkbMultiPolygon,
+               ogr.wkbLineString: ogr.wkbMultiLineString, ogr.wkbMultiLineString: ogr.wkbMultiLineString,
+               ogr.wkbPoint: ogr.wkbMultiPoint, ogr.wkbMultiPoint: ogr.wkbMultiPoint}
+
+
+class RepairReport(object):
+    """
+    Counts of what the repair stage did to a dataset
+    """
+    def __init__(self):
+        self.valid = 0
+        self.already_known = 0
+        self.repaired = 0
+        self.unrepaired = 0
+        self.deleted = 0
+        self.kept_empty = 0
+
+    def __str__(self):
+        return '{0} valid ({1} known from earlier stages), {2} repaired, {3} left invalid, {4} deleted, {5} null or ' \
+               'empty kept'.format(self.valid, self.already_known, self.repaired, self.unrepaired, self.deleted,
+                                   self.kept_empty)
+
+
+def get_workers(gfw_env):
+    """
+    :param gfw_env: the environment
+    :return: number of worker processes to repair with, from settings.ini
+    """
+    return int(settings.get_settings(gfw_env).get('geometry_repair', {}).get('workers', 1))
+
+
+def has_make_valid():
+    """
+    :return: True if this GDAL has MakeValid (GDAL 3+). Without it, repair_esri and repair_ogr fall back to the
+    RepairGeometry tool and spatialite's ST_MakeValid; a zero-width buffer isn't safe, as it drops parts of
+    self-intersecting polygons
+    """
+    return hasattr(ogr.Geometry, 'MakeValid')
+
+
+def clear():
+    """
+    Forget which geometries are known to be valid
+    """
+    _known_valid.clear()
+
+
+def _digest(wkb):
+    """
+    :param wkb: WKB str
+    :return: md5 digest of the WKB, with a single part point, line or polygon wrapped as a one-part multi, so it
+    hashes the same whichever of the two a format stores it as
+    """
+    byte_order = '<' if wkb[0] == '\x01' else '>'
+    geom_type = struct.unpack(byte_order + 'I', wkb[1:5])[0]
+
+    # ISO codes add 1000/2000/3000 for Z/M/ZM; the old 2.5D codes set the high bit
+    if (geom_type & 0x7fffffff) % 1000 in _SINGLE_PART_TYPES:
+        wkb = wkb[0] + struct.pack(byte_order + 'II', geom_type + 3, 1) + wkb
+
+    return hashlib.md5(wkb).digest()
+
+
+def _make_valid(geom):
+    """
+    Repair a geometry with GEOS MakeValid
+    :param geom: an invalid ogr.Geometry
+    :return: a valid ogr.Geometry of the same family, or None if it can't be repaired
+    """
+    base_type = _BASE_TYPES.get(ogr.GT_Flatten(geom.GetGeometryType()))
+
+    try:
+        repaired = geom.MakeValid()
+    except RuntimeError:
+        return None
+
+    if not repaired or repaired.IsEmpty():
+        return None
+
+    # MakeValid can return a collection of mixed types, i.e. a polygon plus the line where it touched itself
+    # Keep only the parts that match the original, like ST_CollectionExtract
+    if base_type and ogr.GT_Flatten(repaired.GetGeometryType()) == ogr.wkbGeometryCollection:
+        extracted = ogr.Geometry(base_type)
+        part_type = ogr.GT_Flatten(base_type) - 3
+
+        for i in range(repaired.GetGeometryCount()):
+            part = repaired.GetGeometryRef(i)
+
+            if ogr.GT_Flatten(part.GetGeometryType()) == part_type:
+                extracted.AddGeometry(part)
+
+            elif ogr.GT_Flatten(part.GetGeometryType()) == base_type:
+                for j in range(part.GetGeometryCount()):
+                    extracted.AddGeometry(part.GetGeometryRef(j))
+
+        if extracted.IsEmpty():
+            return None
+
+        repaired = extracted
+
+    return repaired
+
+
+def repair_wkb_batch(batch):
+    """
+    Validate, and if needed repair, a batch of geometries. Runs in the worker processes; it only uses OGR, but on
+    Windows each worker imports the main script again (gfw-sync.py), and arcpy with it. Only null and empty
+    geometries are deleted; ones that can't be repaired are left as they are
+    :param batch: list of (ID, WKB) tuples
+    :return: list of (ID, status, repaired WKB or None, digest of the valid WKB or None) tuples
+    """
+    results = []
+
+    for feature_id, wkb in batch:
+        geom = ogr.CreateGeometryFromWkb(wkb) if wkb else None
+
+        if not geom or geom.IsEmpty():
+            results.append((feature_id, DELETED, None, None))
+
+        elif geom.IsValid():
+            results.append((feature_id, VALID, None, _digest(wkb)))
+
+        else:
+            repaired = _make_valid(geom)
+
+            if repaired:
+                repaired_wkb = repaired.ExportToWkb()
+                results.append((feature_id, REPAIRED, repaired_wkb, _digest(repaired_wkb)))
+            else:
+                results.append((feature_id, UNREPAIRED, None, None))
+
+    return results
+
+
+def iter_batches(rows, report, batch_size, batch_bytes):
+    """
+    Group (ID, WKB) rows into batches by row count and size, skipping geometries we already know are valid
+    :param rows: iterable of (ID, WKB) rows in ID order, i.e. a search cursor
+    :param report: RepairReport to count known geometries in
+    :param batch_size: max rows per batch
+    :param batch_bytes: max bytes per batch
+    :return: generator of lists of (ID, WKB) tuples
+    """
+    batch = []
+    size = 0
+
+    for feature_id, wkb in rows:
+        wkb = str(wkb) if wkb else None
+
+        if wkb and _digest(wkb) in _known_valid:
+            report.valid += 1
+            report.already_known += 1
+            continue
+
+        batch.append((feature_id, wkb))
+        size += len(wkb) if wkb else 0
+
+        if len(batch) >= batch_size or size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield batch
+
+
+def check_geometries(rows, workers, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                     delete_empty=True):
+    """
+    Validate and repair geometries in parallel
+    :param rows: iterable of (ID, WKB) rows
+    :param workers: number of worker processes
+    :param batch_size: max rows per batch
+    :param batch_bytes: max bytes per batch
+    :param delete_empty: list features with null or empty geometries for deletion; otherwise they're kept
+    :return: tuple of (dict of {ID: repaired WKB}, list of IDs to delete, RepairReport)
+    """
+    report = RepairReport()
+    repaired_dict = {}
+    delete_list = []
+
+    for results in parallel.imap_bounded(repair_wkb_batch, iter_batches(rows, report, batch_size, batch_bytes),
+                                         workers):
+        for feature_id, status, repaired_wkb, digest in results:
+
+            if status == VALID:
+                report.valid += 1
+            elif status == REPAIRED:
+                report.repaired += 1
+                repaired_dict[feature_id] = repaired_wkb
+            elif status == UNREPAIRED:
+                report.unrepaired += 1
+                logging.warning('Unable to repair the geometry of feature {0}; leaving it as it is'.format(feature_id))
+            elif delete_empty:
+                report.deleted += 1
+                delete_list.append(feature_id)
+            else:
+                report.kept_empty += 1
+
+            if digest:
+                _known_valid.add(digest)
+
+    return repaired_dict, delete_list, report
+
+
+def repair_esri(in_fc, workers, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Repair an esri FC in place: invalid geometries are fixed, null/empty ones are deleted (like RepairGeometry
+    with DELETE_NULL). Only features that need changing are touched, in a single update cursor pass
+    :param in_fc: the FC to repair
+    :param workers: number of worker processes
+    :param batch_size: max rows per batch
+    :param batch_bytes: max bytes per batch
+    :return: a RepairReport, or None if GDAL has no MakeValid and the RepairGeometry tool was used instead
+    """
+    # Only needed here; the worker processes just use OGR
+    import arcpy
+
+    if not has_make_valid():
+        logging.warning('GDAL {0} has no MakeValid; repairing {1} with RepairGeometry'.format(
+            gdal.VersionInfo('RELEASE_NAME'), in_fc))
+        arcpy.RepairGeometry_management(in_fc, "DELETE_NULL")
+        return None
+
+    start_time = time.time()
+
+    with arcpy.da.SearchCursor(in_fc, ['OID@', 'SHAPE@WKB']) as cursor:
+        repaired_dict, delete_list, report = check_geometries(cursor, workers, batch_size, batch_bytes)
+
+    if repaired_dict or delete_list:
+        delete_set = set(delete_list)
+
+        with arcpy.da.UpdateCursor(in_fc, ['OID@', 'SHAPE@WKB']) as cursor:
+            for row in cursor:
+                if row[0] in delete_set:
+                    cursor.deleteRow()
+
+                elif row[0] in repaired_dict:
+                    cursor.updateRow([row[0], bytearray(repaired_dict[row[0]])])
+
+    logging.info('Geometry repair for {0} in {1:.1f} seconds: {2}'.format(in_fc, time.time() - start_time, report))
+
+    return report
+
+
+def repair_ogr(path, workers, layer_name=None, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Repair a layer in an OGR datasource (i.e. the spatialite DB we push to cartoDB from) in place. Only invalid
+    geometries are changed; features with null or empty geometries are kept, like the ST_MakeValid UPDATE this
+    replaced
+    :param path: path to the datasource
+    :param workers: number of worker processes
+    :param layer_name: layer to repair; defaults to the first one
+    :param batch_size: max rows per batch
+    :param batch_bytes: max bytes per batch
+    :return: a RepairReport, or None if GDAL has no MakeValid and spatialite's ST_MakeValid was used instead
+    """
+    start_time = time.time()
+
+    datasource = ogr.Open(path, update=True)
+    layer = datasource.GetLayerByName(layer_name) if layer_name else datasource.GetLayer(0)
+
+    if not has_make_valid():
+        logging.warning('GDAL {0} has no MakeValid; repairing {1} with spatialite'.format(
+            gdal.VersionInfo('RELEASE_NAME'), path))
+
+        sql = 'UPDATE "{0}" SET "{1}" = ST_MakeValid("{1}") WHERE ST_IsValid("{1}") <> 1;'.format(
+            layer.GetName(), layer.GetGeometryColumn() or 'GEOMETRY')
+
+        layer = None
+        datasource = None
+
+        # Only needed here; the worker processes don't run this
+        import util
+        util.run_subprocess(['spatialite', path, sql])
+
+        return None
+
+    def read_rows():
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            yield feature.GetFID(), geom.ExportToWkb() if geom else None
+
+    repaired_dict, delete_list, report = check_geometries(read_rows(), workers, batch_size, batch_bytes,
+                                                          delete_empty=False)
+
+    if repaired_dict:
+        datasource.StartTransaction()
+
+        for fid, repaired_wkb in repaired_dict.iteritems():
+            feature = layer.GetFeature(fid)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(repaired_wkb))
+            layer.SetFeature(feature)
+
+        datasource.CommitTransaction()
+
+    # Close the datasource so everything is flushed before ogr2ogr reads it
+    layer = None
+    datasource = None
+
+    logging.info('Geometry repair for {0} in {1:.1f} seconds: {2}'.format(path, time.time() - start_time, report))
+
+    return report
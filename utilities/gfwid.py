@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import logging
+import math
+import multiprocessing
+import random
+import struct
+import time
+
+import parallel
+
+# Rows per batch sent to a worker
+DEFAULT_BATCH_SIZE = 2000
+
+
+def hash_wkb_batch(batch):
+    """
+    Hash the WKB of a batch of geometries. Runs in the worker processes, so it only needs hashlib
+    :param batch: list of (OID, WKB) tuples
+    :return: list of (OID, md5 hex digest) tuples; the digest is None for a null geometry
+    """
+    hashed = []
+
+    for oid, wkb in batch:
+        if wkb:
+            hashed.append((oid, hashlib.md5(wkb).hexdigest()))
+        else:
+            hashed.append((oid, None))
+
+    return hashed
+
+
+def iter_batches(rows, batch_size):
+    """
+    Group rows into lists of batch_size rows without reading them all into memory first
+    :param rows: iterable of (OID, WKB) rows, i.e. a search cursor
+    :param batch_size: rows per batch
+    :return: generator of lists of (OID, WKB) tuples
+    """
+    batch = []
+
+    for oid, wkb in rows:
+        # Cursors return a bytearray; a str is smaller to send to the workers
+        batch.append((oid, str(wkb) if wkb else None))
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def hash_batches(batches, workers):
+    """
+    Hash batches of geometries in a pool of worker processes, keeping only a few batches in flight at once
+    :param batches: iterable of batches from iter_batches()
+    :param workers: number of worker processes; 1 hashes in this process
+    :return: generator of lists of (OID, md5 hex digest) tuples
+    """
+    return parallel.imap_bounded(hash_wkb_batch, batches, workers)
+
+
+def calculate_gfwids(in_fc, workers, batch_size=DEFAULT_BATCH_SIZE, gfwid_field='gfwid'):
+    """
+    Populate the gfwid field with the md5 of each geometry's WKB. Geometries are read and hashed in batches, then
+    the results are written in a single update cursor pass
+    :param in_fc: FC with a gfwid field
+    :param workers: number of worker processes to hash with
+    :param batch_size: rows per batch
+    :param gfwid_field: name of the field to populate
+    :return: number of rows updated
+    """
+    # Only needed here; the worker processes just hash
+    import arcpy
+
+    gfwid_dict = {}
+    start_time = time.time()
+
+    with arcpy.da.SearchCursor(in_fc, ['OID@', 'SHAPE@WKB']) as cursor:
+        for hashed in hash_batches(iter_batches(cursor, batch_size), workers):
+            gfwid_dict.update(hashed)
+
+    logging.debug('Hashed {0} geometries in {1:.1f} seconds with {2} workers'.format(len(gfwid_dict),
+                                                                                     time.time() - start_time,
+                                                                                     workers))
+
+    with arcpy.da.UpdateCursor(in_fc, ['OID@', gfwid_field]) as cursor:
+        for row in cursor:
+            row[1] = gfwid_dict.get(row[0])
+            cursor.updateRow(row)
+
+    return len(gfwid_dict)
+
+
+def synthetic_polygon_wkb(vertex_count):
+    """
+    Build the WKB for a random, roughly circular polygon; used by the benchmark
+    :param vertex_count: vertices in the polygon's ring
+    :return: little endian WKB str
+    """
+    center_x, center_y = random.uniform(-180, 180), random.uniform(-80, 80)
+    radius = random.uniform(0.001, 1)
+
+    points = []
+    for i in range(vertex_count):
+        angle = 2 * math.pi * i / vertex_count
+        points.append((center_x + radius * math.cos(angle), center_y + radius * math.sin(angle)))
+
+    # Close the ring
+    points.append(points[0])
+
+    wkb = struct.pack('<bII', 1, 3, 1) + struct.pack('<I', len(points))
+    wkb += ''.join([struct.pack('<dd', x, y) for x, y in points])
+
+    return wkb
+
+
+def main():
+    """
+    Benchmark hashing on synthetic polygons, so we can track rows/sec for different dataset sizes and worker counts
+    """
+    parser = argparse.ArgumentParser(description='Benchmark gfwid hashing on synthetic polygons.')
+    parser.add_argument('--rows', '-r', type=int, nargs='+', default=[10000, 100000],
+                        help='dataset sizes to test')
+    parser.add_argument('--vertices', '-v', type=int, default=500, help='vertices per polygon')
+    parser.add_argument('--workers', '-w', type=int, nargs='+', default=[1, multiprocessing.cpu_count()],
+                        help='worker counts to test')
+    parser.add_argument('--batch-size', '-b', type=int, default=DEFAULT_BATCH_SIZE, help='rows per batch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Reuse a pool of shapes so building the test data doesn't take longer than hashing it
+    shape_pool = [synthetic_polygon_wkb(args.vertices) for i in range(1000)]
+
+    for row_count in args.rows:
+        rows = [(oid, shape_pool[oid % len(shape_pool)]) for oid in range(row_count)]
+
+        for workers in args.workers:
+            start_time = time.time()
+            hashed_count = sum([len(x) for x in hash_batches(iter_batches(rows, args.batch_size), workers)])
+            elapsed = time.time() - start_time
+
+            logging.info('{0} rows, {1} vertices, {2} workers: {3:.0f} rows/sec'.format(hashed_count, args.vertices,
+                                                                                    workers,
+                                                                                    hashed_count / max(elapsed, 0.001)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,178 @@
 import gspread
+import json
+import os
 import time
 import sys
 import logging
 from oauth2client.service_account import ServiceAccountCredentials
 
+DEFAULT_SPREADSHEET_KEY = r'1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI'
+
+# Bump this if the layout of the on-disk snapshot changes; older files will be ignored and refetched
+SNAPSHOT_VERSION = 1
+
+# How long (in seconds) a snapshot written to disk is considered fresh
+SNAPSHOT_TTL = 12 * 60 * 60
+
+# In-memory snapshots for this process, keyed by (spreadsheet_key, sheet_name)
+_snapshots = {}
+
+# Path to the on-disk snapshot file, if one has been set with use_snapshot()
+_snapshot_path = None
+_snapshot_ttl = SNAPSHOT_TTL
+
+# Cell updates waiting to be written to the sheet, as dicts of sheet_name, spreadsheet_key, row, col and value
+_pending_updates = []
+
+# If set with defer_updates(), flush_updates() appends to this journal instead of writing to the sheet
+_update_journal = None
+
+# Authorized gspread client, reused for every sheet we open in this process
+_client = None
+
+
+class ConfigSnapshot(object):
+    """
+    A copy of one sheet of the config table, fetched once and indexed by tech_title. All reads of the config table
+    go through this object, so a single gfw-sync run (or an entire cron batch sharing a snapshot file) only
+    downloads the sheet once
+    :param sheet_name: the name of the sheet (prod | staging)
+    :param header_row: the first row of the sheet
+    :param data_rows: all remaining rows of the sheet
+    :param spreadsheet_key: key of the google doc
+    :param fetched: epoch time the sheet was downloaded
+    """
+    def __init__(self, sheet_name, header_row, data_rows, spreadsheet_key=DEFAULT_SPREADSHEET_KEY, fetched=None):
+        self.sheet_name = sheet_name
+        self.spreadsheet_key = spreadsheet_key
+        self.header_row = list(header_row)
+        self.data_rows = [list(r) for r in data_rows]
+
+        if fetched:
+            self.fetched = fetched
+        else:
+            self.fetched = time.time()
+
+    def is_stale(self, ttl):
+        """
+        Check if the snapshot is older than the ttl
+        :param ttl: time to live in seconds; None means the snapshot never expires
+        :return: True | False
+        """
+        if ttl is None:
+            return False
+
+        return time.time() - self.fetched > ttl
+
+    def cell_location(self, unique_id_col, unique_id_value, colname):
+        """
+        Get the 1-based row and col of a cell in the sheet, the same way gspread counts them
+        :param unique_id_col: the column that has unique ids (tech_title in the config table)
+        :param unique_id_value: the particular value we're looking for in the unique id col
+        :param colname: the column name of interest
+        :return: row_id, col_id
+        """
+        unique_id_index = self.header_row.index(unique_id_col)
+
+        # Add 2: one for the header row and one because gspread indexes from 1
+        row_id = [r[unique_id_index] for r in self.data_rows].index(unique_id_value) + 2
+        col_id = self.header_row.index(colname) + 1
+
+        return row_id, col_id
+
+    def get_cell(self, unique_id_col, unique_id_value, colname):
+        row_id, col_id = self.cell_location(unique_id_col, unique_id_value, colname)
+
+        return self.data_rows[row_id - 2][col_id - 1]
+
+    def set_cell(self, unique_id_col, unique_id_value, colname, value):
+        """
+        Update the value in the snapshot only; used to keep it in line with what we've written to the sheet
+        """
+        row_id, col_id = self.cell_location(unique_id_col, unique_id_value, colname)
+        row = self.data_rows[row_id - 2]
+
+        # Rows returned by get_all_values() are padded to the sheet width, but be safe for hand-built snapshots
+        while len(row) < col_id:
+            row.append('')
+
+        row[col_id - 1] = value
+
+    def to_dict(self):
+        """
+        Convert the snapshot to a dict with {layername: {colName: colVal, colName2: colVal}
+        Builds new dicts every time, so callers are free to modify the layerdefs they get back
+        :return: a dictionary representing the sheet
+        """
+        sheet_as_dict = {}
+
+        for data_row in self.data_rows:
+
+            # Build a dictionary for each row with the column title
+            # as the key and the value of that row as the value
+            row_as_dict = {k: v for (k, v) in zip(self.header_row, data_row)}
+
+            # Grab the technical title (what we know the layer as) and use it as the key
+            sheet_as_dict[row_as_dict['tech_title']] = row_as_dict
+
+        return sheet_as_dict
+
+    def save(self, path):
+        """
+        Write the snapshot to disk. Each process writes its own temp file and then renames it into place, so a
+        reader sees a whole snapshot or none at all (and fetches the sheet itself). Several processes can save at
+        once; if another one gets its snapshot into place first, ours is dropped, as both are just as fresh
+        :param path: path to the json snapshot
+        """
+        out_dir = os.path.dirname(path)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'sheet_name': self.sheet_name,
+                    'spreadsheet_key': self.spreadsheet_key,
+                    'fetched': self.fetched,
+                    'header_row': self.header_row,
+                    'data_rows': self.data_rows}
+
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+
+        try:
+            # os.rename won't overwrite on Windows
+            if os.path.exists(path):
+                os.remove(path)
+
+            os.rename(temp_path, path)
+
+        except OSError as e:
+            # Another process removed, replaced or has the snapshot open; its copy will do
+            logging.debug('Unable to replace config snapshot {0}: {1}. Leaving the existing one'.format(path, e))
+            os.remove(temp_path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a snapshot from disk
+        :param path: path to the json snapshot
+        :return: a ConfigSnapshot, or None if the file is missing or from an older snapshot version
+        """
+        # Another process may be replacing it right now
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logging.debug('Config snapshot {0} has version {1}; ignoring it'.format(path, snapshot.get('version')))
+            return None
+
+        return cls(snapshot['sheet_name'], snapshot['header_row'], snapshot['data_rows'],
+                   snapshot['spreadsheet_key'], snapshot['fetched'])
+
 
 def _open_spreadsheet(sheet_name, custom_key=False):
     """
@@ -16,51 +185,97 @@ def _open_spreadsheet(sheet_name, custom_key=False):
     if custom_key:
         spreadsheet_key = custom_key
     else:
-        spreadsheet_key = r'1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI'
+        spreadsheet_key = DEFAULT_SPREADSHEET_KEY
+
+    global _client
 
     # Updated for oauth2client
     # http://gspread.readthedocs.org/en/latest/oauth2.html
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(spreadsheet_file,
-                                                                   ['https://spreadsheets.google.com/feeds'])
+    if not _client:
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(spreadsheet_file,
+                                                                       ['https://spreadsheets.google.com/feeds'])
+        _client = gspread.authorize(credentials)
 
-    gc = gspread.authorize(credentials)
-    wks = gc.open_by_key(spreadsheet_key).worksheet(sheet_name)
+    # A worker process can outlive the access token
+    elif _client.auth.access_token_expired:
+        _client.login()
+
+    wks = _client.open_by_key(spreadsheet_key).worksheet(sheet_name)
 
     return wks
 
 
-def sheet_to_dict(gfw_env):
+def use_snapshot(path, ttl=SNAPSHOT_TTL):
     """
-    Convert the spreadsheet to a dict with {layername: {colName: colVal, colName2: colVal}
-    :param gfw_env: the name of the sheet to call (prod | staging)
-    :return: a dictionary representing the sheet
+    Read and write the config table through a snapshot file on disk. cronjob.py sets this up once and passes
+    the path to every gfw-sync.py run, so a nightly batch only downloads the sheet once
+    :param path: path to the json snapshot
+    :param ttl: seconds the snapshot stays fresh; None to always use the file as-is (useful for offline runs)
     """
+    global _snapshot_path, _snapshot_ttl
+
+    _snapshot_path = path
+    _snapshot_ttl = ttl
+
+    # Anything already in memory may have come from a different source
+    _snapshots.clear()
+
+
+def get_snapshot(sheet_name, spreadsheet_key=None, refresh=False):
+    """
+    Get the snapshot for a sheet, in order of preference from memory, from the snapshot file, or from Google
+    :param sheet_name: the name of the sheet (prod | staging)
+    :param spreadsheet_key: key for the spreadsheet if not the default config table
+    :param refresh: force a new download of the sheet
+    :return: a ConfigSnapshot
+    """
+    if not spreadsheet_key:
+        spreadsheet_key = DEFAULT_SPREADSHEET_KEY
+
+    cache_key = (spreadsheet_key, sheet_name)
 
-    sheet_as_dict = {}
-    wks = _open_spreadsheet(gfw_env)
-    gdoc_as_lists = wks.get_all_values()
+    if not refresh and cache_key in _snapshots:
+        return _snapshots[cache_key]
 
-    # Pull the header row from the Google doc
-    header_row = gdoc_as_lists[0]
+    snapshot = None
 
-    # Iterate over the remaining data rows
-    for dataRow in gdoc_as_lists[1:]:
+    # Only the default config table is stored on disk
+    use_disk = _snapshot_path and spreadsheet_key == DEFAULT_SPREADSHEET_KEY
 
-        # Build a dictionary for each row with the column title
-        # as the key and the value of that row as the value
-        row_as_dict = {k: v for (k, v) in zip(header_row, dataRow)}
+    if use_disk and not refresh:
+        snapshot = ConfigSnapshot.load(_snapshot_path)
 
-        # Grab the technical title (what we know the layer as)
-        layer_name = row_as_dict['tech_title']
+        if snapshot and snapshot.sheet_name != sheet_name:
+            snapshot = None
 
-        # Add that as a key to the larger outDict dictionary
-        sheet_as_dict[layer_name] = {}
+        elif snapshot and snapshot.is_stale(_snapshot_ttl):
+            logging.debug('Config snapshot {0} is older than {1} seconds; '
+                          'refreshing it'.format(_snapshot_path, _snapshot_ttl))
+            snapshot = None
 
-        # For the values in each row, add them to the row-level dictionary
-        for key, value in row_as_dict.iteritems():
-            sheet_as_dict[layer_name][key] = value
+    if not snapshot:
+        logging.debug('Downloading sheet {0} of the config table'.format(sheet_name))
+        wks = _open_spreadsheet(sheet_name, spreadsheet_key)
+        gdoc_as_lists = wks.get_all_values()
 
-    return sheet_as_dict
+        snapshot = ConfigSnapshot(sheet_name, gdoc_as_lists[0], gdoc_as_lists[1:], spreadsheet_key)
+
+        if use_disk:
+            snapshot.save(_snapshot_path)
+
+    _snapshots[cache_key] = snapshot
+
+    return snapshot
+
+
+def sheet_to_dict(gfw_env):
+    """
+    Convert the spreadsheet to a dict with {layername: {colName: colVal, colName2: colVal}
+    :param gfw_env: the name of the sheet to call (prod | staging)
+    :return: a dictionary representing the sheet
+    """
+
+    return get_snapshot(gfw_env).to_dict()
 
 
 def get_layerdef(layer_name, gfw_env):
@@ -87,6 +302,24 @@ def get_layerdef(layer_name, gfw_env):
 def set_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_value, spreadsheet_key=None):
     """
     Update a value in the spreadsheet given the layername and column name
+    Writes immediately; use queue_value() and flush_updates() to batch several updates together
+    :param unique_id_col: the column that has unique ids (tech_title in the config table)
+    :param unique_id_value: the particular value we're looking for in the unique id col
+    :param colname: the column name to update
+    :param sheet_name: the name of the sheet to update
+    :param in_update_value: the value to set
+    :param spreadsheet_key: key for the spreadsheet if not the default config table
+    """
+
+    queue_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_value, spreadsheet_key)
+    flush_updates()
+
+
+def queue_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_value, spreadsheet_key=None):
+    """
+    Add a cell update to the write buffer; nothing is sent to Google until flush_updates() is called
+    The cell is located using the in-memory snapshot, and the snapshot is updated right away so that later
+    reads in this run see the new value
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
     :param colname: the column name to update
@@ -94,15 +327,147 @@ def set_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_val
     :param in_update_value: the value to set
     :param spreadsheet_key: key for the spreadsheet if not the default config table
     """
+    if not spreadsheet_key:
+        spreadsheet_key = DEFAULT_SPREADSHEET_KEY
+
+    snapshot = get_snapshot(sheet_name, spreadsheet_key)
+
+    row_id, col_id = snapshot.cell_location(unique_id_col, unique_id_value, colname)
+    snapshot.set_cell(unique_id_col, unique_id_value, colname, in_update_value)
+
+    logging.debug('Queueing update of {0} for {1} to {2}'.format(colname, unique_id_value, in_update_value))
+
+    _pending_updates.append({'sheet_name': sheet_name, 'spreadsheet_key': spreadsheet_key,
+                             'unique_id_col': unique_id_col, 'unique_id_value': unique_id_value,
+                             'colname': colname, 'row': row_id, 'col': col_id, 'value': in_update_value})
+
+
+def defer_updates(journal_path):
+    """
+    Send queued updates to a journal file instead of the sheet when flush_updates() is called. Used by
+    gfw-sync.py runs started by cronjob.py, so that the cronjob can write all updates for the batch at once
+    with apply_update_journal()
+    :param journal_path: path to the journal; one json update per line
+    """
+    global _update_journal
+
+    _update_journal = journal_path
+
+
+def flush_updates():
+    """
+    Write all queued cell updates, one batched update per sheet. If defer_updates() has been called, append them
+    to the journal file instead
+    """
+    global _pending_updates
+
+    if not _pending_updates:
+        return
+
+    pending = _pending_updates
+    _pending_updates = []
+
+    if _update_journal:
+        logging.debug('Writing {0} config table updates to journal {1}'.format(len(pending), _update_journal))
+
+        with open(_update_journal, 'a') as f:
+            for update in pending:
+                f.write(json.dumps(update) + '\n')
+
+    else:
+        _write_cells(pending)
+
+        # If we're journaling, the snapshot file belongs to the cronjob; leave it alone
+        if _snapshot_path:
+            snapshot = _snapshots.get((DEFAULT_SPREADSHEET_KEY, pending[0]['sheet_name']))
+
+            if snapshot:
+                snapshot.save(_snapshot_path)
+
+
+def discard_updates():
+    """
+    Drop any queued updates that haven't been flushed, e.g. when a layer fails partway through
+    """
+    global _pending_updates
+
+    _pending_updates = []
+
+
+def apply_update_journal(journal_paths):
+    """
+    Write all updates in journals created by deferred gfw-sync.py runs to the sheet, then remove the journals
+    Cell locations are looked up again in the current snapshot in case rows have moved since they were queued
+    :param journal_paths: path to a journal, or a list of them
+    """
+    if not isinstance(journal_paths, list):
+        journal_paths = [journal_paths]
+
+    journal_paths = [j for j in journal_paths if os.path.exists(j)]
+    pending = []
+
+    for journal_path in journal_paths:
+        with open(journal_path) as f:
+            pending += [json.loads(line) for line in f if line.strip()]
+
+    for update in pending:
+        snapshot = get_snapshot(update['sheet_name'], update['spreadsheet_key'])
+
+        update['row'], update['col'] = snapshot.cell_location(update['unique_id_col'], update['unique_id_value'],
+                                                              update['colname'])
+        snapshot.set_cell(update['unique_id_col'], update['unique_id_value'], update['colname'], update['value'])
+
+    _write_cells(pending)
+
+    if _snapshot_path and pending:
+        snapshot = _snapshots.get((DEFAULT_SPREADSHEET_KEY, pending[0]['sheet_name']))
+
+        if snapshot:
+            snapshot.save(_snapshot_path)
+
+    for journal_path in journal_paths:
+        os.remove(journal_path)
+
+
+def _write_cells(updates):
+    """
+    Push cell updates to Google with one update_cells call per sheet
+    The cell range covering the updates is requested only to get gspread cell objects; the rest of the
+    sheet isn't downloaded
+    :param updates: list of update dicts built by queue_value()
+    """
+    sheet_dict = {}
 
-    wks, row_id, col_id = get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key)
+    for update in updates:
+        sheet_id = (update['spreadsheet_key'], update['sheet_name'])
 
-    wks.update_cell(row_id, col_id, in_update_value)
+        # Later updates to the same cell win
+        sheet_dict.setdefault(sheet_id, {})[(update['row'], update['col'])] = update['value']
+
+    for (spreadsheet_key, sheet_name), cell_dict in sheet_dict.iteritems():
+        logging.debug('Writing {0} cells to sheet {1} of the config table'.format(len(cell_dict), sheet_name))
+
+        wks = _open_spreadsheet(sheet_name, spreadsheet_key)
+
+        rows = [row for row, col in cell_dict.keys()]
+        cols = [col for row, col in cell_dict.keys()]
+
+        range_label = '{0}:{1}'.format(gspread.utils.rowcol_to_a1(min(rows), min(cols)),
+                                       gspread.utils.rowcol_to_a1(max(rows), max(cols)))
+
+        cell_list = []
+
+        for cell in wks.range(range_label):
+            if (cell.row, cell.col) in cell_dict:
+                cell.value = cell_dict[(cell.row, cell.col)]
+                cell_list.append(cell)
+
+        wks.update_cells(cell_list)
 
 
 def get_value(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key=None):
     """
-    Update a value in the spreadsheet given the layername and column name
+    Get a value from the spreadsheet given the layername and column name
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
     :param colname: the column name to get the value of
@@ -110,14 +475,13 @@ def get_value(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_k
     :param spreadsheet_key: key for the spreadsheet if not the default config table
     """
 
-    wks, row_id, col_id = get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key)
-
-    return wks.cell(row_id, col_id).value
+    return get_snapshot(sheet_name, spreadsheet_key).get_cell(unique_id_col, unique_id_value, colname)
 
 
 def get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key=None):
     """
     Get the row and col of a particular cell so later we can report the value or update it
+    Uses the config snapshot to find the cell instead of downloading every value again
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
     :param colname: the column name to get the value of
@@ -125,28 +489,24 @@ def get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, sprea
     :param spreadsheet_key: json key if not the default config table
     """
 
-    wks = _open_spreadsheet(sheet_name, spreadsheet_key)
-
-    gdoc_as_lists = wks.get_all_values()
-
-    unique_id_index = gdoc_as_lists[0].index(unique_id_col)
+    row_id, col_id = get_snapshot(sheet_name, spreadsheet_key).cell_location(unique_id_col, unique_id_value, colname)
 
-    row_id = [x[unique_id_index] for x in gdoc_as_lists].index(unique_id_value) + 1
-    col_id = gdoc_as_lists[0].index(colname) + 1
+    wks = _open_spreadsheet(sheet_name, spreadsheet_key)
 
     return wks, row_id, col_id
 
 
 def update_gs_timestamp(layername, gfw_env):
     """
-    Update the 'last_updated' column for the layer specified with the current date
+    Queue an update to the 'last_updated' column for the layer specified with the current date
+    Call flush_updates() afterwards to write it to the sheet
     :param layername: the row to update (based on tech_title column)
     :param gfw_env: gfw env
     """
-    set_value('tech_title', layername, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
+    queue_value('tech_title', layername, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
 
     # If the layer is part of a global_layer, update its last_updated timestamp as well
     associated_global_layer = get_layerdef(layername, gfw_env)['global_layer']
 
     if associated_global_layer:
-        set_value('tech_title', associated_global_layer, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
+        queue_value('tech_title', associated_global_layer, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
@@ -3,15 +3,25 @@ import os
 import time
 
 
-def build_logger(verbosity):
+def get_daily_log_file():
+    """
+    :return: path to today's log file; read by email_stats.send_summary()
+    """
+    return os.path.join(os.getcwd(), 'logs', time.strftime("%Y%m%d") + '.log')
+
+
+def build_logger(verbosity, log_file=None):
     """
     Instantiate a logger based on the verbosity specified in gfw-sync.py at the commandline
     :param verbosity:
+    :param log_file: file to write to; defaults to today's log file
     :return: a logger object used by the rest of the application
     """
 
     # Set logging output file, verbosity, and format
-    log_file = os.path.join(os.getcwd(), 'logs', time.strftime("%Y%m%d") + '.log')
+    if not log_file:
+        log_file = get_daily_log_file()
+
     logging.basicConfig(filename=log_file, level=verbosity.upper(), format='%(levelname)s | %(asctime)s | %(message)s',
                         datefmt='%H:%M:%S')
 
@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+
+from osgeo import gdal
+from osgeo import ogr
+
+# Datasources opened read-only, by path. Opened once per run rather than once per question
+_datasources = {}
+
+# OGR datasources aren't thread safe, and the cartoDB uploader asks about the same one from several threads
+_lock = threading.RLock()
+
+
+def split_path(in_path):
+    """
+    Split a path into the datasource and layer, handling the GDB FC vs shapefile/spatialite difference
+    :param in_path: path to a shapefile, spatialite DB, GeoJSON file or FC in a GDB
+    :return: tuple of (datasource path, layer name or None for the first layer)
+    """
+    # Feature classes in a GDB don't have an extension; the GDB is the datasource
+    if os.path.splitext(in_path)[1] == '':
+        return os.path.dirname(in_path), os.path.basename(in_path)
+
+    return in_path, None
+
+
+def _error(message):
+    last_error = gdal.GetLastErrorMsg()
+
+    if last_error:
+        message = '{0}: {1}'.format(message, last_error)
+
+    return RuntimeError(message)
+
+
+def open_datasource(path, update=False):
+    """
+    Open a datasource. Read-only datasources are kept open until clear() or invalidate()
+    :param path: path to the datasource
+    :param update: open for writing; not cached
+    :return: an ogr.DataSource
+    """
+    if update:
+        datasource = ogr.Open(path, update=True)
+
+        if not datasource:
+            raise _error('Unable to open {0} for writing'.format(path))
+
+        return datasource
+
+    with _lock:
+        if path not in _datasources:
+            datasource = ogr.Open(path)
+
+            if not datasource:
+                raise _error('Unable to open {0}'.format(path))
+
+            _datasources[path] = datasource
+
+        return _datasources[path]
+
+
+def get_layer(in_path, layer_name=None):
+    """
+    :param in_path: path to a shapefile, spatialite DB, GeoJSON file or FC in a GDB
+    :param layer_name: the layer; defaults to the FC name for a GDB, otherwise the first layer
+    :return: an ogr.Layer
+    """
+    datasource_path, default_layer = split_path(in_path)
+    layer_name = layer_name or default_layer
+
+    datasource = open_datasource(datasource_path)
+    layer = datasource.GetLayerByName(layer_name) if layer_name else datasource.GetLayer(0)
+
+    if not layer:
+        raise _error('No layer {0} in {1}'.format(layer_name or 0, datasource_path))
+
+    return layer
+
+
+def feature_count(in_path, where_clause=None):
+    """
+    :param in_path: path to the dataset
+    :param where_clause: optional attribute filter
+    :return: number of features
+    """
+    with _lock:
+        layer = get_layer(in_path)
+        layer.SetAttributeFilter(where_clause)
+
+        try:
+            return layer.GetFeatureCount()
+        finally:
+            layer.SetAttributeFilter(None)
+
+
+def min_max(in_path, field_name, where_clause=None):
+    """
+    :param in_path: path to the dataset
+    :param field_name: field to get the range of
+    :param where_clause: optional attribute filter
+    :return: tuple of (min, max); both None if there are no features
+    """
+    with _lock:
+        layer = get_layer(in_path)
+        datasource = open_datasource(split_path(in_path)[0])
+
+        sql = 'SELECT MIN({0}) AS min_value, MAX({0}) AS max_value FROM "{1}"'.format(field_name, layer.GetName())
+
+        if where_clause:
+            sql += ' WHERE {0}'.format(where_clause)
+
+        result = datasource.ExecuteSQL(sql)
+
+        if not result:
+            raise _error('Unable to get the range of {0} in {1}'.format(field_name, in_path))
+
+        try:
+            feature = result.GetNextFeature()
+            return feature.GetField(0), feature.GetField(1)
+
+        finally:
+            datasource.ReleaseResultSet(result)
+
+
+def geometry_type(in_path):
+    """
+    :param in_path: path to the dataset
+    :return: the layer's geometry type as a lowercase name, i.e. 'multi polygon' or 'line string'
+    """
+    with _lock:
+        return ogr.GeometryTypeToName(get_layer(in_path).GetGeomType()).lower()
+
+
+def _set_config_option(key, value):
+    # Thread-local where GDAL has it, so uploader threads don't see each other's options
+    if hasattr(gdal, 'SetThreadLocalConfigOption'):
+        gdal.SetThreadLocalConfigOption(key, value)
+    else:
+        gdal.SetConfigOption(key, value)
+
+
+def translate(out_path, in_path, options=None, config_options=None, layer_name=None):
+    """
+    Convert or append a dataset in process, like ogr2ogr
+    :param out_path: output datasource, i.e. a path or CartoDB:account
+    :param in_path: path to a shapefile, spatialite DB, GeoJSON file or FC in a GDB
+    :param options: list of ogr2ogr options, i.e. ['-f', 'SQLite', '-dim', '2']
+    :param config_options: dict of GDAL config options for this conversion, i.e. {'CARTODB_API_KEY': key}
+    :param layer_name: the layer to convert; defaults to the FC name for a GDB, otherwise every layer
+    :return:
+    """
+    datasource_path, default_layer = split_path(in_path)
+    layer_name = layer_name or default_layer
+
+    logging.debug('Converting {0} to {1} with options {2}'.format(in_path, out_path, ' '.join(options or [])))
+
+    # Anything we have open for the output is about to be out of date
+    invalidate(out_path)
+
+    config_options = config_options or {}
+
+    for key, value in config_options.iteritems():
+        _set_config_option(key, value)
+
+    try:
+        # Open the source separately; VectorTranslate can take a while and shouldn't hold the lock
+        src_datasource = ogr.Open(datasource_path)
+
+        if not src_datasource:
+            raise _error('Unable to open {0}'.format(datasource_path))
+
+        translate_options = gdal.VectorTranslateOptions(options=options or [],
+                                                        layers=[layer_name] if layer_name else None)
+
+        gdal.ErrorReset()
+        out_datasource = gdal.VectorTranslate(out_path, src_datasource, options=translate_options)
+
+        if not out_datasource:
+            raise _error('Unable to convert {0} to {1}'.format(in_path, out_path))
+
+        # Dereferencing the output closes it and flushes everything to disk
+        out_datasource = None
+        src_datasource = None
+
+    finally:
+        for key in config_options:
+            _set_config_option(key, None)
+
+
+def invalidate(path):
+    """
+    Close a cached datasource, i.e. after it's been written to
+    :param path: path to the datasource, or to a layer in it
+    """
+    with _lock:
+        for datasource_path in [path, split_path(path)[0]]:
+            _datasources.pop(datasource_path, None)
+
+
+def clear():
+    """
+    Close every cached datasource. Called between layers
+    """
+    with _lock:
+        _datasources.clear()
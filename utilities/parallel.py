@@ -0,0 +1,47 @@
+import collections
+import multiprocessing
+import multiprocessing.pool
+
+# Batches waiting for a worker, per worker. Limits how far the reader gets ahead of the workers
+BATCHES_IN_FLIGHT = 2
+
+
+def imap_bounded(func, batches, workers, threads=False):
+    """
+    Run func on each batch in a pool of worker processes, returning results in order. Unlike Pool.imap, only a few
+    batches per worker are read ahead, so batches can be streamed from a cursor without all being held in memory
+    :param func: a module level function (so it can be pickled) that takes one batch
+    :param batches: iterable of batches
+    :param workers: number of worker processes; 1 runs func in this process
+    :param threads: use threads instead of processes, for work that releases the GIL (i.e. zlib) and batches that
+    are expensive to pickle
+    :return: generator of func results
+    """
+    if workers <= 1:
+        for batch in batches:
+            yield func(batch)
+
+        return
+
+    pool = multiprocessing.pool.ThreadPool(workers) if threads else multiprocessing.Pool(workers)
+
+    try:
+        pending = collections.deque()
+
+        for batch in batches:
+            pending.append(pool.apply_async(func, (batch, )))
+
+            if len(pending) >= workers * BATCHES_IN_FLIGHT:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
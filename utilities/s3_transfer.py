@@ -0,0 +1,406 @@
+import argparse
+import logging
+import mimetypes
+import os
+import Queue
+import threading
+import time
+import urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import settings
+
+# Size of each part of a multipart upload, and parts uploaded at once, unless settings.ini says otherwise. Memory
+# used by a MultipartWriter is at most (workers + 2) parts
+DEFAULT_PART_SIZE_MB = 16
+DEFAULT_WORKERS = 8
+
+# S3 won't take parts smaller than this, other than the last
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# One boto3 client per environment; clients are thread safe and keep their connections open between calls
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_s3_settings(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: tuple of (endpoint URL or None for AWS, part size in bytes, workers)
+    """
+    s3_settings = settings.get_settings(gfw_env).get('s3', {})
+
+    endpoint_url = s3_settings.get('endpoint_url') or None
+    part_size = max(int(s3_settings.get('part_size_mb', DEFAULT_PART_SIZE_MB)) * 1024 * 1024, MIN_PART_SIZE)
+    workers = int(s3_settings.get('upload_workers', DEFAULT_WORKERS))
+
+    return endpoint_url, part_size, workers
+
+
+def get_client(gfw_env):
+    """
+    Get the S3 client for this environment, creating it the first time it's used
+    :param gfw_env: gfw env
+    :return: a boto3 S3 client
+    """
+    with _lock:
+        if gfw_env not in _clients:
+            endpoint_url, part_size, workers = get_s3_settings(gfw_env)
+
+            # Enough connections for every upload thread, plus the managed transfers' own threads
+            config = Config(max_pool_connections=workers * 2, retries={'max_attempts': 10})
+
+            _clients[gfw_env] = boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+        return _clients[gfw_env]
+
+
+def get_transfer_config(gfw_env):
+    """
+    :param gfw_env: gfw env
+    :return: a TransferConfig for boto3's managed uploads, downloads and copies
+    """
+    endpoint_url, part_size, workers = get_s3_settings(gfw_env)
+
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=workers)
+
+
+def is_s3_url(path):
+    return r's3://' in path
+
+
+def parse_s3_url(url):
+    """
+    :param url: s3://bucket/key
+    :return: tuple of (bucket, key)
+    """
+    parsed = urlparse.urlparse(url)
+
+    if parsed.scheme != 's3' or not parsed.netloc or not parsed.path.lstrip('/'):
+        raise ValueError('Not an S3 object URL: {0}'.format(url))
+
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+class MultipartWriter(object):
+    """
+    File-like object that uploads what's written to it to S3 as it goes, several parts at once. Nothing is visible
+    in S3 until close(); abort() (or an exception in a with block) throws the upload away
+    :param client: a boto3 S3 client
+    :param url: s3://bucket/key to write
+    :param part_size: bytes per part
+    :param workers: parts uploaded at once
+    """
+    def __init__(self, client, url, part_size=DEFAULT_PART_SIZE_MB * 1024 * 1024, workers=DEFAULT_WORKERS):
+        self.client = client
+        self.url = url
+        self.bucket, self.key = parse_s3_url(url)
+
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.workers = workers
+
+        self._buffer = []
+        self._buffered = 0
+        self._position = 0
+
+        self._upload_id = None
+        self._part_number = 0
+        self._etags = {}
+
+        self._queue = None
+        self._threads = []
+        self._error = None
+
+        self.closed = False
+
+    def write(self, data):
+        self._check_error()
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._position += len(data)
+
+        if self._buffered >= self.part_size:
+            data = ''.join(self._buffer)
+
+            while len(data) >= self.part_size:
+                self._submit_part(data[:self.part_size])
+                data = data[self.part_size:]
+
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def _start(self):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                       ContentType=content_type(self.key))
+        self._upload_id = response['UploadId']
+
+        # Bounded, so the writer waits for the workers rather than buffering the whole file
+        self._queue = Queue.Queue(maxsize=1)
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._upload_parts)
+            thread.daemon = True
+            thread.start()
+
+            self._threads.append(thread)
+
+    def _submit_part(self, data):
+        if not self._upload_id:
+            self._start()
+
+        self._part_number += 1
+
+        while True:
+            self._check_error()
+
+            try:
+                self._queue.put((self._part_number, data), timeout=1)
+                break
+            except Queue.Full:
+                pass
+
+    def _upload_parts(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                return
+
+            part_number, data = item
+
+            # Once one part has failed the upload is going to be aborted; don't bother with the rest
+            if self._error:
+                continue
+
+            try:
+                response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                   PartNumber=part_number, Body=data)
+                self._etags[part_number] = response['ETag']
+
+            except Exception as e:
+                self._error = e
+
+    def _check_error(self):
+        if self._error:
+            raise self._error
+
+    def _stop_workers(self):
+        for thread in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def close(self):
+        """
+        Upload what's left and complete the upload
+        """
+        if self.closed:
+            return
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+
+        # Small enough for one request
+        if not self._upload_id:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=data, ContentType=content_type(self.key))
+            self.closed = True
+            return
+
+        try:
+            # The last part can be any size
+            if data:
+                self._submit_part(data)
+
+            self._stop_workers()
+            self._check_error()
+
+            parts = [{'PartNumber': x, 'ETag': self._etags[x]} for x in sorted(self._etags)]
+
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': parts})
+
+        except:
+            self.abort()
+            raise
+
+        self.closed = True
+        logging.debug('Uploaded {0} bytes to {1} in {2} parts'.format(self._position, self.url, len(parts)))
+
+    def abort(self):
+        """
+        Throw away anything uploaded so far, so S3 doesn't keep (and bill for) the parts
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self._upload_id:
+            self._error = self._error or RuntimeError('Upload to {0} aborted'.format(self.url))
+            self._stop_workers()
+
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+def open_writer(url, gfw_env):
+    """
+    :param url: s3://bucket/key to write
+    :param gfw_env: gfw env
+    :return: a MultipartWriter using the environment's client and part size
+    """
+    endpoint_url, part_size, workers = get_s3_settings(gfw_env)
+
+    return MultipartWriter(get_client(gfw_env), url, part_size, workers)
+
+
+def open_reader(url, gfw_env):
+    """
+    :param url: s3://bucket/key to read
+    :param gfw_env: gfw env
+    :return: the object's body, as a file-like object
+    """
+    bucket, key = parse_s3_url(url)
+
+    return get_client(gfw_env).get_object(Bucket=bucket, Key=key)['Body']
+
+
+def exists(url, gfw_env):
+    """
+    :param url: s3://bucket/key
+    :param gfw_env: gfw env
+    :return: True if the object exists
+    """
+    bucket, key = parse_s3_url(url)
+
+    try:
+        get_client(gfw_env).head_object(Bucket=bucket, Key=key)
+
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return False
+        raise
+
+    return True
+
+
+def content_type(key):
+    """
+    :param key: S3 key
+    :return: the Content-Type to serve it with, from its extension, like the aws CLI sets it; i.e. application/zip
+    """
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+def upload_file(path, url, gfw_env):
+    """
+    Upload a local file, in parallel parts if it's large
+    :param path: local file
+    :param url: s3://bucket/key
+    :param gfw_env: gfw env
+    """
+    bucket, key = parse_s3_url(url)
+    get_client(gfw_env).upload_file(path, bucket, key, ExtraArgs={'ContentType': content_type(key)},
+                                    Config=get_transfer_config(gfw_env))
+
+
+def download_file(url, path, gfw_env):
+    """
+    Download an object to a local file, in parallel ranges if it's large
+    :param url: s3://bucket/key
+    :param path: local file
+    :param gfw_env: gfw env
+    """
+    bucket, key = parse_s3_url(url)
+    get_client(gfw_env).download_file(bucket, key, path, Config=get_transfer_config(gfw_env))
+
+
+def copy(src_url, dst_url, gfw_env):
+    """
+    Copy an object within S3. The data never leaves S3; large objects are copied in parallel parts. The Content-Type
+    is set again from the key, as multipart copies don't carry it over from the source
+    :param src_url: s3://bucket/key to copy
+    :param dst_url: s3://bucket/key to copy to
+    :param gfw_env: gfw env
+    """
+    src_bucket, src_key = parse_s3_url(src_url)
+    dst_bucket, dst_key = parse_s3_url(dst_url)
+
+    logging.debug('Copying {0} to {1}'.format(src_url, dst_url))
+
+    # REPLACE, or a single part copy would ignore the ContentType and keep the source's
+    extra_args = {'ContentType': content_type(dst_key), 'MetadataDirective': 'REPLACE'}
+
+    get_client(gfw_env).copy({'Bucket': src_bucket, 'Key': src_key}, dst_bucket, dst_key, ExtraArgs=extra_args,
+                             Config=get_transfer_config(gfw_env))
+
+
+def main():
+    """
+    Stream a local file to S3 through a MultipartWriter, then copy it server-side, timing both. Point --endpoint-url
+    at a local S3 stand-in (i.e. moto_server or minio) to test without touching AWS
+    """
+    parser = argparse.ArgumentParser(description='Test multipart uploads and server-side copies to S3.')
+    parser.add_argument('source', help='local file to upload')
+    parser.add_argument('url', help='s3://bucket/key to upload to; it will also be copied to key + .copy')
+    parser.add_argument('--endpoint-url', '-u', help='S3 endpoint, i.e. http://localhost:5000')
+    parser.add_argument('--part-size', '-p', type=int, default=DEFAULT_PART_SIZE_MB, help='part size in MB')
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS, help='parts uploaded at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    client = boto3.client('s3', endpoint_url=args.endpoint_url,
+                          config=Config(max_pool_connections=args.workers * 2))
+
+    start_time = time.time()
+
+    with open(args.source, 'rb') as src, MultipartWriter(client, args.url, args.part_size * 1024 * 1024,
+                                                         args.workers) as writer:
+        while True:
+            data = src.read(1024 * 1024)
+
+            if not data:
+                break
+
+            writer.write(data)
+
+    size_mb = os.path.getsize(args.source) / 1024.0 / 1024.0
+    elapsed = time.time() - start_time
+
+    logging.info('Uploaded {0:.1f} MB in {1:.1f} seconds ({2:.1f} MB/second)'.format(size_mb, elapsed,
+                                                                                     size_mb / max(elapsed, 0.001)))
+
+    start_time = time.time()
+
+    src_bucket, src_key = parse_s3_url(args.url)
+    client.copy({'Bucket': src_bucket, 'Key': src_key}, src_bucket, src_key + '.copy',
+                Config=TransferConfig(multipart_chunksize=args.part_size * 1024 * 1024, max_concurrency=args.workers))
+
+    logging.info('Copied server-side in {0:.1f} seconds'.format(time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+import logger
+
+# Resource classes we can infer from a layerdef. Layers that share a resource class with a limit of 1 never run
+# at the same time; anything without a limit listed in settings.ini is also limited to 1
+SDE = 'sde'
+CARTO = 'carto'
+ARCGIS_SERVER = 'arcgis_server'
+EC2_PROCESSING_SERVER = 'ec2_processing_server'
+
+
+def get_resource_classes(layerdef):
+    """
+    Get the resource classes a layer needs while it runs. Uses the resource_classes column of the config table if
+    it's populated (comma separated), otherwise works them out from the layer's outputs
+    :param layerdef: the layerdef from the config table
+    :return: a sorted list of resource class names
+    """
+    declared = layerdef.get('resource_classes')
+
+    if declared:
+        return sorted({x.strip() for x in declared.split(',') if x.strip()})
+
+    resource_classes = set()
+
+    # All appends to SDE create a version and then sync the same replica
+    if '.sde' in layerdef.get('esri_service_output', ''):
+        resource_classes.add(SDE)
+
+    if layerdef.get('cartodb_service_output'):
+        resource_classes.add(CARTO)
+
+    # Tile caches stop/start map services on the local ArcGIS Server
+    if layerdef.get('tile_cache_service'):
+        resource_classes.add(ARCGIS_SERVER)
+
+    # Tiles for these are built on the EC2 processing server, which only one layer can use at a time
+    if layerdef.get('type') == 'global_forest_change':
+        resource_classes.add(EC2_PROCESSING_SERVER)
+
+    # Country layers update their global layer too; two countries can't update the same global layer at once
+    if layerdef.get('global_layer'):
+        resource_classes.update([SDE, CARTO, 'global_layer:' + layerdef['global_layer']])
+
+    return sorted(resource_classes)
+
+
+class LayerScheduler(object):
+    """
+    Runs gfw-sync.py for a list of layers, several at a time. Each layer's resource classes act as semaphores:
+    a layer only starts when a worker is free and all of its resources have capacity left, so conflicting layers
+    run one after the other and independent ones overlap
+    Each layer logs to its own file; when it finishes, that file is appended to the daily log in one piece so
+    email_stats.send_summary() reads the same thing it did when layers ran one at a time
+    :param workers: max number of layers to run at once
+    :param resource_limits: dict of {resource_class: max layers using it at once}
+    :param log_dir: dir for the per-layer log files
+    """
+    def __init__(self, workers, resource_limits, log_dir):
+        self.workers = workers
+        self.resource_limits = resource_limits
+        self.log_dir = log_dir
+
+        self.in_use = {}
+        self.pending = []
+        self.running = {}
+        self.results = {}
+
+    def add_layer(self, layername, cmd, resource_classes):
+        """
+        Queue a layer to run
+        :param layername: the layer's tech_title, or a comma separated list if cmd runs several layers
+        :param cmd: list of args to run gfw-sync.py for this layer (without the log file)
+        :param resource_classes: list of resource classes this layer needs
+        """
+        self.pending.append({'layername': layername, 'cmd': cmd, 'resource_classes': resource_classes})
+
+    def _limit(self, resource_class):
+        return int(self.resource_limits.get(resource_class, 1))
+
+    def _can_start(self, job):
+        if len(self.running) >= self.workers:
+            return False
+
+        for resource_class in job['resource_classes']:
+            if self.in_use.get(resource_class, 0) >= self._limit(resource_class):
+                return False
+
+        return True
+
+    def _start(self, job):
+        for resource_class in job['resource_classes']:
+            self.in_use[resource_class] = self.in_use.get(resource_class, 0) + 1
+
+        # Jobs that run several layers are named for all of them; use the first for the log file
+        log_name = job['layername'].split(',')[0]
+        job['log_file'] = os.path.join(self.log_dir, '{0}_{1}.log'.format(time.strftime("%Y%m%d"), log_name))
+
+        if os.path.exists(job['log_file']):
+            os.remove(job['log_file'])
+
+        logging.info('Starting {0}; resources: {1}'.format(job['layername'], ', '.join(job['resource_classes'])))
+
+        job['process'] = subprocess.Popen(job['cmd'] + ['-o', job['log_file']])
+        job['start_time'] = time.time()
+
+        self.running[job['layername']] = job
+
+    def _finish(self, job):
+        for resource_class in job['resource_classes']:
+            self.in_use[resource_class] -= 1
+
+        del self.running[job['layername']]
+
+        returncode = job['process'].returncode
+        elapsed = int(time.time() - job['start_time'])
+        logging.info('Finished {0} with exit code {1} in {2} seconds'.format(job['layername'], returncode, elapsed))
+
+        self.results[job['layername']] = returncode
+
+        # Append this layer's log to the daily log in one block
+        if os.path.exists(job['log_file']):
+            with open(logger.get_daily_log_file(), 'ab') as daily_log:
+                with open(job['log_file'], 'rb') as layer_log:
+                    shutil.copyfileobj(layer_log, daily_log)
+
+            os.remove(job['log_file'])
+
+    def run(self, poll_seconds=5):
+        """
+        Run all queued layers, returning when they've all finished
+        :param poll_seconds: how often to check on running layers
+        :return: dict of {layername: exit code}
+        """
+        while self.pending or self.running:
+
+            for layername, job in self.running.items():
+                if job['process'].poll() is not None:
+                    self._finish(job)
+
+            # Start layers in the order they were queued, skipping over any that are blocked for now
+            for job in list(self.pending):
+                if self._can_start(job):
+                    self.pending.remove(job)
+                    self._start(job)
+
+            if self.running:
+                time.sleep(poll_seconds)
+
+            # Nothing running and nothing could start: these need more of a resource than we allow
+            elif self.pending:
+                for job in self.pending:
+                    logging.error('Unable to schedule {0}; resource limits too low for '
+                                  '{1}'.format(job['layername'], ', '.join(job['resource_classes'])))
+
+                    # Reported as failed in the summary email
+                    for layername in job['layername'].split(','):
+                        logging.critical('Unscheduled | {0}'.format(layername))
+
+                    self.results[job['layername']] = None
+
+                self.pending = []
+
+        return self.results
@@ -1,7 +1,11 @@
+import copy
 import json
 import os
 from ConfigParser import ConfigParser
 
+# Tokens read so far in this process, by token file name
+_tokens = {}
+
 
 def get_token(token_file):
     """
@@ -9,6 +13,13 @@ def get_token(token_file):
     :param token_file: name of the file
     :return: the token value
     """
+    if token_file not in _tokens:
+        _tokens[token_file] = _read_token(token_file)
+
+    return copy.deepcopy(_tokens[token_file])
+
+
+def _read_token(token_file):
     abspath = os.path.abspath(__file__)
     dir_name = os.path.dirname(os.path.dirname(abspath))
     token_path = os.path.join(dir_name, r"tokens\{0!s}".format(token_file))
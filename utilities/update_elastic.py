@@ -1,12 +1,11 @@
-import os
 import requests
 import logging
 import datetime
-import subprocess
 import uuid
 import time
 import boto3
 
+import utilities.s3_transfer
 import utilities.token_util
 
 
@@ -166,30 +165,15 @@ def delete_and_append(dataset_id, api_version, src_url, delete_where_clause=None
 
 def add_headers_to_s3(layerdef, s3_url, header_csv_str):
 
-    today = datetime.datetime.today().strftime('%Y%m%d')
+    # Stream the CSV from S3 back to the same key with the header in front. The new object replaces the old one
+    # only once it's complete, so nothing has to be written locally
+    src = utilities.s3_transfer.open_reader(s3_url, layerdef.gfw_env)
 
-    temp_s3_dir = os.path.join(layerdef.scratch_workspace, 'temp_s3_download')
-    local_path = os.path.join(temp_s3_dir, '{}.csv'.format(today))
+    with utilities.s3_transfer.open_writer(s3_url, layerdef.gfw_env) as dst:
+        dst.write(header_csv_str + '\n')
 
-    # download CSV without header
-    cmd = ['aws', 's3', 'cp', s3_url, local_path]
-    subprocess.check_call(cmd)
-
-    temp_file = os.path.join(temp_s3_dir, 'temp.csv')
-    if os.path.exists(temp_file):
-        os.remove(temp_file)
-
-    # create file with header
-    cmd = ['echo', header_csv_str, '>', temp_file]
-    subprocess.check_call(cmd, shell=True)
-
-    # append GLAD CSV to it
-    cmd = ['type', local_path, '>>', temp_file]
-    subprocess.check_call(cmd, shell=True)
-
-    # Copy back to s3
-    cmd = ['aws', 's3', 'cp', temp_file, s3_url]
-    subprocess.check_call(cmd)
+        for chunk in iter(lambda: src.read(1024 * 1024), ''):
+            dst.write(chunk)
 
 
 def get_current_hadoop_output(alert_type, url_type=None):
@@ -1,4 +1,5 @@
 import ctypes
+import datetime
 import errno
 import itertools
 import json
@@ -14,9 +15,11 @@ import win32file
 from collections import namedtuple
 
 import arcpy
+import numpy
 import requests
 
 import cartodb
+import dataset_cache
 from token_util import get_token
 
 
@@ -100,6 +103,26 @@ def fc_to_temp_gdb(input_fc, rootdir, where_clause=None):
     return fc_path
 
 
+def fc_to_temp_gpkg(input_fc, rootdir):
+    """
+    Create a tempdir in the root, create a GeoPackage in the temp dir, and copy the input_fc there
+    :param input_fc: the fc of interest
+    :param rootdir: the dir where we'll create the temp dir
+    :return: path to the input_fc as it exists in the new GeoPackage
+    """
+    temp_dir = create_temp_dir(rootdir)
+
+    basepath, fname, base_fname = gen_paths_shp(input_fc)
+
+    gpkg_path = os.path.join(temp_dir, base_fname + '.gpkg')
+    arcpy.CreateSQLiteDatabase_management(gpkg_path, 'GEOPACKAGE')
+
+    arcpy.FeatureClassToFeatureClass_conversion(input_fc, gpkg_path, base_fname)
+    fc_path = os.path.join(gpkg_path, 'main.' + base_fname)
+
+    return fc_path
+
+
 def csl_to_list(csl):
     l = csl.split(',')
     result = []
@@ -115,7 +138,7 @@ def is_wgs_84(input_dataset):
     :return: True/False if SRS is WGS84
     """
     logging.debug('Starting layer.isWGS84')
-    sr_as_string = arcpy.Describe(input_dataset).spatialReference.exporttostring()
+    sr_as_string = dataset_cache.describe(input_dataset).spatialReference.exporttostring()
 
     first_element = sr_as_string.split(',')[0]
 
@@ -237,6 +260,7 @@ def add_field_and_calculate(fc, field_name, field_type, field_length, field_val,
 
     if field_name not in list_fields(fc, gfw_env):
         arcpy.AddField_management(fc, field_name, field_type, "", "", field_length)
+        dataset_cache.invalidate(fc)
 
     if field_type in ['TEXT', 'DATE']:
         field_val = "'{0}'".format(field_val)
@@ -249,17 +273,17 @@ def add_field_and_calculate(fc, field_name, field_type, field_length, field_val,
 
 def list_fields(input_dataset, gfw_env):
     """
-    List fields for an esri or cartoDB dataset
+    List fields for an esri or cartoDB dataset. Results are cached for the run; see dataset_cache
     :param input_dataset: either path to local esri FC or a cartoDB table name
     :param gfw_env: used to determine which cartoDB account to use
     :return: list of fields
     """
 
-    if arcpy.Exists(input_dataset):
-        field_list = [x.name for x in arcpy.ListFields(input_dataset)]
+    if dataset_cache.exists(input_dataset):
+        field_list = dataset_cache.esri_fields(input_dataset)
 
-    elif cartodb.cartodb_check_exists(input_dataset, gfw_env):
-        field_list = cartodb.get_column_order(input_dataset, gfw_env)
+    elif dataset_cache.carto_exists(input_dataset, gfw_env):
+        field_list = dataset_cache.carto_fields(input_dataset, gfw_env)
 
     else:
         logging.error('Input dataset type for list_fields unknown. Does not appear to be an esri fc, and '
@@ -362,27 +386,197 @@ def validate_osm_source(osm_source):
     return is_valid
 
 
-def generate_where_clause(start_row, end_row, where_field_name, transaction_row_limit):
+class IdWindowPlanner(object):
     """
-    Build a series of where clauses based on a start_row, end_row, a number of ids per where_clause, and the field_name
-    Also sleeps for a minute every time the current_max_id is divisible by 20,000. Important to give the API a break
-    Per the cartoDB developers, we're hardcoding the transaction row limit to 500
-    :param start_row: the first ID to append, usually 0
-    :param end_row: the last ID in the dataset
-    :param where_field_name: the field name of the where_field
-    :return: where_clauses for all ids from start_id to end_id in the appropriate chunks
+    Hands out windows of consecutive (sorted) IDs one at a time, each with at most a given number of rows and, if
+    row_sizes are given, roughly target_bytes of data. Windows are built from the IDs that exist, so gaps in the ID
+    space never produce empty windows. The row limit can change from one window to the next
+    :param id_list: list or numpy array of integer IDs
+    :param row_sizes: optional list or array of the size in bytes of each row, in the same order as id_list
+    :param target_bytes: max bytes per window; a single row larger than this gets a window to itself
+    """
+    def __init__(self, id_list, row_sizes=None, target_bytes=None):
+        ids = numpy.asarray(id_list, dtype=numpy.int64)
+        order = numpy.argsort(ids, kind='mergesort')
+
+        self.ids = ids[order]
+        self.target_bytes = target_bytes
+        self.position = 0
+
+        if row_sizes is not None and target_bytes:
+            # Cumulative bytes up to and including each row; used to find where each window hits target_bytes
+            self.cumulative_bytes = numpy.cumsum(numpy.asarray(row_sizes, dtype=numpy.int64)[order])
+        else:
+            self.cumulative_bytes = None
+
+    def remaining(self):
+        return self.ids.size - self.position
+
+    def next_window(self, target_rows):
+        """
+        :param target_rows: max rows in this window
+        :return: tuple of (first_id, last_id, row count), or None when every ID has been handed out
+        """
+        start = self.position
+
+        if start >= self.ids.size:
+            return None
+
+        end = min(start + target_rows, self.ids.size)
+
+        if self.cumulative_bytes is not None:
+            bytes_before = self.cumulative_bytes[start - 1] if start else 0
+            end_by_bytes = int(numpy.searchsorted(self.cumulative_bytes, bytes_before + self.target_bytes,
+                                                  side='right'))
+
+            end = max(start + 1, min(end, end_by_bytes))
+
+        self.position = end
+
+        return int(self.ids[start]), int(self.ids[end - 1]), end - start
+
+
+def plan_id_chunks(id_list, target_rows, row_sizes=None, target_bytes=None):
+    """
+    Split a list of IDs into windows of consecutive (sorted) IDs, each with at most target_rows rows and, if
+    row_sizes are given, roughly target_bytes of data
+    :param id_list: list or numpy array of integer IDs
+    :param target_rows: max rows per window
+    :param row_sizes: optional list or array of the size in bytes of each row, in the same order as id_list
+    :param target_bytes: max bytes per window; a single row larger than this gets a window to itself
+    :return: generator of (first_id, last_id) tuples
+    """
+    planner = IdWindowPlanner(id_list, row_sizes, target_bytes)
+
+    window = planner.next_window(target_rows)
+
+    while window:
+        yield window[0], window[1]
+        window = planner.next_window(target_rows)
+
+
+def chunk_where_clause(where_field_name, first_id, last_id):
+    """
+    :param where_field_name: the field name of the ID field
+    :param first_id: first ID in the window
+    :param last_id: last ID in the window
+    :return: a where clause that selects the window
+    """
+    return '{0} >= {1} and {0} <= {2}'.format(where_field_name, first_id, last_id)
+
+
+def generate_chunk_where_clause(id_list, where_field_name, target_rows, row_sizes=None, target_bytes=None):
+    """
+    Build where clauses for the windows from plan_id_chunks()
+    :param id_list: list or numpy array of integer IDs
+    :param where_field_name: the field name of the ID field
+    :param target_rows: max rows per where_clause
+    :param row_sizes: optional size in bytes of each row, in the same order as id_list
+    :param target_bytes: optional max bytes per where_clause
+    :return: where_clauses that together select every ID in id_list, skipping gaps in the ID space
+    """
+    chunk_count = 0
+
+    for first_id, last_id in plan_id_chunks(id_list, target_rows, row_sizes, target_bytes):
+        chunk_count += 1
+        yield chunk_where_clause(where_field_name, first_id, last_id)
+
+    logging.debug('Split {0} IDs into {1} chunks'.format(len(id_list), chunk_count))
+
+
+def get_oids_and_sizes(input_fc, where_clause=None):
+    """
+    Read the OID and size of the geometry of every row in one pass, to plan append chunks with plan_id_chunks()
+    :param input_fc: input FC or feature layer
+    :param where_clause: optional where clause
+    :return: tuple of numpy arrays (oids, sizes in bytes)
+    """
+    oid_list = []
+    size_list = []
+
+    with arcpy.da.SearchCursor(input_fc, ['OID@', 'SHAPE@WKB'], where_clause) as cursor:
+        for oid, wkb in cursor:
+            oid_list.append(oid)
+            size_list.append(len(wkb) if wkb else 0)
+
+    return numpy.array(oid_list, dtype=numpy.int64), numpy.array(size_list, dtype=numpy.int64)
+
+
+def get_oids(input_fc, where_clause=None):
+    """
+    :param input_fc: input FC or feature layer
+    :param where_clause: optional where clause
+    :return: numpy array of the OIDs of every row
+    """
+    oid_array = arcpy.da.TableToNumPyArray(input_fc, ['OID@'], where_clause)
+
+    return oid_array['OID@'].astype(numpy.int64)
+
+
+def normalize_value(value):
+    """
+    Convert a cursor value to a string that's the same whichever database it was read from; used to compare rows
+    between a source and an output that may store a field as a different type
+    :param value: a value from an arcpy cursor
+    :return: a str
     """
+    if value is None:
+        return ''
 
-    # Set the max to the start_id
-    current_max_id = start_row
+    elif isinstance(value, (int, long, float)):
+        return '{0:.10g}'.format(float(value))
+
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+
+    elif isinstance(value, unicode):
+        return value.strip().encode('utf-8')
+
+    else:
+        return str(value).strip()
+
+
+def diff_rows_by_key(current_rows, new_rows):
+    """
+    Work out which rows to delete and which to add to turn one set of rows into another, where rows with the same
+    key (i.e. a hash of the feature) are interchangeable. The same key can appear more than once; only the
+    difference in count is deleted/added
+    :param current_rows: dict of {key: list of IDs} for the rows there now
+    :param new_rows: dict of {key: list of IDs} for the rows there should be
+    :return: tuple of (dict of {key: IDs in current_rows to delete}, dict of {key: IDs in new_rows to add})
+    """
+    to_delete = {}
+    to_append = {}
+
+    for key, id_list in current_rows.iteritems():
+        surplus = id_list[len(new_rows.get(key, [])):]
+
+        if surplus:
+            to_delete[key] = surplus
+
+    for key, id_list in new_rows.iteritems():
+        missing = id_list[len(current_rows.get(key, [])):]
+
+        if missing:
+            to_append[key] = missing
+
+    return to_delete, to_append
+
+
+def generate_oid_list_where_clause(oid_list, where_field_name, transaction_row_limit):
+    """
+    Build a series of where clauses that select a list of IDs, transaction_row_limit IDs at a time
+    :param oid_list: the IDs to select
+    :param where_field_name: the field name of the where_field
+    :param transaction_row_limit: max number of IDs per where_clause
+    :return: where_clauses for all ids in oid_list
+    """
+    oid_list = sorted(oid_list)
 
-    # Iterate until the current max is > the last id of interest
-    while current_max_id <= end_row:
-        yield '{0} >= {1} and {0} < {2}'.format(where_field_name, current_max_id,
-                                                current_max_id + transaction_row_limit)
+    for i in range(0, len(oid_list), transaction_row_limit):
+        chunk = oid_list[i:i + transaction_row_limit]
 
-        # Increment the current_max_id based on the rows we just processed
-        current_max_id += transaction_row_limit
+        yield '{0} IN ({1})'.format(where_field_name, ', '.join([str(x) for x in chunk]))
 
 
 def make_dummy_gfw_env(gfw_env, scratch_workspace=r'D:\data\gfw-sync-scratch\temp'):